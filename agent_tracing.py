@@ -0,0 +1,262 @@
+# agent_tracing.py
+
+# Import necessary libraries and modules
+import json
+import os
+import threading
+import time
+import uuid
+from dataclasses import asdict, dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+from uuid import UUID
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+from tools.metrics import ResourceProbe, pop_tool_metrics, start_tool_metrics
+
+# JSONL file every finished run is appended to (overridable via environment; empty disables export)
+TRACE_FILE = os.environ.get("AGENT_TRACE_FILE", os.path.join(".agent_traces", "traces.jsonl"))
+
+# Output of AgentExecutor when it gives up
+_ITERATION_LIMIT_MARKER = "Agent stopped due to iteration limit"
+
+_write_lock = threading.Lock()
+
+
+@dataclass
+class LLMCallTrace:
+    """One LLM call: latency (and time to first token when streamed), tokens and text sizes."""
+    latency_s: float
+    first_token_s: Optional[float] = None
+    prompt_tokens: Optional[int] = None
+    completion_tokens: Optional[int] = None
+    prompt_chars: int = 0
+    completion_chars: int = 0
+
+
+@dataclass
+class StepTrace:
+    """
+    One ReAct cycle: the LLM call that chose the action, and the tool call.
+    `tool_metrics` holds wall_s, cpu_s, peak_rss_mb and rss_growth_mb plus
+    whatever the tool reported (exec_s, chart_s, load_s, backend...).
+    """
+    index: int
+    tool: str
+    tool_input_chars: int = 0
+    llm: Optional[LLMCallTrace] = None
+    tool_metrics: Dict[str, Any] = field(default_factory=dict)
+    observation_chars: int = 0
+    observation_lines: int = 0
+    error: Optional[str] = None
+
+
+@dataclass
+class RunTrace:
+    """A whole agent run: its steps, the final LLM call and run-level metadata."""
+    run_id: str
+    session_id: str = ""
+    model_name: str = ""
+    question: str = ""
+    dataset_fingerprint: str = ""
+    started_at: float = field(default_factory=time.time)
+    total_s: Optional[float] = None
+    status: str = "running"
+    steps: List[StepTrace] = field(default_factory=list)
+    final_llm: Optional[LLMCallTrace] = None
+    answer_chars: int = 0
+    error: Optional[str] = None
+
+    @property
+    def llm_calls(self) -> List[LLMCallTrace]:
+        calls = [step.llm for step in self.steps if step.llm is not None]
+        return calls + ([self.final_llm] if self.final_llm is not None else [])
+
+    @property
+    def llm_s(self) -> float:
+        return sum(call.latency_s for call in self.llm_calls)
+
+    @property
+    def tool_s(self) -> float:
+        return sum(step.tool_metrics.get("wall_s", 0.0) for step in self.steps)
+
+    def token_totals(self) -> Tuple[Optional[int], Optional[int]]:
+        """(prompt, completion) tokens over every call, or None when the model reported none."""
+        calls = self.llm_calls
+        prompt = [call.prompt_tokens for call in calls if call.prompt_tokens is not None]
+        completion = [call.completion_tokens for call in calls if call.completion_tokens is not None]
+        return (sum(prompt) if prompt else None, sum(completion) if completion else None)
+
+    def to_dict(self) -> dict:
+        record = asdict(self)
+        prompt_tokens, completion_tokens = self.token_totals()
+        record.update(
+            llm_s=self.llm_s,
+            tool_s=self.tool_s,
+            llm_call_count=len(self.llm_calls),
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
+        )
+        return record
+
+
+def write_trace(trace: RunTrace, path: str = TRACE_FILE) -> None:
+    """Appends a run as one JSON line to `path`. Export errors never fail the run."""
+    if not path:
+        return
+    line = json.dumps(trace.to_dict(), ensure_ascii=False, default=str)
+    try:
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with _write_lock, open(path, "a", encoding="utf-8") as handle:
+            handle.write(line + "\n")
+    except OSError:
+        pass
+
+
+def _token_usage(response) -> Tuple[Optional[int], Optional[int]]:
+    """(prompt, completion) tokens reported by the model, from the message or the provider output."""
+    for generations in response.generations:
+        for generation in generations:
+            usage = getattr(getattr(generation, "message", None), "usage_metadata", None)
+            if usage:
+                return usage.get("input_tokens"), usage.get("output_tokens")
+    output = response.llm_output or {}
+    usage = output.get("token_usage") or output.get("usage_metadata") or {}
+    return (usage.get("prompt_tokens", usage.get("input_tokens")),
+            usage.get("completion_tokens", usage.get("output_tokens")))
+
+
+class AgentTracer(BaseCallbackHandler):
+    """
+    Callback handler that records one agent run as a RunTrace: per step,
+    the LLM call's latency and tokens, the tool's wall time, CPU time and
+    peak memory (see `tools.metrics`) and the observation size. When the run
+    ends the trace is appended to `trace_file` as JSONL.
+
+    Attach one tracer per run, ahead of handlers that read `trace` (they are
+    called in list order, so the step is complete by the time they see it).
+    Events are handled inline in async runs too, so tool metrics reported
+    from the executor thread reach the right step.
+    """
+
+    raise_error = False
+    run_inline = True
+
+    def __init__(self, session_id: str = "", model_name: str = "", question: str = "",
+                 dataset_fingerprint: str = "", trace_file: Optional[str] = TRACE_FILE):
+        self.trace = RunTrace(run_id=uuid.uuid4().hex, session_id=session_id, model_name=model_name,
+                              question=question, dataset_fingerprint=dataset_fingerprint)
+        self.trace_file = trace_file
+        self._root_run = None
+        self._started = time.perf_counter()
+        self._llm_starts = {}             # LLM run id -> (start time, prompt chars, first token time)
+        self._pending_llm = None          # last finished LLM call, not yet tied to an action
+        self._probe = None
+
+    @property
+    def current_step(self) -> Optional[StepTrace]:
+        return self.trace.steps[-1] if self.trace.steps else None
+
+    # --- Run lifecycle ---
+
+    def on_chain_start(self, serialized: Dict[str, Any], inputs: Dict[str, Any], *, run_id: UUID,
+                       parent_run_id: Optional[UUID] = None, **kwargs: Any) -> None:
+        if parent_run_id is None and self._root_run is None:
+            self._root_run = run_id
+            self._started = time.perf_counter()
+            self.trace.started_at = time.time()
+
+    def on_chain_end(self, outputs: Dict[str, Any], *, run_id: UUID, **kwargs: Any) -> None:
+        if run_id == self._root_run:
+            answer = str(outputs.get("output", "")) if isinstance(outputs, dict) else str(outputs)
+            self.trace.answer_chars = len(answer)
+            self._finish("iteration_limit" if _ITERATION_LIMIT_MARKER in answer else "ok")
+
+    def on_chain_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> None:
+        if run_id == self._root_run:
+            self.trace.error = f"{type(error).__name__}: {error}"
+            self._finish("error")
+
+    def _finish(self, status: str) -> None:
+        self.trace.status = status
+        self.trace.total_s = time.perf_counter() - self._started
+        if self._pending_llm is not None:
+            self.trace.final_llm = self._pending_llm
+            self._pending_llm = None
+        write_trace(self.trace, self.trace_file)
+
+    # --- LLM calls ---
+
+    def on_chat_model_start(self, serialized: Dict[str, Any], messages: List[List[Any]], *, run_id: UUID, **kwargs: Any) -> None:
+        chars = sum(len(str(getattr(message, "content", message))) for batch in messages for message in batch)
+        self._llm_starts[run_id] = [time.perf_counter(), chars, None]
+
+    def on_llm_start(self, serialized: Dict[str, Any], prompts: List[str], *, run_id: UUID, **kwargs: Any) -> None:
+        self._llm_starts[run_id] = [time.perf_counter(), sum(len(prompt) for prompt in prompts), None]
+
+    def on_llm_new_token(self, token: str, *, run_id: UUID, **kwargs: Any) -> None:
+        start = self._llm_starts.get(run_id)
+        if start is not None and start[2] is None:
+            start[2] = time.perf_counter()
+
+    def on_llm_end(self, response, *, run_id: UUID, **kwargs: Any) -> None:
+        start = self._llm_starts.pop(run_id, None)
+        if start is None:
+            return
+        started, prompt_chars, first_token = start
+        prompt_tokens, completion_tokens = _token_usage(response)
+        self._pending_llm = LLMCallTrace(
+            latency_s=time.perf_counter() - started,
+            first_token_s=None if first_token is None else first_token - started,
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
+            prompt_chars=prompt_chars,
+            completion_chars=sum(len(generation.text) for generations in response.generations for generation in generations),
+        )
+
+    def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> None:
+        self._llm_starts.pop(run_id, None)
+
+    # --- Agent steps and tools ---
+
+    def on_agent_action(self, action, *, run_id: UUID, **kwargs: Any) -> None:
+        self.trace.steps.append(StepTrace(
+            index=len(self.trace.steps),
+            tool=action.tool,
+            tool_input_chars=len(str(action.tool_input)),
+            llm=self._pending_llm,
+        ))
+        self._pending_llm = None
+
+    def on_tool_start(self, serialized: Dict[str, Any], input_str: str, *, run_id: UUID, **kwargs: Any) -> None:
+        start_tool_metrics()
+        if self.current_step is None or self.current_step.tool_metrics:
+            # A tool call without a preceding action (should not happen with AgentExecutor)
+            name = (serialized or {}).get("name", "") or kwargs.get("name", "")
+            self.trace.steps.append(StepTrace(index=len(self.trace.steps), tool=name, tool_input_chars=len(input_str)))
+        self._probe = ResourceProbe()
+
+    def _finish_tool(self) -> StepTrace:
+        step = self.current_step
+        metrics = self._probe.finish() if self._probe is not None else {}
+        self._probe = None
+        # Values the tool measured itself (e.g. in a sandbox worker) take precedence
+        metrics.update(pop_tool_metrics())
+        step.tool_metrics = metrics
+        return step
+
+    def on_tool_end(self, output: Any, *, run_id: UUID, **kwargs: Any) -> None:
+        if self.current_step is None:
+            return
+        step = self._finish_tool()
+        observation = str(getattr(output, "content", output))
+        step.observation_chars = len(observation)
+        step.observation_lines = observation.count("\n") + 1 if observation else 0
+
+    def on_tool_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any) -> None:
+        if self.current_step is None:
+            return
+        step = self._finish_tool()
+        step.error = f"{type(error).__name__}: {error}"
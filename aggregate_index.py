@@ -0,0 +1,210 @@
+# aggregate_index.py
+
+# Import necessary libraries and modules
+import json
+from typing import Dict, Iterable, List, Optional
+
+import pandas as pd
+
+from nfe_parser import emission_month
+
+# Dimensions the cubes are grouped by; "month" is the emission month (YYYY-MM) of `dhEmi`
+DIMENSIONS = ("emit_CNPJ", "dest_CNPJ", "prod_NCM", "prod_cProd", "month")
+
+# Name shown next to each identifier in lookups
+DIMENSION_LABELS = {"emit_CNPJ": "emit_xNome", "dest_CNPJ": "dest_xNome", "prod_cProd": "prod_xProd"}
+
+# Additive measures kept per group: summed columns plus the item count
+SUM_MEASURES = ("prod_vProd", "prod_qCom")
+MEASURES = SUM_MEASURES + ("itens",)
+
+# Each dimension alone and crossed with the month
+CUBES = tuple((dimension,) for dimension in DIMENSIONS) + tuple(
+    (dimension, "month") for dimension in DIMENSIONS if dimension != "month"
+)
+
+# Rows returned by a lookup unless the query asks otherwise
+DEFAULT_TOP = 20
+
+
+def _as_category(series: pd.Series) -> pd.Series:
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        return series
+    return series.astype("string").astype("category")
+
+
+def _cube_frame(df: pd.DataFrame) -> pd.DataFrame:
+    """Reduces item rows to the categorical and numeric columns the cubes are built from."""
+    if "source_file" in df.columns:
+        columns = {"source_file": _as_category(df["source_file"])}
+    else:
+        columns = {"source_file": pd.Series("", index=df.index, dtype="category")}
+    for dimension in DIMENSIONS:
+        if dimension == "month" and "dhEmi" in df.columns:
+            columns[dimension] = emission_month(df["dhEmi"]).astype("category")
+        elif dimension != "month" and dimension in df.columns:
+            columns[dimension] = _as_category(df[dimension])
+        else:
+            columns[dimension] = pd.Series(pd.NA, index=df.index, dtype="category")
+    for label in DIMENSION_LABELS.values():
+        if label in df.columns:
+            columns[label] = df[label]
+    for measure in SUM_MEASURES:
+        if measure in df.columns:
+            columns[measure] = pd.to_numeric(df[measure].astype("float64"), errors="coerce")
+        else:
+            columns[measure] = pd.Series(float("nan"), index=df.index)
+    return pd.DataFrame(columns, index=df.index)
+
+
+class AggregateIndex:
+    """
+    Pre-aggregated cubes over the invoice items: sums of `prod_vProd` and
+    `prod_qCom` and the item count per emitter, recipient, NCM, product and
+    emission month, alone and per month (see `CUBES`).
+
+    Every cube is kept split by `source_file`, which makes it maintainable
+    the same way the dataset is: rows of new files are aggregated and
+    appended with `add`, files that leave the dataset are dropped with
+    `remove`, and lookups sum the per-file partials, which is cheap since
+    they hold one row per file and group instead of one per item.
+    """
+
+    def __init__(self):
+        self.cubes: Dict[tuple, pd.DataFrame] = {}
+        self.labels: Dict[str, pd.Series] = {}
+        self._totals: Dict[tuple, pd.DataFrame] = {}
+
+    @classmethod
+    def from_dataframe(cls, df: Optional[pd.DataFrame]) -> "AggregateIndex":
+        """Builds the index of a whole DataFrame of invoice items in one go."""
+        index = cls()
+        if df is not None and not df.empty:
+            index.add(df)
+        return index
+
+    def add(self, df: pd.DataFrame) -> None:
+        """Aggregates newly ingested (already deduplicated) item rows into the cubes."""
+        if df is None or df.empty:
+            return
+        frame = _cube_frame(df)
+        frame["itens"] = 1
+        for cube in CUBES:
+            partial = (
+                frame.groupby(["source_file", *cube], observed=True, dropna=False, sort=False)[list(MEASURES)]
+                .sum(min_count=1)
+                .reset_index()
+            )
+            # Partials of different batches are concatenated, so keys are stored as plain strings
+            for key in ("source_file", *cube):
+                partial[key] = partial[key].astype("string")
+            partial["itens"] = partial["itens"].fillna(0).astype("int64")
+            existing = self.cubes.get(cube)
+            self.cubes[cube] = partial if existing is None else pd.concat([existing, partial], ignore_index=True)
+        for dimension, label in DIMENSION_LABELS.items():
+            if label in frame.columns:
+                names = frame[[dimension, label]].dropna().drop_duplicates(dimension)
+                names = names.astype("string").set_index(dimension)[label]
+                existing = self.labels.get(dimension)
+                combined = names if existing is None else pd.concat([existing, names])
+                self.labels[dimension] = combined[~combined.index.duplicated(keep="first")]
+        self._totals.clear()
+
+    def remove(self, source_names: Iterable[str]) -> None:
+        """Drops the partials of files that left the dataset."""
+        names = set(source_names)
+        if not names:
+            return
+        for cube, partial in self.cubes.items():
+            self.cubes[cube] = partial[~partial["source_file"].isin(names)].reset_index(drop=True)
+        self._totals.clear()
+
+    def totals(self, cube: tuple) -> pd.DataFrame:
+        """Returns the cube summed over files, computed once per index version."""
+        if cube not in self._totals:
+            partial = self.cubes.get(cube)
+            if partial is None:
+                self._totals[cube] = pd.DataFrame(columns=[*cube, *MEASURES])
+            else:
+                self._totals[cube] = (
+                    partial.groupby(list(cube), dropna=False, sort=False)[list(MEASURES)]
+                    .sum(min_count=1)
+                    .reset_index()
+                )
+        return self._totals[cube]
+
+    def lookup(self, by: List[str], filters: Optional[Dict[str, str]] = None,
+               top: int = DEFAULT_TOP, order: str = "prod_vProd", ascending: bool = False) -> pd.DataFrame:
+        """
+        Answers an aggregate query from the cubes.
+
+        Args:
+            by: Dimensions to group by (one dimension, optionally with "month").
+            filters: Exact-match filters on dimensions, e.g. {"month": "2024-03"}.
+            top: Maximum number of groups returned.
+            order: Measure the groups are ranked by.
+            ascending: Rank from the smallest value instead of the largest.
+
+        Returns:
+            One row per group with the dimensions, their labels and the measures.
+
+        Raises:
+            ValueError: If no cube covers the requested dimensions or the order is unknown.
+        """
+        filters = dict(filters or {})
+        wanted = set(by) | set(filters)
+        cube = next((cube for cube in CUBES if set(cube) == wanted), None)
+        if cube is None:
+            raise ValueError(
+                f"no cube covers dimensions {sorted(wanted)}; available: "
+                + ", ".join("+".join(cube) for cube in CUBES)
+            )
+        if order not in MEASURES:
+            raise ValueError(f"unknown order '{order}'; use one of {', '.join(MEASURES)}")
+
+        result = self.totals(cube)
+        for dimension, value in filters.items():
+            result = result[result[dimension] == str(value)]
+        result = result.groupby(by, dropna=False, sort=False)[list(MEASURES)].sum(min_count=1).reset_index()
+        result = result.sort_values(order, ascending=ascending, na_position="last").head(top)
+        for dimension in by:
+            if dimension in self.labels:
+                position = result.columns.get_loc(dimension) + 1
+                result.insert(position, DIMENSION_LABELS[dimension], result[dimension].map(self.labels[dimension]))
+        return result.reset_index(drop=True)
+
+
+def run_aggregate_query(index: AggregateIndex, query: str) -> str:
+    """
+    Parses a JSON aggregate query and formats its result for the agent.
+
+    The query is a JSON object with "by" (a dimension name or a list with one
+    dimension plus "month"), and optionally "filters", "top", "order" and
+    "ascending".
+    """
+    try:
+        spec = json.loads(query.strip().strip("`").removeprefix("json").strip())
+    except json.JSONDecodeError as e:
+        return f"Invalid query: expected a JSON object ({e}). Example: {{\"by\": \"emit_CNPJ\", \"top\": 10}}"
+    if not isinstance(spec, dict) or "by" not in spec:
+        return "Invalid query: the JSON object must have a \"by\" key. Example: {\"by\": [\"prod_NCM\", \"month\"]}"
+
+    by = spec["by"] if isinstance(spec["by"], list) else [spec["by"]]
+    unknown = [name for name in list(by) + list(spec.get("filters", {})) if name not in DIMENSIONS]
+    if unknown:
+        return f"Invalid query: unknown dimension(s) {unknown}; use {', '.join(DIMENSIONS)}."
+    try:
+        result = index.lookup(
+            by,
+            filters=spec.get("filters"),
+            top=int(spec.get("top", DEFAULT_TOP)),
+            order=spec.get("order", "prod_vProd"),
+            ascending=bool(spec.get("ascending", False)),
+        )
+    except (TypeError, ValueError) as e:
+        return f"Invalid query: {e}"
+    if result.empty:
+        return "No groups match this query."
+    with pd.option_context("display.max_rows", None, "display.max_columns", None, "display.width", 200,
+                           "display.float_format", "{:,.2f}".format):
+        return result.to_string(index=False)
@@ -0,0 +1,206 @@
+# answer_cache.py
+
+# Import necessary libraries and modules
+import hashlib
+import os
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Dict, Iterable, List, Optional
+
+from tools.charts import CHART_TAG_PATTERN
+
+# How long a cached answer stays valid, and how many answers are kept (overridable via environment)
+ANSWER_CACHE_TTL_S = float(os.environ.get("ANSWER_CACHE_TTL_S", str(24 * 3600)))
+ANSWER_CACHE_MAX_ENTRIES = int(os.environ.get("ANSWER_CACHE_MAX_ENTRIES", "256"))
+
+_WHITESPACE = re.compile(r"\s+")
+_TRAILING_PUNCTUATION = re.compile(r"[\s?!.;:]+$")
+
+
+def normalize_question(question: str) -> str:
+    """
+    Reduces a question to the form used in cache keys: case, accents,
+    repeated whitespace and trailing punctuation are ignored, so
+    "Total por NCM?" and "total  por ncm" share an entry.
+    """
+    text = unicodedata.normalize("NFKD", question.casefold())
+    text = "".join(char for char in text if not unicodedata.combining(char))
+    text = _WHITESPACE.sub(" ", text).strip()
+    return _TRAILING_PUNCTUATION.sub("", text)
+
+
+def question_key(model_name: str, question: str, chat_history: str = "") -> str:
+    """
+    Returns the key of a question asked to `model_name` in one conversation,
+    whatever the data. The rendered chat history is part of it, since a
+    follow-up ("e no mês anterior?") only means something in its conversation.
+    """
+    digest = hashlib.sha256()
+    for part in (model_name, normalize_question(question), chat_history):
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def answer_key(dataset_fingerprint: str, model_name: str, question: str, chat_history: str = "") -> str:
+    """Returns the cache key of a question (see `question_key`) about one dataset version."""
+    digest = hashlib.sha256()
+    for part in (dataset_fingerprint, question_key(model_name, question, chat_history)):
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+@dataclass
+class CachedAnswer:
+    """A finished agent run: its final answer, its ReAct steps and the charts it produced."""
+    question: str
+    output: str
+    intermediate_steps: List[tuple]
+    charts: Dict[str, bytes] = field(default_factory=dict)
+    question_key: Optional[str] = None
+    created_at: float = field(default_factory=time.time)
+    hits: int = 0
+
+    def as_response(self) -> dict:
+        """Returns the entry in the shape of an AgentExecutor response."""
+        return {"input": self.question, "output": self.output, "intermediate_steps": list(self.intermediate_steps)}
+
+
+class AnswerCache:
+    """
+    Process-wide cache of agent answers, keyed by dataset fingerprint, model
+    name, normalized question and chat history (see `answer_key`). Entries
+    expire after `ttl_s` seconds and the least recently used ones are dropped
+    beyond `max_entries`.
+
+    The latest answer to each question is also reachable without the
+    fingerprint (`latest`), so after the data changes it can be revalidated
+    against the new data instead of asking the LLM again.
+    """
+
+    def __init__(self, max_entries: int = ANSWER_CACHE_MAX_ENTRIES, ttl_s: float = ANSWER_CACHE_TTL_S):
+        self.max_entries = max_entries
+        self.ttl_s = ttl_s
+        self._entries = OrderedDict()
+        self._latest = {}                 # question key -> key of its most recent entry
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[CachedAnswer]:
+        """Returns the live entry for `key`, or None on a miss or an expired entry."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if time.time() - entry.created_at > self.ttl_s:
+                self._drop(key)
+                return None
+            self._entries.move_to_end(key)
+            entry.hits += 1
+            return entry
+
+    def latest(self, question_key: str) -> Optional[CachedAnswer]:
+        """Returns the most recent live entry for a question, about any dataset version."""
+        with self._lock:
+            key = self._latest.get(question_key)
+        return self.get(key) if key is not None else None
+
+    def _drop(self, key: str) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None and self._latest.get(entry.question_key) == key:
+            del self._latest[entry.question_key]
+
+    def put(self, key: str, question: str, response: dict, charts: Optional[Dict[str, bytes]] = None,
+            question_key: Optional[str] = None) -> Optional[CachedAnswer]:
+        """
+        Stores a finished AgentExecutor response with the rendered charts its
+        answer references (by chart id), as the latest answer to `question_key`
+        when given. Runs that stopped at the iteration limit are not cached,
+        since they hold no real answer.
+
+        Returns:
+            The stored entry, or None when the response was not cacheable.
+        """
+        output = response.get("output")
+        if not output or "Agent stopped due to iteration limit" in output:
+            return None
+        entry = CachedAnswer(
+            question=question,
+            output=output,
+            intermediate_steps=list(response.get("intermediate_steps", [])),
+            charts=dict(charts or {}),
+            question_key=question_key,
+        )
+        with self._lock:
+            self._drop(key)
+            self._entries[key] = entry
+            if question_key is not None:
+                self._latest[question_key] = key
+            while len(self._entries) > self.max_entries:
+                self._drop(next(iter(self._entries)))
+        return entry
+
+    def invalidate(self, key: str) -> None:
+        """Drops the entry for `key`."""
+        with self._lock:
+            self._drop(key)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._latest.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+def _comparable(observation) -> str:
+    # Chart ids are new on every run; the observations match if everything else does
+    return CHART_TAG_PATTERN.sub(r"[\1:]", str(observation))
+
+
+def revalidate(entry: CachedAnswer, tools: Iterable) -> bool:
+    """
+    Checks whether a cached answer computed on another dataset version
+    still holds for the session's data: re-runs its tool calls against the
+    session's current tools (and so its current `df`), without calling the
+    LLM, and confirms it when every observation comes out identical (up to
+    chart ids).
+
+    Answers with charts are never confirmed, since equal observations do not
+    mean equal pictures, nor are answers without any tool call to re-run.
+
+    Args:
+        entry: The cached answer to check.
+        tools: The tools of the session's AgentExecutor.
+
+    Returns:
+        True if every step reproduced its cached observation.
+    """
+    if entry.charts:
+        return False
+    tools_by_name = {tool.name: tool for tool in tools}
+    checked = 0
+    for action, observation in entry.intermediate_steps:
+        tool = tools_by_name.get(getattr(action, "tool", None))
+        if tool is None:
+            # Parsing-error steps and similar have no tool to re-run
+            continue
+        try:
+            if _comparable(tool.invoke(action.tool_input)) != _comparable(observation):
+                return False
+        except Exception:
+            return False
+        checked += 1
+    return checked > 0
+
+
+@lru_cache(maxsize=1)
+def get_answer_cache() -> AnswerCache:
+    """Returns the answer cache shared by every session of this server process."""
+    return AnswerCache()
@@ -0,0 +1,377 @@
+# batch_runner.py
+
+# Import necessary libraries and modules
+import argparse
+import asyncio
+import json
+import os
+import re
+import sys
+import time
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional
+
+from dotenv import load_dotenv
+
+from agent_tracing import AgentTracer
+from agent_workflow import create_data_analysis_workflow, get_llm
+from answer_cache import answer_key
+from dataset import InvoiceDataset
+from ingestion import iter_sources
+from invoice_store import InvoiceStore
+from parse_cache import ParseCache
+from tools.analysis_tools import ExecutionContext
+
+DEFAULT_MODEL = "gemini-2.5-flash"
+DEFAULT_CONCURRENCY = 4
+
+# Files written to the output directory
+ANSWERS_FILE = "answers.jsonl"
+TRACES_FILE = "traces.jsonl"
+RUN_FILE = "run.json"
+CHARTS_DIR = "charts"
+
+_UNSAFE_FILENAME = re.compile(r"[^A-Za-z0-9_.-]+")
+
+
+@dataclass
+class BatchQuestion:
+    """One question of a batch; `id` names its answer record and chart files."""
+    id: str
+    question: str
+
+
+@dataclass
+class BatchSummary:
+    """Outcome of a batch run."""
+    output_dir: str
+    answered: int = 0
+    failed: int = 0
+    skipped: int = 0
+    seconds: float = 0.0
+    errors: List[str] = field(default_factory=list)
+
+
+def load_questions(path: str) -> List[BatchQuestion]:
+    """
+    Reads a JSONL question file: one object per line with a "question" and
+    an optional "id" (default: q<line number>), or a bare JSON string.
+    Blank lines are ignored; ids must be unique.
+    """
+    questions, seen = [], set()
+    with open(path, encoding="utf-8") as handle:
+        for number, line in enumerate(handle, start=1):
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            if isinstance(entry, str):
+                entry = {"question": entry}
+            if not isinstance(entry, dict) or not str(entry.get("question", "")).strip():
+                raise ValueError(f"{path}:{number}: expected a JSON object with a \"question\"")
+            question_id = str(entry.get("id") or f"q{number:04d}")
+            if question_id in seen:
+                raise ValueError(f"{path}:{number}: duplicate question id {question_id!r}")
+            seen.add(question_id)
+            questions.append(BatchQuestion(id=question_id, question=str(entry["question"]).strip()))
+    return questions
+
+
+def load_finished(answers_path: str, retry_failed: bool = False) -> Dict[str, dict]:
+    """
+    Reads the answer records of a previous (possibly interrupted) run, by id.
+    A line cut short by a crash is ignored, and failed questions are left
+    out when `retry_failed` is set, so they run again.
+    """
+    finished = {}
+    if not os.path.exists(answers_path):
+        return finished
+    with open(answers_path, encoding="utf-8") as handle:
+        for line in handle:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if retry_failed and record.get("status") != "ok":
+                finished.pop(record.get("id"), None)
+                continue
+            finished[record.get("id")] = record
+    return finished
+
+
+def _end_partial_line(path: str) -> None:
+    # A crash mid-write leaves a line without its newline; close it so new records start clean
+    try:
+        with open(path, "rb+") as handle:
+            handle.seek(0, os.SEEK_END)
+            if handle.tell() == 0:
+                return
+            handle.seek(-1, os.SEEK_END)
+            if handle.read(1) != b"\n":
+                handle.write(b"\n")
+    except FileNotFoundError:
+        pass
+
+
+def _append_record(path: str, record: dict) -> None:
+    # One flushed line per question, so a crash loses at most the questions in flight
+    with open(path, "a", encoding="utf-8") as handle:
+        handle.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+        handle.flush()
+        os.fsync(handle.fileno())
+
+
+def _write_json(path: str, data: dict) -> None:
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as handle:
+        json.dump(data, handle, ensure_ascii=False, indent=2, default=str)
+    os.replace(tmp_path, path)
+
+
+def load_dataset(xml_dir: str, max_workers: Optional[int] = None, use_cache: bool = True,
+                 arrow_dtypes: bool = False) -> InvoiceDataset:
+    """
+    Loads every XML (and .zip of XMLs) under `xml_dir` through the same
+    ingestion as the app: streamed NF-e parsing across a process pool,
+    the Parquet parse cache, deduplication and the columnar store.
+    """
+    def report_progress(done_count, name, error):
+        if error is not None:
+            print(f"  {name}: {error}", file=sys.stderr)
+
+    dataset = InvoiceDataset(arrow_dtypes=arrow_dtypes, store=InvoiceStore())
+    result = dataset.sync(iter_sources(directories=[xml_dir]), max_workers=max_workers,
+                          cache=ParseCache() if use_cache else None, on_progress=report_progress)
+    if dataset.dataframe is None or dataset.dataframe.empty:
+        raise ValueError(f"no NF-e rows could be read from {xml_dir}")
+    ingest = result.ingest
+    if ingest is not None and ingest.errors:
+        print(f"{len(ingest.errors)} of {ingest.file_count} XML file(s) could not be read and were skipped.", file=sys.stderr)
+    return dataset
+
+
+async def arun_questions(
+    questions: List[BatchQuestion],
+    context: ExecutionContext,
+    build_executor: Callable[[ExecutionContext], object],
+    output_dir: str,
+    dataset_fingerprint: str,
+    model_name: str,
+    concurrency: int = DEFAULT_CONCURRENCY,
+    retry_failed: bool = False,
+) -> BatchSummary:
+    """
+    Answers `questions` with at most `concurrency` agent runs in flight.
+
+    Each slot gets its own fork of `context` (own variables and charts over
+    the shared data) and an executor built on it; variables are reset before
+    every question, so answers do not depend on which questions ran before.
+    Questions already answered in `output_dir` for the same dataset, model
+    and question text are skipped, which makes an interrupted run resumable.
+
+    Args:
+        questions: The questions to answer.
+        context: The ExecutionContext over the loaded dataset.
+        build_executor: Builds an AgentExecutor on a context (see `create_data_analysis_workflow`).
+        output_dir: Where answers.jsonl, traces.jsonl and charts/ are written.
+        dataset_fingerprint: The dataset version, part of the resume key.
+        model_name: The model name, part of the resume key.
+        concurrency: Maximum number of questions running at once.
+        retry_failed: Run again the questions whose previous attempt failed.
+
+    Returns:
+        A BatchSummary of this invocation.
+    """
+    started = time.perf_counter()
+    summary = BatchSummary(output_dir=output_dir)
+    answers_path = os.path.join(output_dir, ANSWERS_FILE)
+    traces_path = os.path.join(output_dir, TRACES_FILE)
+    charts_dir = os.path.join(output_dir, CHARTS_DIR)
+    os.makedirs(charts_dir, exist_ok=True)
+
+    finished = load_finished(answers_path, retry_failed)
+    _end_partial_line(answers_path)
+    pending = []
+    for item in questions:
+        key = answer_key(dataset_fingerprint, model_name, item.question)
+        if finished.get(item.id, {}).get("key") == key:
+            summary.skipped += 1
+        else:
+            pending.append((item, key))
+    if not pending:
+        summary.seconds = time.perf_counter() - started
+        return summary
+
+    # The free slots bound the concurrency: a question waits until one is returned
+    slots = asyncio.Queue()
+    for index in range(max(1, min(concurrency, len(pending)))):
+        slot_context = context if index == 0 else context.fork()
+        executor = build_executor(slot_context)
+        if isinstance(executor, Exception):
+            raise executor
+        executor.verbose = False
+        slots.put_nowait((slot_context, executor))
+
+    done_count = 0
+
+    async def answer(item: BatchQuestion, key: str) -> None:
+        nonlocal done_count
+        slot_context, executor = await slots.get()
+        try:
+            slot_context.reset_scope()
+            tracer = AgentTracer(session_id=slot_context.session_id, model_name=model_name, question=item.question,
+                                 dataset_fingerprint=dataset_fingerprint, trace_file=traces_path)
+            record = {"id": item.id, "key": key, "question": item.question, "model": model_name}
+            try:
+                response = await executor.ainvoke({"input": item.question, "chat_history": ""},
+                                                  config={"callbacks": [tracer]})
+                output = response.get("output", "")
+                record["status"] = "iteration_limit" if tracer.trace.status == "iteration_limit" else "ok"
+                record["output"] = output
+                record["steps"] = [
+                    {"tool": action.tool, "tool_input": action.tool_input, "observation": str(observation)}
+                    for action, observation in response.get("intermediate_steps", [])
+                ]
+                # Charts are on disk before the record that references them
+                record["charts"] = {}
+                for chart_id, png in slot_context.charts.collect(output).items():
+                    filename = f"{_UNSAFE_FILENAME.sub('_', item.id)}_{chart_id}.png"
+                    with open(os.path.join(charts_dir, filename), "wb") as handle:
+                        handle.write(png)
+                    record["charts"][chart_id] = os.path.join(CHARTS_DIR, filename)
+            except Exception as e:
+                record["status"] = "error"
+                record["error"] = f"{type(e).__name__}: {e}"
+            trace = tracer.trace
+            prompt_tokens, completion_tokens = trace.token_totals()
+            record["timings"] = {
+                "total_s": trace.total_s, "llm_s": trace.llm_s, "tool_s": trace.tool_s,
+                "llm_calls": len(trace.llm_calls), "steps": len(trace.steps),
+                "prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+            }
+            record["trace_id"] = trace.run_id
+        finally:
+            slots.put_nowait((slot_context, executor))
+
+        _append_record(answers_path, record)
+        done_count += 1
+        if record["status"] == "error":
+            summary.failed += 1
+            summary.errors.append(f"{item.id}: {record['error']}")
+        else:
+            summary.answered += 1
+        print(f"[{done_count}/{len(pending)}] {item.id} {record['status']} "
+              f"{record['timings']['total_s'] or 0.0:.1f}s ({record['timings']['steps']} step(s))", file=sys.stderr)
+
+    await asyncio.gather(*(answer(item, key) for item, key in pending))
+    summary.seconds = time.perf_counter() - started
+    return summary
+
+
+def run_batch(
+    xml_dir: str,
+    questions_path: str,
+    output_dir: str,
+    api_key: str = "",
+    model_name: str = DEFAULT_MODEL,
+    concurrency: int = DEFAULT_CONCURRENCY,
+    backend: Optional[str] = None,
+    max_workers: Optional[int] = None,
+    retry_failed: bool = False,
+    llm=None,
+) -> BatchSummary:
+    """
+    Loads the invoices under `xml_dir`, builds the analysis agent and answers
+    every question of `questions_path`, writing to `output_dir`:
+    answers.jsonl (one record per question, with its steps, chart files and
+    timings), charts/ (PNG files), traces.jsonl (per-step traces, see
+    `agent_tracing`) and run.json (dataset and run metadata).
+
+    Re-running with the same arguments resumes: questions already answered
+    for the same dataset and model are skipped.
+
+    Args:
+        xml_dir: Directory of NF-e XML files (and .zip archives), read recursively.
+        questions_path: JSONL question file (see `load_questions`).
+        output_dir: Output directory, created if needed.
+        api_key: The Gemini API key (unused when `llm` is given).
+        model_name: The Gemini model name.
+        concurrency: Maximum number of questions running at once.
+        backend: Code execution backend ("sandbox" or "inprocess"); defaults to ANALYSIS_EXECUTION_BACKEND.
+        max_workers: Size of the XML parsing pool; defaults to the CPU count.
+        retry_failed: Run again the questions whose previous attempt failed.
+        llm: A chat model to use instead of the Gemini client (e.g. a local fake).
+    """
+    questions = load_questions(questions_path)
+    os.makedirs(output_dir, exist_ok=True)
+    if llm is None:
+        llm = get_llm(api_key, model_name)
+
+    load_started = time.perf_counter()
+    dataset = load_dataset(xml_dir, max_workers=max_workers)
+    load_seconds = time.perf_counter() - load_started
+    fingerprint = dataset.fingerprint
+    context = ExecutionContext(dataset.dataframe, backend=backend, profile=dataset.profile,
+                               aggregates=dataset.aggregates, store_paths=dataset.store_paths)
+    print(f"{len(dataset.files)} file(s), {len(dataset.dataframe)} item row(s) loaded in {load_seconds:.1f}s; "
+          f"{len(questions)} question(s)", file=sys.stderr)
+
+    run_info = {
+        "xml_dir": os.path.abspath(xml_dir),
+        "questions": os.path.abspath(questions_path),
+        "model": model_name,
+        "dataset_fingerprint": fingerprint,
+        "files": len(dataset.files),
+        "rows": len(dataset.dataframe),
+        "load_s": load_seconds,
+        "backend": context.backend,
+        "concurrency": concurrency,
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+    }
+    _write_json(os.path.join(output_dir, RUN_FILE), run_info)
+
+    summary = asyncio.run(arun_questions(
+        questions,
+        context,
+        lambda slot_context: create_data_analysis_workflow(slot_context.dataframe, api_key, model_name,
+                                                           context=slot_context, llm=llm),
+        output_dir,
+        fingerprint,
+        model_name,
+        concurrency=concurrency,
+        retry_failed=retry_failed,
+    ))
+
+    run_info.update(finished_at=time.strftime("%Y-%m-%dT%H:%M:%S%z"), answered=summary.answered,
+                    failed=summary.failed, skipped=summary.skipped, seconds=summary.seconds)
+    _write_json(os.path.join(output_dir, RUN_FILE), run_info)
+    return summary
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Answers a JSONL file of questions about a directory of NF-e XML files.")
+    parser.add_argument("--xml-dir", required=True, help="Directory of NF-e XML files (and .zip archives).")
+    parser.add_argument("--questions", required=True, help="JSONL file: {\"id\": ..., \"question\": ...} per line.")
+    parser.add_argument("--output", required=True, help="Output directory (answers.jsonl, charts/, traces.jsonl, run.json).")
+    parser.add_argument("--model", default=DEFAULT_MODEL, help=f"Gemini model name (default: {DEFAULT_MODEL}).")
+    parser.add_argument("--api-key", default=None, help="Gemini API key (default: GOOGLE_API_KEY or GEMINI_API_KEY).")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY, help="Questions answered at once.")
+    parser.add_argument("--backend", choices=("sandbox", "inprocess"), default=None, help="Code execution backend.")
+    parser.add_argument("--workers", type=int, default=None, help="XML parsing processes (default: CPU count).")
+    parser.add_argument("--retry-failed", action="store_true", help="Run again questions that failed previously.")
+    args = parser.parse_args(argv)
+
+    api_key = args.api_key or os.environ.get("GOOGLE_API_KEY") or os.environ.get("GEMINI_API_KEY")
+    if not api_key:
+        parser.error("a Gemini API key is required (--api-key, GOOGLE_API_KEY or GEMINI_API_KEY)")
+
+    summary = run_batch(args.xml_dir, args.questions, args.output, api_key=api_key, model_name=args.model,
+                        concurrency=args.concurrency, backend=args.backend, max_workers=args.workers,
+                        retry_failed=args.retry_failed)
+    print(f"{summary.answered} answered, {summary.failed} failed, {summary.skipped} already done "
+          f"in {summary.seconds:.1f}s; results in {summary.output_dir}", file=sys.stderr)
+    return 1 if summary.failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
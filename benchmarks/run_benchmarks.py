@@ -0,0 +1,314 @@
+# benchmarks/run_benchmarks.py
+
+# Import necessary libraries and modules
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+# Make the repository's flat modules importable when run as `python -m benchmarks.run_benchmarks`
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_ROOT not in sys.path:
+    sys.path.insert(0, REPO_ROOT)
+
+from benchmarks.synthetic_nfe import write_corpus  # noqa: E402
+
+SUITES = ("parser", "ingest", "agent")
+DEFAULT_TRANSCRIPTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "transcripts.json")
+
+# Relative slowdown of a median beyond which --compare flags a regression
+REGRESSION_THRESHOLD = 0.10
+
+
+def _peak_rss_mb() -> Dict[str, float]:
+    # ru_maxrss is in KiB on Linux and in bytes on macOS; children only count once reaped
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return {
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale,
+        "peak_rss_children_mb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale,
+    }
+
+
+def _corpus_stats(corpus: str) -> Dict[str, float]:
+    paths = [os.path.join(corpus, name) for name in sorted(os.listdir(corpus)) if name.endswith(".xml")]
+    return {"files": len(paths), "bytes": sum(os.path.getsize(path) for path in paths)}
+
+
+def _throughput(seconds: float, files: int, rows: int, size: int) -> Dict[str, float]:
+    return {
+        "seconds": seconds,
+        "files_per_s": files / seconds if seconds else 0.0,
+        "rows_per_s": rows / seconds if seconds else 0.0,
+        "mb_per_s": size / (1024 * 1024) / seconds if seconds else 0.0,
+        "rows": rows,
+    }
+
+
+# --- Cases: each runs in a fresh interpreter and returns its metrics --------
+
+
+def case_parser(corpus: str, params: dict) -> dict:
+    """`parse_nfe_xml` over every file of the corpus, in this process."""
+    from nfe_parser import parse_nfe_xml
+
+    stats = _corpus_stats(corpus)
+    paths = [os.path.join(corpus, name) for name in sorted(os.listdir(corpus)) if name.endswith(".xml")]
+    start = time.perf_counter()
+    rows = sum(len(parse_nfe_xml(path)) for path in paths)
+    return _throughput(time.perf_counter() - start, stats["files"], rows, stats["bytes"])
+
+
+def case_ingest_cold(corpus: str, params: dict) -> dict:
+    """`ingest_sources` over the corpus directory, without a parse cache."""
+    from ingestion import ingest_sources, iter_sources
+
+    stats = _corpus_stats(corpus)
+    start = time.perf_counter()
+    result = ingest_sources(iter_sources(directories=[corpus]), max_workers=params["workers"], arrow_dtypes=params["arrow"])
+    rows = 0 if result.dataframe is None else len(result.dataframe)
+    return _throughput(time.perf_counter() - start, stats["files"], rows, stats["bytes"])
+
+
+def case_ingest_warm_cache(corpus: str, params: dict) -> dict:
+    """`ingest_sources` with a parse cache already holding every file (the re-upload path)."""
+    from ingestion import ingest_sources, iter_sources
+    from parse_cache import ParseCache
+
+    stats = _corpus_stats(corpus)
+    with tempfile.TemporaryDirectory(prefix="nfe_bench_cache_") as directory:
+        cache = ParseCache(directory)
+        ingest_sources(iter_sources(directories=[corpus]), max_workers=params["workers"], cache=cache)
+        start = time.perf_counter()
+        result = ingest_sources(iter_sources(directories=[corpus]), max_workers=params["workers"],
+                                arrow_dtypes=params["arrow"], cache=cache)
+        seconds = time.perf_counter() - start
+    rows = 0 if result.dataframe is None else len(result.dataframe)
+    metrics = _throughput(seconds, stats["files"], rows, stats["bytes"])
+    metrics["cache_hits"] = result.cache_hits
+    return metrics
+
+
+def case_dataset_sync(corpus: str, params: dict) -> dict:
+    """`InvoiceDataset.sync` adding the last 10% of the files to a dataset holding the rest."""
+    from dataset import InvoiceDataset
+    from ingestion import iter_sources
+
+    sources = list(iter_sources(directories=[corpus]))
+    base = sources[: max(1, len(sources) * 9 // 10)]
+    dataset = InvoiceDataset(arrow_dtypes=params["arrow"])
+    dataset.sync(base, max_workers=params["workers"])
+    rows_before = len(dataset.dataframe)
+    start = time.perf_counter()
+    result = dataset.sync(sources, max_workers=params["workers"])
+    seconds = time.perf_counter() - start
+    added_bytes = sum(os.path.getsize(source.payload) for source in sources[len(base):])
+    metrics = _throughput(seconds, len(result.added), len(dataset.dataframe) - rows_before, added_bytes)
+    metrics["total_rows"] = len(dataset.dataframe)
+    return metrics
+
+
+def case_agent(corpus: str, params: dict) -> dict:
+    """
+    End-to-end agent runs: `create_data_analysis_workflow` driven by the
+    scripted chat model, one invocation per transcript question.
+    """
+    from agent_tracing import AgentTracer
+    from agent_workflow import create_data_analysis_workflow
+    from benchmarks.scripted_llm import ScriptedChatModel, load_transcripts
+    from ingestion import ingest_sources, iter_sources
+    from tools.analysis_tools import ExecutionContext
+
+    transcripts = load_transcripts(params["transcripts"])
+    df = ingest_sources(iter_sources(directories=[corpus]), max_workers=params["workers"], arrow_dtypes=params["arrow"]).dataframe
+
+    start = time.perf_counter()
+    context = ExecutionContext(df, backend=params["backend"])
+    llm = ScriptedChatModel(transcripts=transcripts, latency_s=params["llm_latency"])
+    executor = create_data_analysis_workflow(df, "", "scripted", context=context, llm=llm)
+    if isinstance(executor, Exception):
+        raise executor
+    executor.verbose = False
+    setup_seconds = time.perf_counter() - start
+
+    questions = {}
+    for question in transcripts:
+        tracer = AgentTracer(session_id=context.session_id, model_name="scripted", question=question, trace_file=None)
+        start = time.perf_counter()
+        response = executor.invoke({"input": question, "chat_history": ""}, config={"callbacks": [tracer]})
+        questions[question] = {
+            "seconds": time.perf_counter() - start,
+            "llm_s": tracer.trace.llm_s,
+            "tool_s": tracer.trace.tool_s,
+            "steps": len(response["intermediate_steps"]),
+            "errors": sum("Error" in str(observation)[:200] for _, observation in response["intermediate_steps"]),
+        }
+    if params["backend"] == "sandbox":
+        # Reap the workers so their peak memory shows up in the children's RSS
+        from tools.sandbox import get_sandbox_pool
+        get_sandbox_pool().shutdown()
+    return {
+        "seconds": setup_seconds + sum(entry["seconds"] for entry in questions.values()),
+        "setup_seconds": setup_seconds,
+        "rows": len(df),
+        "questions": questions,
+    }
+
+
+CASES: Dict[str, List[tuple]] = {
+    "parser": [("parser.parse_nfe_xml", case_parser)],
+    "ingest": [
+        ("ingest.cold", case_ingest_cold),
+        ("ingest.warm_cache", case_ingest_warm_cache),
+        ("ingest.dataset_sync", case_dataset_sync),
+    ],
+    "agent": [("agent.scripted", case_agent)],
+}
+
+
+def _run_case(case: Callable, corpus: str, params: dict) -> dict:
+    metrics = case(corpus, params)
+    metrics.update(_peak_rss_mb())
+    return metrics
+
+
+def run_isolated(case: Callable, corpus: str, params: dict) -> dict:
+    """Runs one case in a fresh spawned interpreter, so imports, caches and peak RSS start clean."""
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as pool:
+        return pool.submit(_run_case, case, corpus, params).result()
+
+
+def _summarize(runs: List[dict]) -> dict:
+    """Median of every numeric metric across repeats (per-question timings included)."""
+    summary = {"repeats": len(runs)}
+    for name, value in runs[0].items():
+        if isinstance(value, (int, float)):
+            summary[name] = statistics.median(run[name] for run in runs)
+        elif name == "questions":
+            summary[name] = {
+                question: {key: statistics.median(run[name][question][key] for run in runs) for key in entry}
+                for question, entry in value.items()
+            }
+    return summary
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_ROOT, capture_output=True, text=True, check=True)
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=REPO_ROOT,
+                               capture_output=True, text=True, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit.stdout.strip() + ("-dirty" if dirty.stdout.strip() else "")
+
+
+def compare(results: dict, baseline: dict, threshold: float = REGRESSION_THRESHOLD) -> List[str]:
+    """
+    Lines comparing the median times of `results` against a previous run.
+    Timings are only comparable when the corpus and run parameters match.
+    """
+    lines = []
+    if baseline.get("corpus") != results.get("corpus"):
+        lines.append("warning: corpus parameters differ from the baseline, timings are not comparable")
+    if baseline.get("params") != results.get("params"):
+        lines.append("warning: run parameters differ from the baseline (workers, dtypes, backend or LLM latency)")
+    for name, case in results["cases"].items():
+        before = baseline.get("cases", {}).get(name)
+        if not before or not before.get("seconds") or "seconds" not in case:
+            continue
+        change = case["seconds"] / before["seconds"] - 1
+        flag = "REGRESSION" if change > threshold else ("improvement" if change < -threshold else "")
+        lines.append(f"{name:<24} {before['seconds']:9.3f}s -> {case['seconds']:9.3f}s  {change:+7.1%}  {flag}".rstrip())
+    return lines
+
+
+def _format_case(name: str, case: dict) -> str:
+    if "error" in case:
+        return f"{name:<24} FAILED: {case['error']}"
+    line = f"{name:<24} {case['seconds']:9.3f}s"
+    if case.get("rows_per_s"):
+        line += f"  {case['files_per_s']:9.1f} files/s  {case['rows_per_s']:11.0f} rows/s  {case['mb_per_s']:7.1f} MB/s"
+    return line + f"  peak RSS {case['peak_rss_mb']:.0f} MB (children {case['peak_rss_children_mb']:.0f} MB)"
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Offline benchmarks of the NF-e parser, ingestion and agent loop.")
+    parser.add_argument("--suite", default=",".join(SUITES), help=f"Comma-separated suites to run ({', '.join(SUITES)}).")
+    parser.add_argument("--files", type=int, default=200, help="Number of synthetic NF-e files.")
+    parser.add_argument("--min-items", type=int, default=1, help="Minimum items per invoice.")
+    parser.add_argument("--max-items", type=int, default=500, help="Maximum items per invoice.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic corpus.")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per case; the median is reported.")
+    parser.add_argument("--workers", type=int, default=None, help="Ingest pool size (default: CPU count).")
+    parser.add_argument("--arrow", action="store_true", help="Use Arrow-backed dtypes.")
+    parser.add_argument("--backend", default="inprocess", choices=("inprocess", "sandbox"),
+                        help="Code execution backend of the agent benchmark.")
+    parser.add_argument("--llm-latency", type=float, default=0.0, help="Simulated seconds per fake LLM call.")
+    parser.add_argument("--transcripts", default=DEFAULT_TRANSCRIPTS, help="Scripted ReAct transcripts (JSON).")
+    parser.add_argument("--corpus-dir", default=None, help="Keep the generated corpus here instead of a temp dir.")
+    parser.add_argument("--output", default=None, help="Write the results as JSON to this file.")
+    parser.add_argument("--compare", default=None, help="A previous --output file to compare against.")
+    args = parser.parse_args(argv)
+
+    suites = [suite.strip() for suite in args.suite.split(",") if suite.strip()]
+    unknown = [suite for suite in suites if suite not in CASES]
+    if unknown:
+        parser.error(f"unknown suite(s): {', '.join(unknown)}")
+
+    corpus_params = {"files": args.files, "min_items": args.min_items, "max_items": args.max_items, "seed": args.seed}
+    params = {
+        "workers": args.workers or os.cpu_count() or 1,
+        "arrow": args.arrow,
+        "backend": args.backend,
+        "llm_latency": args.llm_latency,
+        "transcripts": os.path.abspath(args.transcripts),
+    }
+    results = {
+        "commit": _git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "corpus": corpus_params,
+        "params": {**params, "transcripts": os.path.basename(params["transcripts"])},
+        "repeat": args.repeat,
+        "cases": {},
+    }
+
+    with tempfile.TemporaryDirectory(prefix="nfe_bench_") as scratch:
+        corpus = os.path.abspath(args.corpus_dir or os.path.join(scratch, "corpus"))
+        size = write_corpus(corpus, args.files, args.min_items, args.max_items, args.seed)
+        results["corpus"]["bytes"] = size
+        print(f"corpus: {args.files} files, {size / (1024 * 1024):.1f} MB in {corpus}")
+
+        for suite in suites:
+            for name, case in CASES[suite]:
+                try:
+                    runs = [run_isolated(case, corpus, params) for _ in range(max(1, args.repeat))]
+                    results["cases"][name] = _summarize(runs)
+                except Exception as e:
+                    results["cases"][name] = {"error": f"{type(e).__name__}: {e}"}
+                print(_format_case(name, results["cases"][name]), flush=True)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as handle:
+            json.dump(results, handle, indent=2, ensure_ascii=False)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as handle:
+            baseline = json.load(handle)
+        print(f"\ncompared with {baseline.get('commit')}:")
+        for line in compare(results, baseline):
+            print(line)
+    return 1 if any("error" in case for case in results["cases"].values()) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,68 @@
+# benchmarks/scripted_llm.py
+
+# Import necessary libraries and modules
+import json
+import time
+from typing import Any, Dict, List, Optional
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+
+from tools.charts import CHART_TAG_PATTERN
+
+# Marker of the current question in the rendered ReAct prompt, and of each completed step
+_QUESTION_MARKER = "\nQuestion: "
+_OBSERVATION_MARKER = "\nObservation:"
+
+# Placeholder in a scripted step replaced by the chart tags the run has captured so far
+CHART_TAGS_PLACEHOLDER = "{chart_tags}"
+
+
+def load_transcripts(path: str) -> Dict[str, List[str]]:
+    """
+    Reads scripted ReAct transcripts: a JSON list of {"question", "steps"},
+    where `steps` are the raw model outputs in order (Thought/Action/Action
+    Input blocks, the last one ending in a Final Answer). A Final Answer can
+    show the run's charts with the `{chart_tags}` placeholder.
+    """
+    with open(path, encoding="utf-8") as handle:
+        return {entry["question"]: entry["steps"] for entry in json.load(handle)}
+
+
+class ScriptedChatModel(BaseChatModel):
+    """
+    Deterministic local chat model that replays scripted ReAct transcripts.
+
+    The reply is chosen from the prompt itself: the current question selects
+    the transcript and the number of observations already in the scratchpad
+    selects the step, so runs are reproducible and concurrency-safe.
+    `latency_s` optionally simulates the time of a remote call.
+    """
+
+    transcripts: Dict[str, List[str]]
+    latency_s: float = 0.0
+
+    @property
+    def _llm_type(self) -> str:
+        return "scripted"
+
+    def _reply(self, prompt: str) -> str:
+        _, _, turn = prompt.rpartition(_QUESTION_MARKER)
+        question = turn.split("\n", 1)[0].strip()
+        steps = self.transcripts.get(question)
+        if steps is None:
+            return f"Thought: no script for this question.\nFinal Answer: (no scripted answer for '{question}')"
+        step = steps[min(turn.count(_OBSERVATION_MARKER), len(steps) - 1)]
+        if CHART_TAGS_PLACEHOLDER in step:
+            tags = " ".join(f"[{kind}:{chart_id}]" for kind, chart_id in CHART_TAG_PATTERN.findall(turn))
+            step = step.replace(CHART_TAGS_PLACEHOLDER, tags)
+        return step
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                  run_manager=None, **kwargs: Any) -> ChatResult:
+        if self.latency_s:
+            time.sleep(self.latency_s)
+        prompt = "\n".join(str(message.content) for message in messages)
+        text = self._reply(prompt)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=text))])
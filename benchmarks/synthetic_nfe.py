@@ -0,0 +1,125 @@
+# benchmarks/synthetic_nfe.py
+
+# Import necessary libraries and modules
+import os
+import random
+from datetime import datetime, timedelta
+from typing import Iterator, Tuple
+from xml.sax.saxutils import escape
+
+NFE_NAMESPACE = "http://www.portalfiscal.inf.br/nfe"
+
+# Layouts a generated document can take: bare <NFe>, or wrapped in <nfeProc> with a protocol
+VARIANTS = ("nfe", "nfeproc")
+
+# Size of the pools the generated identifiers are drawn from (controls cardinalities)
+_EMITTERS = 200
+_RECIPIENTS = 2000
+_PRODUCTS = 5000
+_NCMS = 400
+
+_UNITS = ("UN", "KG", "CX", "LT", "PC")
+_FIRST_EMISSION = datetime(2024, 1, 1)
+
+
+def _cnpj(kind: int, number: int) -> str:
+    return f"{kind}{number:07d}000100"[:14]
+
+
+def _access_key(index: int, emitter_cnpj: str, seed: int) -> str:
+    # 44 digits: state and year/month, emitter CNPJ, model 55, series, number, emission type, code and check digit
+    code = (index * 7919 + seed) % 10**8
+    return f"3524{index % 12 + 1:02d}{emitter_cnpj}55001{index % 10**9:09d}1{code:08d}0"
+
+
+def generate_nfe_xml(index: int, items: int, namespaced: bool = True, variant: str = "nfe", seed: int = 0) -> bytes:
+    """
+    Builds one synthetic NF-e document with `items` <det> entries.
+
+    Output is fully determined by (index, items, namespaced, variant, seed),
+    so benchmark corpora are byte-identical across runs and machines.
+
+    Args:
+        index: Document number; also drives the access key and emission date.
+        items: Number of items (<det>) in the invoice.
+        namespaced: Declare the portalfiscal namespace, as real documents do.
+        variant: "nfe" for a bare <NFe>, "nfeproc" for <nfeProc> with <protNFe>.
+        seed: Seed of the value generator.
+    """
+    rng = random.Random(seed * 1_000_003 + index)
+    emitter = rng.randrange(_EMITTERS)
+    key = _access_key(index, _cnpj(1, emitter), seed)
+    recipient = rng.randrange(_RECIPIENTS)
+    emitted = _FIRST_EMISSION + timedelta(minutes=rng.randrange(365 * 24 * 60))
+
+    parts = []
+    total = 0.0
+    for number in range(1, items + 1):
+        product = rng.randrange(_PRODUCTS)
+        quantity = rng.randint(1, 50) * 1.0
+        unit_price = round(rng.uniform(0.5, 2500.0), 2)
+        value = round(quantity * unit_price, 2)
+        total += value
+        parts.append(
+            f'<det nItem="{number}"><prod>'
+            f"<cProd>P{product:05d}</cProd>"
+            f"<cEAN>SEM GTIN</cEAN>"
+            f"<xProd>{escape(f'Produto {product} & cia')}</xProd>"
+            f"<NCM>{84000000 + product % _NCMS:08d}</NCM>"
+            f"<CFOP>5102</CFOP>"
+            f"<uCom>{_UNITS[product % len(_UNITS)]}</uCom>"
+            f"<qCom>{quantity:.4f}</qCom>"
+            f"<vUnCom>{unit_price:.10f}</vUnCom>"
+            f"<vProd>{value:.2f}</vProd>"
+            f"</prod><imposto><ICMS><ICMS00><orig>0</orig><CST>00</CST></ICMS00></ICMS></imposto></det>"
+        )
+
+    namespace = f' xmlns="{NFE_NAMESPACE}"' if namespaced else ""
+    invoice = (
+        f'<NFe{namespace}><infNFe Id="NFe{key}" versao="4.00">'
+        f"<ide><cUF>35</cUF><cNF>{index % 10**8:08d}</cNF><mod>55</mod><serie>1</serie><nNF>{index}</nNF>"
+        f"<dhEmi>{emitted:%Y-%m-%dT%H:%M:%S}-03:00</dhEmi></ide>"
+        f"<emit><CNPJ>{_cnpj(1, emitter)}</CNPJ><xNome>Emitente {emitter} Ltda</xNome>"
+        f"<enderEmit><xLgr>Rua {emitter}</xLgr><UF>SP</UF></enderEmit></emit>"
+        f"<dest><CNPJ>{_cnpj(2, recipient)}</CNPJ><xNome>Destinatario {recipient} SA</xNome></dest>"
+        + "".join(parts)
+        + f"<total><ICMSTot><vBC>0.00</vBC><vProd>{total:.2f}</vProd><vNF>{total:.2f}</vNF></ICMSTot></total>"
+        f"</infNFe><Signature><SignatureValue>{'A' * 344}</SignatureValue></Signature></NFe>"
+    )
+    if variant == "nfeproc":
+        invoice = (
+            f'<nfeProc{namespace} versao="4.00">{invoice}'
+            f"<protNFe><infProt><chNFe>{key}</chNFe><nProt>1{index:014d}</nProt><cStat>100</cStat></infProt></protNFe>"
+            f"</nfeProc>"
+        )
+    return ('<?xml version="1.0" encoding="UTF-8"?>' + invoice).encode("utf-8")
+
+
+def iter_corpus(files: int, min_items: int = 1, max_items: int = 500, seed: int = 0) -> Iterator[Tuple[str, bytes]]:
+    """
+    Yields (file name, XML bytes) for a deterministic corpus: item counts are
+    drawn uniformly from [min_items, max_items] and documents cycle through
+    the four namespaced/plain x bare/nfeProc layouts.
+    """
+    rng = random.Random(seed)
+    for index in range(files):
+        items = rng.randint(min_items, max_items)
+        namespaced = (index // 2) % 2 == 0
+        variant = VARIANTS[index % len(VARIANTS)]
+        yield f"nfe_{index:06d}.xml", generate_nfe_xml(index, items, namespaced, variant, seed)
+
+
+def write_corpus(directory: str, files: int, min_items: int = 1, max_items: int = 500, seed: int = 0) -> int:
+    """
+    Writes `iter_corpus` to `directory`.
+
+    Returns:
+        The total size of the corpus in bytes.
+    """
+    os.makedirs(directory, exist_ok=True)
+    total = 0
+    for name, data in iter_corpus(files, min_items, max_items, seed):
+        with open(os.path.join(directory, name), "wb") as handle:
+            handle.write(data)
+        total += len(data)
+    return total
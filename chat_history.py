@@ -0,0 +1,122 @@
+# chat_history.py
+
+# Import necessary libraries and modules
+import os
+from typing import List, Optional
+
+# Character budget of the history sent with each question (~4 characters per token)
+HISTORY_MAX_CHARS = int(os.environ.get("HISTORY_MAX_CHARS", "6000"))
+
+# Longest a single verbatim message may be inside the history
+MESSAGE_MAX_CHARS = 1500
+
+# Longest the rolling summary may grow
+SUMMARY_MAX_CHARS = 2000
+
+# Messages always kept verbatim, however long the session is
+MIN_RECENT_MESSAGES = 2
+
+_ROLE_LABELS = {"user": "Usuário", "assistant": "Assistente"}
+
+SUMMARY_PROMPT = """Você mantém o resumo de uma sessão de análise de dados de NF-e entre um usuário e um assistente.
+Atualize o resumo existente incorporando as novas mensagens. Preserve obrigatoriamente: filtros e recortes definidos
+pelo usuário (períodos, CNPJs, NCMs, produtos), significados de colunas e convenções combinadas, resultados numéricos
+importantes já obtidos e preferências de apresentação. Descarte cumprimentos e detalhes de execução.
+Responda apenas com o resumo atualizado, em Português, em no máximo {max_chars} caracteres.
+
+Resumo existente:
+{summary}
+
+Novas mensagens:
+{messages}
+
+Resumo atualizado:"""
+
+
+def _format_message(message: dict) -> str:
+    content = str(message.get("content", ""))
+    if len(content) > MESSAGE_MAX_CHARS:
+        content = content[:MESSAGE_MAX_CHARS] + " [...]"
+    return f"{_ROLE_LABELS.get(message.get('role'), message.get('role'))}: {content}"
+
+
+class ChatHistoryManager:
+    """
+    Keeps the chat history sent to the agent within a character budget.
+
+    Recent messages are kept verbatim; when they outgrow the budget, the
+    oldest ones are folded into a rolling summary (with the LLM when one is
+    given, extractively otherwise). Folding happens in chunks down to half
+    the budget, and the summary is kept between turns, so it is only
+    recomputed when messages actually leave the verbatim window.
+    """
+
+    def __init__(self, llm=None, max_chars: int = HISTORY_MAX_CHARS):
+        self.llm = llm
+        self.max_chars = max_chars
+        self.summary = ""
+        self._summarized = 0             # messages already folded into the summary
+
+    def _size(self, messages: List[dict]) -> int:
+        return sum(len(_format_message(message)) + 1 for message in messages)
+
+    def _extractive_summary(self, messages: List[dict]) -> str:
+        # Without an LLM, keep what the user asked: that is where filters and definitions live
+        questions = [f"- {_format_message(message)}" for message in messages if message.get("role") == "user"]
+        summary = "\n".join(filter(None, [self.summary] + questions))
+        return summary[-SUMMARY_MAX_CHARS:]
+
+    def _fold(self, messages: List[dict]) -> None:
+        if not messages:
+            return
+        if self.llm is not None:
+            prompt = SUMMARY_PROMPT.format(
+                max_chars=SUMMARY_MAX_CHARS,
+                summary=self.summary or "(vazio)",
+                messages="\n".join(_format_message(message) for message in messages),
+            )
+            try:
+                response = self.llm.invoke(prompt)
+                summary = str(getattr(response, "content", response)).strip()
+                if summary:
+                    self.summary = summary[:SUMMARY_MAX_CHARS]
+                    return
+            except Exception:
+                pass  # Fall back to the extractive summary below
+        self.summary = self._extractive_summary(messages)
+
+    def render(self, messages: List[dict]) -> str:
+        """
+        Returns the history text for the prompt: the rolling summary of older
+        turns followed by the most recent messages verbatim.
+
+        Args:
+            messages: The full session messages, oldest first, without the current question.
+        """
+        if len(messages) < self._summarized:
+            # The conversation was reset underneath us
+            self.summary, self._summarized = "", 0
+
+        recent = messages[self._summarized:]
+        budget = self.max_chars - len(self.summary)
+        if self._size(recent) > budget and len(recent) > MIN_RECENT_MESSAGES:
+            # Fold the oldest messages until the rest fits in half the budget
+            cut = 0
+            while len(recent) - cut > MIN_RECENT_MESSAGES and self._size(recent[cut:]) > budget // 2:
+                cut += 1
+            self._fold(recent[:cut])
+            self._summarized += cut
+            recent = messages[self._summarized:]
+
+        parts = []
+        if self.summary:
+            parts.append(f"Resumo da conversa anterior:\n{self.summary}")
+        if recent:
+            parts.append("\n".join(_format_message(message) for message in recent))
+        return "\n\n".join(parts) if parts else "(sem histórico)"
+
+    def reset(self, llm: Optional[object] = None) -> None:
+        """Forgets the summary, e.g. when the agent is re-initialized."""
+        self.summary, self._summarized = "", 0
+        if llm is not None:
+            self.llm = llm
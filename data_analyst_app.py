@@ -2,121 +2,18 @@
 
 import streamlit as st
 from dotenv import load_dotenv
-from agent_workflow import create_data_analysis_workflow 
+from agent_tracing import AgentTracer
+from agent_workflow import create_data_analysis_workflow, get_llm
+from answer_cache import answer_key, get_answer_cache, question_key, revalidate
+from chat_history import ChatHistoryManager
+from streamlit_callbacks import StreamlitAgentCallbackHandler, format_run_summary, render_agent_steps
+from dataset import InvoiceDataset
+from ingestion import count_sources, iter_sources
+from invoice_store import InvoiceStore
+from parse_cache import ParseCache
+from tools.analysis_tools import ExecutionContext
+from tools.charts import CHART_TAG_PATTERN
 import os
-import pandas as pd
-import re
-import xml.etree.ElementTree as ET
-
-def parse_nfe_xml(uploaded_file) -> pd.DataFrame:
-    """
-    Robust NF-e XML parser that is namespace-agnostic.
-    Each <det> (item) becomes a row; invoice-level fields are repeated.
-    Works with default namespaces by comparing local tag names.
-    """
-    def local(tag: str) -> str:
-        return tag.split('}')[-1] if '}' in tag else tag
-
-    def find_child_by_local(parent, name):
-        if parent is None:
-            return None
-        for child in parent:
-            if local(child.tag) == name:
-                return child
-        return None
-
-    def find_all_by_local(parent, name):
-        return [el for el in parent.iter() if local(el.tag) == name]
-
-    try:
-        uploaded_file.seek(0)
-    except Exception:
-        pass
-
-    raw = uploaded_file.read()
-    if isinstance(raw, bytes):
-        try:
-            raw = raw.decode('utf-8')
-        except Exception:
-            raw = raw.decode('latin-1', errors='replace')
-
-    try:
-        root = ET.fromstring(raw)
-    except Exception as e:
-        try:
-            uploaded_file.seek(0)
-            root = ET.parse(uploaded_file).getroot()
-        except Exception as e2:
-            raise RuntimeError(f"Erro ao parsear XML: {e} / {e2}")
-
-    rows = []
-    inf_nodes = find_all_by_local(root, "infNFe")
-    if not inf_nodes:
-        inf_nodes = find_all_by_local(root, "infNFe")
-
-    for inf in inf_nodes:
-        ide = find_child_by_local(inf, "ide")
-        emit = find_child_by_local(inf, "emit")
-        dest = find_child_by_local(inf, "dest")
-
-        total = None
-        for el in inf.iter():
-            if local(el.tag) == "ICMSTot":
-                total = el
-                break
-
-        def text_from(parent, tagname):
-            if parent is None:
-                return None
-            ch = find_child_by_local(parent, tagname)
-            return ch.text.strip() if ch is not None and ch.text else None
-
-        invoice = {
-            "cNF": text_from(ide, "cNF"),
-            "nNF": text_from(ide, "nNF"),
-            "dhEmi": text_from(ide, "dhEmi"),
-            "emit_CNPJ": text_from(emit, "CNPJ"),
-            "emit_xNome": text_from(emit, "xNome"),
-            "dest_CNPJ": text_from(dest, "CNPJ"),
-            "dest_xNome": text_from(dest, "xNome"),
-            "vNF": text_from(total, "vNF"),
-        }
-
-        dets = [d for d in inf if local(d.tag) == "det"]
-        if not dets:
-            dets = [d for d in inf.iter() if local(d.tag) == "det"]
-
-        if not dets:
-            row = invoice.copy()
-            row.update({"nItem": None})
-            rows.append(row)
-            continue
-
-        for det in dets:
-            nItem = det.attrib.get("nItem")
-            prod = find_child_by_local(det, "prod")
-            if prod is None:
-                row = invoice.copy()
-                row.update({"nItem": nItem})
-                rows.append(row)
-                continue
-
-            row = invoice.copy()
-            row.update({
-                "nItem": nItem,
-                "prod_cProd": text_from(prod, "cProd"),
-                "prod_xProd": text_from(prod, "xProd"),
-                "prod_NCM": text_from(prod, "NCM"),
-                "prod_qCom": text_from(prod, "qCom"),
-                "prod_uCom": text_from(prod, "uCom"),
-                "prod_vUnCom": text_from(prod, "vUnCom"),
-                "prod_vProd": text_from(prod, "vProd"),
-            })
-            rows.append(row)
-
-    df = pd.DataFrame(rows)
-    df["source_file"] = getattr(uploaded_file, "name", None)
-    return df
 
 # Load environment variables
 load_dotenv()
@@ -131,11 +28,79 @@ def initialize_session_state():
         st.session_state.messages = [{"role": "assistant", "content": "Olá! Configure o LLM Gemini e carregue um ou mais arquivos XML para começar a explorar seus dados."}]
     if "agent_executor" not in st.session_state:
         st.session_state.agent_executor = None
+    if "agent_model_name" not in st.session_state:
+        st.session_state.agent_model_name = None
     if "dataframe" not in st.session_state:
         st.session_state.dataframe = None
+    if "dataset" not in st.session_state:
+        st.session_state.dataset = None
+    if "execution_context" not in st.session_state:
+        st.session_state.execution_context = None
+    if "history_manager" not in st.session_state:
+        st.session_state.history_manager = ChatHistoryManager()
 
 initialize_session_state()
 
+def sync_dataset(dataset: InvoiceDataset, uploaded_files, directories):
+    """
+    Loads the current upload set into `dataset`, parsing only files it does
+    not hold yet, with a progress bar and per-file errors shown as they come.
+    """
+    total_files = count_sources(uploaded_files or [], directories)
+    progress_bar = st.progress(0.0, text=f"Lendo {total_files} arquivo(s) XML...")
+    error_box = st.container()
+
+    # Report progress and per-file errors as the worker pool finishes files
+    def report_progress(done_count, name, error):
+        progress_bar.progress(min(1.0, done_count / max(total_files, 1)), text=f"{done_count}/{total_files} arquivo(s) processado(s)")
+        if error is not None:
+            error_box.error(f"{name}: {error}")
+
+    sync_result = dataset.sync(iter_sources(uploaded_files or [], directories), on_progress=report_progress, cache=ParseCache())
+    progress_bar.empty()
+
+    result = sync_result.ingest
+    if sync_result.restored:
+        st.info(f"{sync_result.restored} arquivo(s) restaurado(s) do armazenamento colunar, sem novo processamento.")
+    if result is not None and result.cache_hits:
+        st.info(f"{result.cache_hits} arquivo(s) reaproveitado(s) do cache, sem novo processamento do XML.")
+
+    if sync_result.duplicates_dropped:
+        st.info(f"{sync_result.duplicates_dropped} item(ns) de NF-e duplicado(s) (mesma chave de acesso e nItem) foram descartado(s).")
+
+    # Report errors if any; good files are still loaded
+    if result is not None and result.errors:
+        st.warning(f"{len(result.errors)} de {result.file_count} arquivo(s) XML não puderam ser lidos e foram ignorados.")
+    return sync_result
+
+
+def render_answer(answer: str):
+    """
+    Writes an answer, showing each `[CHART:id]` tag as the chart it refers
+    to in the session's chart store. Tags of the former `[CHART_PATH:file]`
+    protocol are still read from disk.
+    """
+    context = st.session_state.execution_context
+    position = 0
+    for match in CHART_TAG_PATTERN.finditer(answer):
+        if answer[position:match.start()].strip():
+            st.write(answer[position:match.start()])
+        position = match.end()
+        kind, reference = match.groups()
+        if kind == "CHART_PATH":
+            image = reference
+        else:
+            image = context.charts.get(reference) if context is not None else None
+        if image is None:
+            st.caption(f"(O gráfico `{reference}` não está mais disponível.)")
+            continue
+        try:
+            st.image(image, caption="Gráfico gerado pela IA.", use_column_width=True)
+        except Exception as img_e:
+            st.error(f"Erro ao exibir o gráfico `{reference}`: {img_e}")
+    if answer[position:].strip():
+        st.write(answer[position:])
+
 
 # --- Application Layout (Sidebar and Chat) ---
 
@@ -153,78 +118,105 @@ with st.sidebar:
     model_name = st.text_input("Nome do Modelo:", value=model_name_default, placeholder=model_name_default)
 
     st.header("📂 Carregamento de Arquivos XML")
-    # Accept multiple XML files only
-    uploaded_files = st.file_uploader("Escolha um ou mais arquivos XML", type=["xml"], accept_multiple_files=True)
+    # Accept XML files and ZIP archives of XML files
+    uploaded_files = st.file_uploader("Escolha um ou mais arquivos XML ou ZIP", type=["xml", "zip"], accept_multiple_files=True)
+
+    # Optional directory on the server with XML/ZIP files (read recursively)
+    source_directory = st.text_input("Ou informe um diretório no servidor (opcional):", value="")
+
+    # Render each reasoning step and the final answer while the agent works
+    stream_agent_steps = st.checkbox("Mostrar raciocínio em tempo real", value=True)
 
-    # Button to create/update the agent
-    if st.button("Inicializar Agente"):
+    # Repeated questions over the same data are answered from the answer cache unless bypassed
+    use_answer_cache = st.checkbox("Reutilizar respostas em cache", value=True)
+    revalidate_cached_answers = st.checkbox("Reaproveitar respostas de outras versões dos dados após revalidá-las (reexecuta o código sem o LLM)", value=False, disabled=not use_answer_cache)
+
+    # Arrow-backed dtypes shrink memory further at some cost in library compatibility
+    use_arrow_dtypes = st.checkbox("Usar tipos Arrow (menor uso de memória)", value=False)
+
+    directories = [source_directory.strip()] if source_directory.strip() else []
+    col_init, col_update = st.columns(2)
+
+    # Button to create the agent from scratch
+    if col_init.button("Inicializar Agente"):
         if not api_key:
             st.warning("Por favor, insira sua chave de API do Gemini.")
         elif not model_name:
             st.warning(f"Por favor, insira o nome do modelo. Sugestão: `{model_name_default}`")
-        elif not uploaded_files:
+        elif not uploaded_files and not directories:
             st.warning("Por favor, carregue pelo menos um arquivo XML.")
+        elif directories and not os.path.isdir(directories[0]):
+            st.warning(f"O diretório `{directories[0]}` não existe no servidor.")
         else:
             with st.spinner("Processando arquivos XML e configurando agente..."):
-                dataframes = []
-                errors = []
-
-                # Loop through uploaded files and parse each one
-                for uploaded_file in uploaded_files:
-                    try:
-                        try:
-                            uploaded_file.seek(0)
-                        except Exception:
-                            pass
-
-                        parsed_df = parse_nfe_xml(uploaded_file)
-                        if parsed_df is None or parsed_df.empty:
-                            errors.append(f"{getattr(uploaded_file, 'name', str(uploaded_file))}: nenhum registro extraído do XML.")
-                        else:
-                            dataframes.append(parsed_df)
-                    except Exception as e_file:
-                        errors.append(f"{getattr(uploaded_file, 'name', str(uploaded_file))}: {e_file}")
-
-                # Report errors if any
-                if errors:
-                    st.error("Ocorreram erros ao ler os seguintes arquivos XML:")
-                    for err in errors:
-                        st.error(err)
-                    st.session_state.dataframe = None
-                    st.session_state.agent_executor = None
+                dataset = InvoiceDataset(arrow_dtypes=use_arrow_dtypes, store=InvoiceStore())
+                sync_result = sync_dataset(dataset, uploaded_files, directories)
 
                 # No dataframes produced
-                elif not dataframes:
+                if dataset.dataframe is None:
                     st.error("Nenhum DataFrame foi gerado a partir dos arquivos XML fornecidos.")
                     st.session_state.dataframe = None
+                    st.session_state.dataset = None
                     st.session_state.agent_executor = None
 
-                # All good: concat and create agent
+                # Create agent over the files that were parsed
                 else:
                     try:
-                        dataframe = pd.concat(dataframes, ignore_index=True, sort=False)
+                        dataframe = dataset.dataframe
                         st.session_state.dataframe = dataframe
+                        st.session_state.dataset = dataset
 
-                        executor = create_data_analysis_workflow(dataframe, api_key, model_name)
+                        # Each browser session gets its own execution scope and output capture
+                        execution_context = ExecutionContext(dataframe, profile=dataset.profile, aggregates=dataset.aggregates,
+                                                             store_paths=dataset.store_paths)
+                        st.session_state.execution_context = execution_context
+                        executor = create_data_analysis_workflow(dataframe, api_key, model_name, context=execution_context)
                         if isinstance(executor, Exception):
                             st.error(f"Erro ao criar o agente: {executor}")
                             st.session_state.agent_executor = None
                         else:
                             st.session_state.agent_executor = executor
-                            file_count = len(uploaded_files)
+                            # The sidebar field may change later; answers come from this model
+                            st.session_state.agent_model_name = model_name
+                            # Older turns are summarized with the same (cached) Gemini client
+                            st.session_state.history_manager = ChatHistoryManager(llm=get_llm(api_key, model_name))
+                            file_count = len(dataset.files)
                             st.session_state.messages = [{"role": "assistant", "content": f"Agente configurado com `{model_name}`. {file_count} arquivo(s) carregado(s). Como posso ajudar na sua análise de dados?"}]
                             st.success("Agente inicializado com sucesso!")
                             st.dataframe(dataframe.head())
                     except Exception as e:
                         st.error(f"Erro ao processar os dados: {e}")
                         st.session_state.dataframe = None
+                        st.session_state.dataset = None
                         st.session_state.agent_executor = None
                         st.stop()
 
+    # Button to add new files (and drop removed ones) without rebuilding the agent or the chat
+    if col_update.button("Atualizar Dados", disabled=st.session_state.agent_executor is None):
+        dataset = st.session_state.dataset
+        if dataset.arrow_dtypes != use_arrow_dtypes:
+            st.warning("A opção de tipos Arrow mudou; clique em \"Inicializar Agente\" para recarregar todos os arquivos.")
+        elif directories and not os.path.isdir(directories[0]):
+            st.warning(f"O diretório `{directories[0]}` não existe no servidor.")
+        else:
+            with st.spinner("Atualizando dados..."):
+                sync_result = sync_dataset(dataset, uploaded_files, directories)
+            if dataset.dataframe is None:
+                st.warning("Nenhum arquivo restou carregado; carregue arquivos XML para continuar a análise.")
+            elif sync_result.added or sync_result.removed:
+                st.session_state.dataframe = dataset.dataframe
+                st.session_state.execution_context.update_dataframe(
+                    dataset.dataframe, dataset.profile, dataset.aggregates, dataset.store_paths)
+                update_message = f"Dados atualizados: {len(sync_result.added)} arquivo(s) adicionado(s), {len(sync_result.removed)} removido(s). Total de {len(dataset.files)} arquivo(s) e {len(dataset.dataframe)} linha(s)."
+                st.session_state.messages.append({"role": "assistant", "content": update_message})
+                st.success(update_message)
+            else:
+                st.info("Nenhuma alteração nos arquivos carregados.")
+
 # Display chat history
 for message in st.session_state.messages:
     with st.chat_message(message["role"]):
-        st.write(message["content"])
+        render_answer(message["content"])
 
 # --- Chat Logic ---
 
@@ -240,81 +232,87 @@ if prompt := st.chat_input("Qual é a sua pergunta sobre os dados?"):
 
     # Invoke the agent
     with st.chat_message("assistant"):
-        with st.spinner("Analisando dados..."):
-            # Prepare agent input, including chat history
-            agent_input = {
-                "input": prompt,
-                "chat_history": [msg for msg in st.session_state.messages if msg['role'] != 'assistant' or 'steps:' not in msg['content']]
-            }
+        # Prepare agent input, including the bounded chat history (without the current question)
+        agent_input = {
+            "input": prompt,
+            "chat_history": st.session_state.history_manager.render(st.session_state.messages[:-1])
+        }
 
-            try:
-                # Invoke the agent
-                response = st.session_state.agent_executor.invoke(agent_input)
+        # Same data, model, (normalized) question and conversation: reuse the previous answer
+        agent_model_name = st.session_state.agent_model_name
+        cache_key = answer_key(st.session_state.dataset.fingerprint, agent_model_name, prompt, agent_input["chat_history"])
+        variant_key = question_key(agent_model_name, prompt, agent_input["chat_history"])
+        cached_answer = get_answer_cache().get(cache_key) if use_answer_cache else None
+        revalidated = False
+        if cached_answer is None and use_answer_cache and revalidate_cached_answers:
+            # The same question answered on other data: reuse it if its code reproduces every observation here
+            candidate = get_answer_cache().latest(variant_key)
+            if candidate is not None:
+                with st.spinner("Revalidando resposta em cache com os dados atuais..."):
+                    if revalidate(candidate, st.session_state.agent_executor.tools):
+                        cached_answer = get_answer_cache().put(cache_key, prompt, candidate.as_response(), question_key=variant_key)
+                        revalidated = cached_answer is not None
+
+        # Per-step timings, tokens and memory of a fresh run, also appended to the JSONL trace file
+        tracer = AgentTracer(
+            session_id=st.session_state.execution_context.session_id,
+            model_name=agent_model_name,
+            question=prompt,
+            dataset_fingerprint=st.session_state.dataset.fingerprint,
+        )
 
-                # Display agent reasoning steps
-                with st.expander("Ver Fluxo de Raciocínio do Agente", expanded=False):
-                    intermediate_steps = response.get("intermediate_steps", [])
-                    if not intermediate_steps:
-                        st.write("Nenhum passo intermediário executado (ex: resposta direta fornecida).")
-                    else:
-                        for i, step in enumerate(intermediate_steps):
-                            st.subheader(f"🔄 Ciclo {i+1}")
-                            action, observation = step
-
-                            # 1. Agent Thought
-                            st.markdown("##### 1. Pensamento")
-                            st.text(action.log.strip())
-
-                            # 2. Action Executed
-                            st.markdown("##### 2. Ação")
-                            st.markdown(f"**Ferramenta:** `{action.tool}`")
-                            st.markdown("**Entrada da Ação (Código Executado):**")
-                            st.code(action.tool_input, language="python")
-
-                            # 3. Observation (Result of Action)
-                            st.markdown("##### 3. Observação")
-                            st.markdown(observation)
-                            
-                            if i < len(intermediate_steps) - 1:
-                                st.divider()
-
-                # Display final response
-                final_answer = response.get("output", "Desculpe, não foi possível gerar uma resposta.")         
-
-                # Handle iteration limit gracefully
-                if "Agent stopped due to iteration limit" in final_answer:
-                    st.warning("A análise se tornou muito complexa e atingiu o limite de iterações. Aqui está o último passo conhecido:")
-                    intermediate_steps = response.get("intermediate_steps", [])
-                    if intermediate_steps:
-                        last_action, last_observation = intermediate_steps[-1]
-                        st.markdown("##### Pensamento")
-                        st.text(last_action.log.strip())
-                        st.markdown("##### Observação")
-                        st.markdown(last_observation)
-                    st.session_state.messages.append({"role": "assistant", "content": "A análise não foi concluída dentro do limite de tempo."})
+        try:
+            if cached_answer is not None:
+                response = cached_answer.as_response()
+                # Bring the answer's charts back into the session under their original ids
+                for chart_id, png in cached_answer.charts.items():
+                    st.session_state.execution_context.charts.put(chart_id, png)
+                if revalidated:
+                    st.caption("♻️ Resposta reaproveitada do cache e revalidada com os dados atuais.")
                 else:
-                    # Logic to robustly extract and display charts
-                    chart_tag = "[CHART_PATH:"
-                    if chart_tag in final_answer:
-                        parts = final_answer.split(chart_tag)
-                        if parts[0].strip():
-                            st.write(parts[0])
-                        for part in parts[1:]:
-                            if ']' in part:
-                                image_path, text_after = part.split(']', 1)
-                                image_path = image_path.strip()
-                                try:
-                                    st.image(image_path, caption="Gráfico gerado pela IA.", use_column_width=True)
-                                except Exception as img_e:
-                                    st.error(f"Erro ao exibir o gráfico em '{image_path}': {img_e}")
-                                if text_after.strip():
-                                    st.write(text_after)
-                            else:
-                                st.write(f"{chart_tag}{part}")
-                    else:
-                        st.write(final_answer)
-                    st.session_state.messages.append({"role": "assistant", "content": final_answer})
-            except Exception as e:
-                st.error("Ocorreu um erro durante a execução do agente. Veja os detalhes abaixo:")
-                st.exception(e)
-                st.session_state.messages.append({"role": "assistant", "content": f"Erro de execução: {e}"})
\ No newline at end of file
+                    st.caption("♻️ Resposta reaproveitada do cache (mesmos dados, modelo, pergunta e conversa).")
+                render_agent_steps(st.expander("Ver Fluxo de Raciocínio do Agente", expanded=False), response["intermediate_steps"])
+            elif stream_agent_steps:
+                # Stream Thought/Action/Observation and the final answer's tokens as they happen
+                steps_container = st.expander("Ver Fluxo de Raciocínio do Agente", expanded=True)
+                answer_placeholder = st.empty()
+                stream_handler = StreamlitAgentCallbackHandler(steps_container, answer_placeholder, tracer)
+                response = st.session_state.agent_executor.invoke(agent_input, config={"callbacks": [tracer, stream_handler]})
+                answer_placeholder.empty()
+                if stream_handler.step_count == 0:
+                    steps_container.write("Nenhum passo intermediário executado (ex: resposta direta fornecida).")
+            else:
+                with st.spinner("Analisando dados..."):
+                    # Invoke the agent
+                    response = st.session_state.agent_executor.invoke(agent_input, config={"callbacks": [tracer]})
+
+                # Display agent reasoning steps
+                render_agent_steps(st.expander("Ver Fluxo de Raciocínio do Agente", expanded=False), response.get("intermediate_steps", []), tracer.trace)
+
+            if cached_answer is None:
+                st.caption(format_run_summary(tracer.trace))
+                # A bypassed question still refreshes its entry
+                charts = st.session_state.execution_context.charts.collect(response.get("output", ""))
+                get_answer_cache().put(cache_key, prompt, response, charts, question_key=variant_key)
+
+            # Display final response
+            final_answer = response.get("output", "Desculpe, não foi possível gerar uma resposta.")         
+
+            # Handle iteration limit gracefully
+            if "Agent stopped due to iteration limit" in final_answer:
+                st.warning("A análise se tornou muito complexa e atingiu o limite de iterações. Aqui está o último passo conhecido:")
+                intermediate_steps = response.get("intermediate_steps", [])
+                if intermediate_steps:
+                    last_action, last_observation = intermediate_steps[-1]
+                    st.markdown("##### Pensamento")
+                    st.text(last_action.log.strip())
+                    st.markdown("##### Observação")
+                    st.markdown(last_observation)
+                st.session_state.messages.append({"role": "assistant", "content": "A análise não foi concluída dentro do limite de tempo."})
+            else:
+                render_answer(final_answer)
+                st.session_state.messages.append({"role": "assistant", "content": final_answer})
+        except Exception as e:
+            st.error("Ocorreu um erro durante a execução do agente. Veja os detalhes abaixo:")
+            st.exception(e)
+            st.session_state.messages.append({"role": "assistant", "content": f"Erro de execução: {e}"})
\ No newline at end of file
@@ -0,0 +1,278 @@
+# dataset.py
+
+# Import necessary libraries and modules
+import hashlib
+import weakref
+from dataclasses import dataclass, field, replace
+from typing import Iterable, List, Optional
+
+import pandas as pd
+
+from aggregate_index import AggregateIndex
+from ingestion import IngestResult, XmlSource, ingest_sources
+from dataset_profile import build_dataset_profile
+from invoice_store import InvoiceStore
+from nfe_parser import concat_nfe_frames
+from parse_cache import content_key, file_content_key
+
+
+@dataclass
+class SyncResult:
+    """Summary of an incremental sync: which files were added, removed or kept."""
+    added: List[str] = field(default_factory=list)
+    removed: List[str] = field(default_factory=list)
+    unchanged: int = 0
+    restored: int = 0
+    duplicates_dropped: int = 0
+    ingest: Optional[IngestResult] = None
+
+
+def _release_store_files(store: InvoiceStore, store_files: dict) -> None:
+    store.release(list(store_files))
+
+
+def _empty_index() -> pd.Series:
+    return pd.Series([], index=pd.Index([], dtype="uint64"), dtype=object)
+
+
+class InvoiceDataset:
+    """
+    The typed NF-e rows loaded in a session, plus the content key of every
+    file that contributed to them. `sync` diffs a new upload set against
+    what is already loaded and only parses the difference.
+
+    Rows are deduplicated on (chNFe, nItem) through a hash index kept at
+    ingest, mapping a 64-bit hash of the key to the file that owns it: the
+    first file to deliver an item owns it and later copies (the same NF-e
+    bare and inside an nfeProc, or in two uploads) are rejected.
+    When an owner is removed, the files it shadowed are re-ingested so their
+    copies take over.
+
+    With a store, the first sync of a fresh dataset starts from the closest
+    version saved in the store (see `InvoiceStore.find_manifest`): its rows
+    are read back from Parquet and only the difference is parsed, so a server
+    restart does not re-parse every source.
+    """
+
+    def __init__(self, arrow_dtypes: bool = False, store: Optional[InvoiceStore] = None):
+        self.arrow_dtypes = arrow_dtypes
+        self.store = store
+        self.dataframe: Optional[pd.DataFrame] = None
+        self.files = {}                  # source name -> content key
+        self.index = _empty_index()      # hash of (chNFe, nItem) -> owning source name
+        self.shadowed = {}               # source name -> owners that shadowed some of its rows
+        self.aggregates = AggregateIndex()  # pre-aggregated cubes, maintained alongside the rows
+        self.store_files = {}            # Parquet file in `store` (retained) -> sources with rows in it
+        self._profile = None
+        if store is not None:
+            # Sessions end without notice; release the files once the dataset is collected
+            weakref.finalize(self, _release_store_files, store, self.store_files)
+
+    @property
+    def profile(self) -> str:
+        """Schema and statistics summary of the rows, computed once per dataset version."""
+        if self._profile is None:
+            self._profile = build_dataset_profile(self.dataframe)
+        return self._profile
+
+    @property
+    def fingerprint(self) -> str:
+        """
+        Content fingerprint of the loaded rows: a hash of every loaded file's
+        name and content key, so it changes exactly when `sync` changes the data.
+        """
+        digest = hashlib.sha256(b"arrow" if self.arrow_dtypes else b"numpy")
+        for name, key in sorted(self.files.items()):
+            digest.update(f"\0{name}\0{key}".encode("utf-8"))
+        return digest.hexdigest()
+
+    def _forget(self, names: set) -> None:
+        if names:
+            self.index = self.index[~self.index.isin(names)]
+        for name in names:
+            self.shadowed.pop(name, None)
+            self.files.pop(name, None)
+
+    def _deduplicate(self, df: pd.DataFrame) -> tuple:
+        """
+        Checks the new rows against the index in one vectorized pass and
+        registers the keys they are the first to deliver. Rows without an
+        access key are kept as is.
+
+        Returns:
+            (deduplicated dataframe, number of rows dropped)
+        """
+        keyed = df["chNFe"].notna().to_numpy()
+        hashes = pd.util.hash_pandas_object(df.loc[keyed, ["chNFe", "nItem"]], index=False, categorize=False).to_numpy()
+        sources = df.loc[keyed, "source_file"].astype(object).to_numpy()
+
+        positions = self.index.index.get_indexer(hashes)
+        fresh = (positions < 0) & ~pd.Index(hashes).duplicated(keep="first")
+        additions = pd.Series(sources[fresh], index=pd.Index(hashes[fresh]), dtype=object)
+
+        rejected = ~fresh
+        dropped = int(rejected.sum())
+        if dropped:
+            # Owner of each rejected copy: an earlier file, or the first copy in this batch
+            owners = pd.concat([self.index, additions]).reindex(hashes[rejected]).to_numpy()
+            pairs = pd.DataFrame({"source": sources[rejected], "owner": owners})
+            pairs = pairs[pairs["source"] != pairs["owner"]].drop_duplicates()
+            for source, owner in zip(pairs["source"], pairs["owner"]):
+                self.shadowed.setdefault(source, set()).add(owner)
+            keep = keyed.copy()
+            keep[keyed] = fresh
+            df = df[keep | ~keyed]
+        self.index = pd.concat([self.index, additions]) if len(self.index) else additions
+        return df, dropped
+
+    def _restore(self, manifest: dict) -> List[str]:
+        """Loads a dataset version saved in the store; returns the names of its sources."""
+        rows = self.store.read(sorted(manifest["files"]), self.arrow_dtypes)
+        self.files = dict(manifest["sources"])
+        self.shadowed = {name: set(owners) for name, owners in manifest["shadowed"].items()}
+        self._deduplicate(rows)
+        self.aggregates.add(rows)
+        self.store.retain(manifest["files"])
+        self.store_files.update(manifest["files"])
+        self.dataframe = rows
+        return list(self.files)
+
+    def _drop_from_store(self, names: set) -> None:
+        """Replaces the files holding rows of `names` with copies holding only the other sources' rows."""
+        for path, sources in list(self.store_files.items()):
+            if not sources & names:
+                continue
+            del self.store_files[path]
+            remaining = sources - names
+            new_path = self.store.rewrite(path, sources & names) if remaining else None
+            if new_path is not None:
+                if new_path not in self.store_files:
+                    self.store.retain([new_path])
+                self.store_files[new_path] = self.store_files.get(new_path, set()) | remaining
+            self.store.release([path])
+
+    def _write_store(self, rows: Optional[pd.DataFrame]) -> None:
+        """
+        Persists newly added rows to the columnar store (one file per month),
+        merges the dataset's small files, evicts and saves the dataset's manifest.
+        """
+        if rows is not None and not rows.empty:
+            for path, sources in self.store.write(rows, self.files, self.arrow_dtypes).items():
+                if path not in self.store_files:
+                    self.store.retain([path])
+                self.store_files[path] = self.store_files.get(path, set()) | sources
+        compacted = self.store.compact(self.store_files)
+        self.store.retain(path for path in compacted if path not in self.store_files)
+        self.store.release(path for path in self.store_files if path not in compacted)
+        self.store_files.clear()
+        self.store_files.update(compacted)
+        self.store.evict()
+        self.store.save_manifest(self.fingerprint, self.arrow_dtypes, self.files, self.shadowed, self.store_files)
+
+    @property
+    def store_paths(self) -> List[str]:
+        """Every store file holding this dataset's rows (what the SQL tool queries)."""
+        return list(self.store_files)
+
+    def sync(self, sources: Iterable[XmlSource], remove_missing: bool = True, **ingest_kwargs) -> SyncResult:
+        """
+        Brings the dataset in line with `sources`.
+
+        New files (or files whose content changed) are parsed through
+        `ingest_sources`, deduplicated and appended; files no longer present
+        are dropped when `remove_missing` is set; unchanged files are not touched.
+        A fresh dataset with a store first restores the closest version saved
+        there, so only the files that version lacks are parsed.
+
+        Args:
+            sources: The full current source set (see `ingestion.iter_sources`).
+            remove_missing: Drop rows of previously loaded files absent from `sources`.
+            **ingest_kwargs: Forwarded to `ingest_sources` (max_workers, cache, on_progress...).
+
+        Returns:
+            A SyncResult; `ingest` is None when nothing new had to be parsed.
+        """
+        result = SyncResult()
+        current = {}
+        by_name = {}
+        unreadable = []
+        for source in sources:
+            if source.error is not None:
+                unreadable.append(source)
+                continue
+            # Files on disk are hashed in chunks and stay paths; workers read them when parsing
+            in_memory = isinstance(source.payload, bytes)
+            try:
+                key = content_key(source.payload) if in_memory else file_content_key(source.payload)
+            except OSError as e:
+                # Reported per file by the ingestion, like any other unreadable source
+                unreadable.append(replace(source, error=str(e)))
+                continue
+            current[source.name] = key
+            # Unchanged in-memory payloads are only needed again if they may have to be resynced
+            if not in_memory or self.files.get(source.name) != key or source.name in self.shadowed:
+                by_name[source.name] = replace(source, key=key)
+
+        restored = set()
+        if self.store is not None and self.dataframe is None and not self.files and current:
+            manifest = self.store.find_manifest(current, self.arrow_dtypes)
+            try:
+                restored.update(self._restore(manifest) if manifest is not None else ())
+            except OSError:
+                pass  # A file was evicted since the lookup; everything is parsed instead
+
+        stale = {name for name, key in self.files.items()
+                 if (name not in current and remove_missing) or (name in current and current[name] != key)}
+        # Files whose duplicates were rejected in favour of a stale owner must be reloaded
+        resync = {name for name, owners in self.shadowed.items()
+                  if name not in stale and name in current and owners & stale}
+        dropped_names = stale | resync
+
+        frames = []
+        if self.dataframe is not None:
+            kept = self.dataframe
+            if dropped_names:
+                kept = kept[~kept["source_file"].isin(dropped_names)]
+                if isinstance(kept["source_file"].dtype, pd.CategoricalDtype):
+                    kept = kept.assign(source_file=kept["source_file"].cat.remove_unused_categories())
+            frames.append(kept)
+        self.aggregates.remove(dropped_names)
+        self._forget(dropped_names)
+        if self.store is not None and dropped_names:
+            self._drop_from_store(dropped_names)
+        for name in dropped_names:
+            if name not in current and name not in restored:
+                result.removed.append(name)
+
+        pending = unreadable[:]
+        for name, key in current.items():
+            if self.files.get(name) == key:
+                if name in restored:
+                    result.added.append(name)
+                    result.restored += 1
+                else:
+                    result.unchanged += 1
+            else:
+                pending.append(by_name[name])
+
+        new_rows = None
+        if pending:
+            result.ingest = ingest_sources(pending, arrow_dtypes=self.arrow_dtypes, **ingest_kwargs)
+            failed = set(result.ingest.failed)
+            for source in pending:
+                if source.error is None and source.name not in failed:
+                    self.files[source.name] = current[source.name]
+                    if source.name not in resync or source.name in restored:
+                        result.added.append(source.name)
+            if result.ingest.dataframe is not None:
+                new_rows, result.duplicates_dropped = self._deduplicate(result.ingest.dataframe)
+                frames.append(new_rows)
+                self.aggregates.add(new_rows)
+
+        if self.store is not None and (restored or dropped_names or new_rows is not None):
+            self._write_store(new_rows)
+        if restored or dropped_names or new_rows is not None:
+            combined = concat_nfe_frames(frames)
+            self.dataframe = combined if not combined.empty else None
+            self._profile = None
+        return result
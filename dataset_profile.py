@@ -0,0 +1,111 @@
+# dataset_profile.py
+
+# Import necessary libraries and modules
+import pandas as pd
+
+# How many entries the "top" rankings list
+TOP_N = 5
+
+# Numeric columns whose row sum means nothing: identifiers, unit prices, and
+# invoice-level values repeated on every item row of the invoice
+_NO_SUM_COLUMNS = {"nItem", "prod_vUnCom", "vNF"}
+
+# Invoice-level values, summed once per invoice instead
+_PER_INVOICE_COLUMNS = {"vNF"}
+
+# Identify an invoice whose access key is missing
+_FALLBACK_INVOICE_KEY = ("source_file", "emit_CNPJ", "nNF")
+
+
+def _is_numeric(series: pd.Series) -> bool:
+    return pd.api.types.is_numeric_dtype(series.dtype) and not pd.api.types.is_bool_dtype(series.dtype)
+
+
+def _is_datetime(series: pd.Series) -> bool:
+    if isinstance(series.dtype, pd.ArrowDtype):
+        return series.dtype.kind == "M"
+    return pd.api.types.is_datetime64_any_dtype(series.dtype)
+
+
+def _format_number(value) -> str:
+    try:
+        return f"{float(value):,.2f}"
+    except (TypeError, ValueError):
+        return str(value)
+
+
+def _one_row_per_invoice(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    One row of each invoice: the first row of every access key, and rows
+    without a key deduplicated on file, emitter and number instead, so
+    invoices missing `chNFe` are not merged into one.
+    """
+    keyed = df["chNFe"].notna()
+    fallback = [column for column in _FALLBACK_INVOICE_KEY if column in df.columns]
+    unkeyed = df.loc[~keyed]
+    if fallback:
+        unkeyed = unkeyed.drop_duplicates(fallback)
+    return pd.concat([df.loc[keyed].drop_duplicates("chNFe"), unkeyed])
+
+
+def _top_by_value(df: pd.DataFrame, key: str, label: str = None) -> list:
+    """Top keys by summed `prod_vProd` (item value), optionally shown with a label column."""
+    if key not in df.columns or "prod_vProd" not in df.columns:
+        return []
+    group_cols = [key] + ([label] if label and label in df.columns else [])
+    totals = (
+        df.groupby(group_cols, observed=True, dropna=True)["prod_vProd"]
+        .sum()
+        .sort_values(ascending=False)
+        .head(TOP_N)
+    )
+    lines = []
+    for index, value in totals.items():
+        name = " / ".join(str(part) for part in index) if isinstance(index, tuple) else str(index)
+        lines.append(f"  - {name}: {_format_number(value)}")
+    return lines
+
+
+def build_dataset_profile(df: pd.DataFrame) -> str:
+    """
+    Computes a compact schema and statistics summary of the invoice rows:
+    size, each column's dtype, nulls and cardinality, numeric ranges and
+    sums (invoice totals counted once per NF-e), the emission date span and
+    the top emitters and NCMs by item value.
+
+    The text goes into the agent prompt so the first ReAct steps no longer
+    have to be spent on `df.info()`, `df.head()` or `df.dtypes`.
+    """
+    if df is None:
+        return "Nenhum dado carregado."
+
+    lines = [f"Linhas: {len(df)} | Colunas: {len(df.columns)}"]
+    if "chNFe" in df.columns:
+        lines.append(f"NF-e distintas (chNFe): {df['chNFe'].nunique()}")
+    if "source_file" in df.columns:
+        lines.append(f"Arquivos de origem: {df['source_file'].nunique()}")
+
+    lines.append("Colunas (dtype | nulos | distintos | faixa):")
+    for column in df.columns:
+        series = df[column]
+        details = [str(series.dtype), f"nulos={int(series.isna().sum())}", f"distintos={series.nunique()}"]
+        if _is_numeric(series) and series.notna().any():
+            details.append(f"min={_format_number(series.min())} max={_format_number(series.max())}")
+            if column not in _NO_SUM_COLUMNS:
+                details.append(f"soma={_format_number(series.sum())}")
+            elif column in _PER_INVOICE_COLUMNS and "chNFe" in df.columns:
+                per_invoice = _one_row_per_invoice(df)[column]
+                details.append(f"soma por NF-e={_format_number(per_invoice.sum())}")
+        elif _is_datetime(series) and series.notna().any():
+            details.append(f"de {series.min()} até {series.max()}")
+        lines.append(f"  - {column}: " + " | ".join(details))
+
+    top_emitters = _top_by_value(df, "emit_CNPJ", "emit_xNome")
+    if top_emitters:
+        lines.append(f"Top {TOP_N} emitentes por valor dos itens (prod_vProd):")
+        lines.extend(top_emitters)
+    top_ncms = _top_by_value(df, "prod_NCM")
+    if top_ncms:
+        lines.append(f"Top {TOP_N} NCMs por valor dos itens (prod_vProd):")
+        lines.extend(top_ncms)
+    return "\n".join(lines)
@@ -0,0 +1,340 @@
+# ingestion.py
+
+# Import necessary libraries and modules
+import io
+import multiprocessing
+import os
+import zipfile
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from contextlib import ExitStack
+from dataclasses import dataclass, field, replace
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple, Union
+
+import pandas as pd
+
+from nfe_parser import apply_nfe_schema, parse_nfe_xml
+from parse_cache import ParseCache, content_key, file_content_key
+
+# Number of files sent to a worker per task; amortizes IPC for small invoices
+DEFAULT_BATCH_SIZE = 32
+
+# Files to parse per pool worker; below this, starting a worker costs more than it saves
+MIN_FILES_PER_WORKER = 256
+
+
+@dataclass
+class XmlSource:
+    """
+    One XML document to ingest. `payload` is either the raw bytes (uploads,
+    archive members) or a filesystem path the worker opens by itself.
+    `error` marks sources that could not even be read (e.g. a corrupt archive).
+    `key` is the content key when already known, so cache hits skip the read.
+    """
+    name: str
+    payload: Union[bytes, str]
+    error: Optional[str] = None
+    key: Optional[str] = None
+
+
+@dataclass
+class IngestResult:
+    """Outcome of an ingestion run: the combined rows plus per-file errors."""
+    dataframe: Optional[pd.DataFrame]
+    errors: List[str] = field(default_factory=list)
+    failed: List[str] = field(default_factory=list)
+    file_count: int = 0
+    loaded_count: int = 0
+    cache_hits: int = 0
+
+
+def _iter_zip(archive, label: str) -> Iterator[XmlSource]:
+    try:
+        zf = zipfile.ZipFile(archive)
+    except zipfile.BadZipFile as e:
+        yield XmlSource(label, b"", error=f"arquivo ZIP inválido ({e})")
+        return
+    with zf:
+        for info in zf.infolist():
+            if info.is_dir() or not info.filename.lower().endswith(".xml"):
+                continue
+            yield XmlSource(f"{label}/{info.filename}", zf.read(info))
+
+
+def iter_sources(uploads: Iterable = (), directories: Iterable[str] = ()) -> Iterator[XmlSource]:
+    """
+    Expands uploads and server-side directories into individual XML sources.
+    `.zip` uploads and archives found in directories are opened and each
+    `.xml` member becomes its own source; directories are walked recursively.
+
+    Args:
+        uploads: File-like objects with a `name` (e.g. Streamlit uploads).
+        directories: Paths readable by the server process.
+    """
+    for upload in uploads:
+        name = getattr(upload, "name", str(upload))
+        try:
+            upload.seek(0)
+        except Exception:
+            pass
+        data = upload.read()
+        if name.lower().endswith(".zip"):
+            yield from _iter_zip(io.BytesIO(data), name)
+        else:
+            yield XmlSource(name, data)
+
+    for directory in directories:
+        for root, dirs, files in os.walk(directory):
+            dirs.sort()
+            for filename in sorted(files):
+                path = os.path.join(root, filename)
+                lower = filename.lower()
+                if lower.endswith(".xml"):
+                    yield XmlSource(os.path.relpath(path, directory), path)
+                elif lower.endswith(".zip"):
+                    yield from _iter_zip(path, os.path.relpath(path, directory))
+
+
+def count_sources(uploads: Iterable = (), directories: Iterable[str] = ()) -> int:
+    """
+    Counts the XML documents `iter_sources` would yield, reading only archive
+    indexes. Used to size progress bars before ingestion starts.
+    """
+    def count_zip(archive) -> int:
+        try:
+            with zipfile.ZipFile(archive) as zf:
+                return sum(1 for info in zf.infolist() if not info.is_dir() and info.filename.lower().endswith(".xml"))
+        except zipfile.BadZipFile:
+            return 1
+
+    total = 0
+    for upload in uploads:
+        if getattr(upload, "name", "").lower().endswith(".zip"):
+            try:
+                upload.seek(0)
+            except Exception:
+                pass
+            total += count_zip(upload)
+        else:
+            total += 1
+    for directory in directories:
+        for root, _, files in os.walk(directory):
+            for filename in files:
+                lower = filename.lower()
+                if lower.endswith(".xml"):
+                    total += 1
+                elif lower.endswith(".zip"):
+                    total += count_zip(os.path.join(root, filename))
+    return total
+
+
+def _read_payload(source: XmlSource) -> bytes:
+    if isinstance(source.payload, bytes):
+        return source.payload
+    with open(source.payload, "rb") as handle:
+        return handle.read()
+
+
+def _lookup_cached(batch: List[XmlSource], cache: Optional[ParseCache]) -> Tuple[List[Optional[tuple]], List[XmlSource]]:
+    """
+    Parent side of a batch: resolves the sources the parse cache already
+    holds, with one lookup and without any worker process.
+
+    Returns:
+        (outcomes, sources): per source, its (name, dataframe, error, cached)
+        outcome when it was served from the cache or could not be hashed,
+        else None; and the sources with their content keys filled in.
+    """
+    outcomes = [None] * len(batch)
+    resolved = list(batch)
+    if cache is None:
+        return outcomes, resolved
+    for position, source in enumerate(batch):
+        if source.error is not None or source.key is not None:
+            continue
+        try:
+            key = content_key(source.payload) if isinstance(source.payload, bytes) else file_content_key(source.payload)
+        except OSError as e:
+            outcomes[position] = (source.name, None, str(e), False)
+            continue
+        resolved[position] = replace(source, key=key)
+
+    try:
+        hits = cache.get_many(source.key for source in resolved if source.key is not None)
+    except Exception:
+        hits = {}                         # An unreadable cache only costs a re-parse
+    for position, source in enumerate(resolved):
+        df = hits.get(source.key) if outcomes[position] is None and source.error is None else None
+        if df is not None:
+            # The same bytes may arrive under another name; always report the current one
+            outcomes[position] = (source.name, df.assign(source_file=source.name), None, True)
+    return outcomes, resolved
+
+
+def _parse_batch(batch: List[XmlSource], cache: Optional[ParseCache] = None) -> List[tuple]:
+    """
+    Worker entry point: parses a batch of sources the cache did not hold and
+    reports each outcome as (name, dataframe, error, cached) so one bad file
+    never sinks the batch. The parsed documents are added to the cache
+    together, as one segment, keyed by the bytes actually parsed.
+    """
+    outcomes = []
+    parsed = {}                           # key -> dataframe parsed in this batch
+    for source in batch:
+        if source.error is not None:
+            outcomes.append((source.name, None, source.error, False))
+            continue
+        try:
+            data = _read_payload(source)
+            handle = io.BytesIO(data)
+            handle.name = source.name
+            df = parse_nfe_xml(handle)
+        except Exception as e:
+            outcomes.append((source.name, None, str(e), False))
+            continue
+        if df is None or df.empty:
+            outcomes.append((source.name, None, "nenhum registro extraído do XML.", False))
+            continue
+        if cache is not None:
+            parsed[content_key(data)] = df
+        outcomes.append((source.name, df.assign(source_file=source.name), None, False))
+
+    if cache is not None and parsed:
+        try:
+            cache.put_many(parsed)
+        except Exception:
+            pass  # A failed cache write must never fail the ingestion
+    return outcomes
+
+
+def _batched(sources: Iterable[XmlSource], size: int) -> Iterator[List[XmlSource]]:
+    batch = []
+    for source in sources:
+        batch.append(source)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _pool_context():
+    """
+    Start method of the parsing pool. Forking the threaded Streamlit server
+    can copy locks held by other threads into the children, so workers come
+    from a forkserver (pre-importing this module) or, where unavailable, spawn.
+    """
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("forkserver")
+        context.set_forkserver_preload([__name__])
+        return context
+    return multiprocessing.get_context("spawn")
+
+
+def ingest_sources(
+    sources: Iterable[XmlSource],
+    max_workers: Optional[int] = None,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    on_progress: Optional[Callable[[int, str, Optional[str]], None]] = None,
+    arrow_dtypes: bool = False,
+    cache: Optional[ParseCache] = None,
+) -> IngestResult:
+    """
+    Parses NF-e sources, concatenates the results and converts them to the
+    typed NF-e schema (see `apply_nfe_schema`).
+
+    Cache hits are resolved here, in the calling process. Only the files
+    that must really be parsed go to a process pool, and only when there are
+    enough of them: the pool gets one worker per `MIN_FILES_PER_WORKER`
+    files (up to `max_workers`), and smaller loads are parsed inline. At most
+    `2 * max_workers` batches are in flight, so archives and large
+    directories are never fully materialized in memory. Files that fail are
+    reported and skipped; every good file is kept.
+
+    Args:
+        sources: Iterable of XmlSource (see `iter_sources`).
+        max_workers: Largest pool size, capped at the CPU count (the default). Use 1 to always parse inline.
+        batch_size: Files per worker task.
+        on_progress: Called as `on_progress(done_count, name, error)` after each file.
+        arrow_dtypes: Use Arrow-backed dtypes when applying the NF-e schema.
+        cache: Optional ParseCache; known documents are loaded from it instead
+            of being parsed, and new ones are added. Evicted to size at the end.
+
+    Returns:
+        An IngestResult; `dataframe` is None when no file produced rows.
+    """
+    # Parsing is CPU-bound: more workers than CPUs only add start-up cost
+    max_workers = min(max_workers or os.cpu_count() or 1, os.cpu_count() or 1)
+    frames = {}
+    result = IngestResult(dataframe=None)
+
+    def collect(indexes, outcomes):
+        for index, (name, df, error, cached) in zip(indexes, outcomes):
+            result.file_count += 1
+            result.cache_hits += int(cached)
+            if error is None:
+                frames[index] = df
+                result.loaded_count += 1
+            else:
+                result.errors.append(f"{name}: {error}")
+                result.failed.append(name)
+            if on_progress is not None:
+                on_progress(result.file_count, name, error)
+
+    with ExitStack() as stack:
+        pool = None
+        pending = {}                      # future -> positions of its sources
+        misses = []                       # (position, source) still to be parsed
+
+        def drain(limit):
+            while len(pending) > limit:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    collect(pending.pop(future), future.result())
+
+        def dispatch(chunk):
+            indexes, batch = [index for index, _ in chunk], [source for _, source in chunk]
+            if pool is None:
+                collect(indexes, _parse_batch(batch, cache))
+            else:
+                pending[pool.submit(_parse_batch, batch, cache)] = indexes
+                drain(2 * pool_size - 1)
+
+        def start_pool(workers):
+            return stack.enter_context(ProcessPoolExecutor(max_workers=workers, mp_context=_pool_context()))
+
+        position = 0
+        for batch in _batched(sources, batch_size):
+            outcomes, resolved = _lookup_cached(batch, cache)
+            for offset, (outcome, source) in enumerate(zip(outcomes, resolved)):
+                if outcome is not None:
+                    collect([position + offset], [outcome])
+                else:
+                    misses.append((position + offset, source))
+            position += len(batch)
+            # Enough misses buffered to keep every worker busy: start the full pool and stream
+            if pool is None and max_workers > 1 and len(misses) >= max_workers * MIN_FILES_PER_WORKER:
+                pool_size = max_workers
+                pool = start_pool(pool_size)
+            if pool is not None or max_workers == 1:
+                while len(misses) >= batch_size:
+                    dispatch(misses[:batch_size])
+                    del misses[:batch_size]
+
+        if pool is None:
+            # The whole load is known now: size the pool by what is left to parse
+            pool_size = min(max_workers, len(misses) // MIN_FILES_PER_WORKER)
+            if pool_size > 1:
+                pool = start_pool(pool_size)
+        for start in range(0, len(misses), batch_size):
+            dispatch(misses[start:start + batch_size])
+        drain(0)
+
+    if cache is not None:
+        cache.evict()
+
+    if frames:
+        # Concatenate once, in source order, regardless of completion order
+        ordered = [frames[key] for key in sorted(frames)]
+        combined = pd.concat(ordered, ignore_index=True, sort=False)
+        result.dataframe = apply_nfe_schema(combined, arrow=arrow_dtypes)
+    return result
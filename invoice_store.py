@@ -0,0 +1,426 @@
+# invoice_store.py
+
+# Import necessary libraries and modules
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+from collections import Counter
+from typing import Dict, Iterable, Optional, Sequence, Set
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from nfe_parser import NFE_SCHEMA, apply_nfe_schema, emission_month
+
+try:
+    import duckdb
+except ImportError:  # The SQL tool is simply not offered without DuckDB
+    duckdb = None
+
+# Default location and size bound of the on-disk store (overridable via environment)
+DEFAULT_STORE_DIR = os.environ.get("NFE_STORE_DIR", ".nfe_store")
+DEFAULT_STORE_MAX_BYTES = int(os.environ.get("NFE_STORE_MAX_MB", "8192")) * 1024 * 1024
+
+# Resource limits of one SQL query (DuckDB spills to disk beyond the memory limit)
+SQL_MEMORY_MB = int(os.environ.get("SQL_MEMORY_MB", "1024"))
+SQL_TIMEOUT_S = float(os.environ.get("SQL_TIMEOUT_S", "60"))
+SQL_MAX_ROWS = 200
+
+# Partition value of rows without an emission date
+UNKNOWN_MONTH = "unknown"
+
+# Name of the view the agent's SQL runs against
+TABLE_NAME = "nfe"
+
+# A dataset's files in one month are merged once this many of them are under COMPACT_MAX_BYTES
+COMPACT_MIN_FILES = 4
+COMPACT_MAX_BYTES = 16 * 1024 * 1024
+
+# Dataset manifests kept for restarts, least recently used dropped first
+MANIFEST_DIR = "manifests"
+MAX_MANIFESTS = 64
+
+# Store files referenced by live datasets of this process (path -> number of references)
+_live_paths = Counter()
+_live_lock = threading.Lock()
+
+_READ_ONLY_STATEMENT = re.compile(r"^\s*(\(\s*)*(select|with|from|describe|summarize|show)\b", re.IGNORECASE)
+
+
+class InvoiceStore:
+    """
+    Persistent columnar copy of the invoice rows: Parquet files under
+    `directory`, Hive-partitioned by emission month (`month=YYYY-MM/`).
+
+    Each sync writes the rows it adds as one file per month, and a dataset's
+    small files in a month are merged as they accumulate, so the SQL tool
+    scans a handful of files however many sources were loaded. Files are
+    immutable and content-addressed: dropping sources writes a new file with
+    the remaining rows, and sessions building the same rows share the files.
+    Each session queries only the files of its own dataset (see
+    `InvoiceDataset.store_files`).
+
+    After every sync the dataset saves a manifest (its sources, their content
+    keys and its files), from which a fresh dataset is restored after a
+    server restart instead of re-parsing the sources (see `find_manifest`).
+
+    Datasets `retain` the files they use and `release` them when done, and
+    `evict` never removes a retained file, so one session's eviction cannot
+    pull files from under another live session of the same process.
+    Otherwise recency is tracked with file mtimes, as in the parse cache.
+    """
+
+    def __init__(self, directory: str = DEFAULT_STORE_DIR, max_bytes: int = DEFAULT_STORE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    @staticmethod
+    def _touch(path: str) -> None:
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def _write_file(self, path: str, data) -> None:
+        """Writes a DataFrame or Arrow table to `path` atomically, unless it is already there."""
+        if os.path.exists(path):
+            self._touch(path)
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        os.close(fd)
+        try:
+            if isinstance(data, pa.Table):
+                pq.write_table(data, tmp_path)
+            else:
+                data.to_parquet(tmp_path, index=False)
+            os.replace(tmp_path, path)
+        except Exception:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+
+    @staticmethod
+    def _plain_strings(rows: pd.DataFrame) -> pd.DataFrame:
+        """
+        Categorical columns as plain strings: Parquet would otherwise store
+        every category of the dataset in each file. `read` restores them.
+        """
+        plain = {}
+        for column, dtype in rows.dtypes.items():
+            if isinstance(dtype, pd.CategoricalDtype):
+                plain[column] = "string"
+            elif isinstance(dtype, pd.ArrowDtype) and pa.types.is_dictionary(dtype.pyarrow_dtype):
+                plain[column] = pd.ArrowDtype(pa.string())
+        return rows.astype(plain) if plain else rows
+
+    def write(self, rows: pd.DataFrame, sources: Dict[str, str], arrow_dtypes: bool = False) -> Dict[str, Set[str]]:
+        """
+        Stores the rows one sync adds to a dataset, one Parquet file per
+        emission month. Files already present are only touched.
+
+        Args:
+            rows: The new rows, as kept by the dataset.
+            sources: Content key of each source the rows may come from.
+            arrow_dtypes: Whether the rows use Arrow-backed dtypes.
+
+        Returns:
+            The path of each file written, mapped to the sources with rows in it.
+        """
+        digest = hashlib.sha256(b"arrow" if arrow_dtypes else b"numpy")
+        # Files written under an older schema must not be reused
+        digest.update("\0".join(f"{column}:{dtype}" for column, dtype in rows.dtypes.items()).encode("utf-8"))
+        names = rows["source_file"].astype(object).unique()
+        for name in sorted(names):
+            digest.update(f"\0{name}\0{sources.get(name, '')}".encode("utf-8"))
+        if "chNFe" in rows.columns and "nItem" in rows.columns:
+            digest.update(pd.util.hash_pandas_object(rows[["chNFe", "nItem"]], index=False).values.tobytes())
+        file_id = digest.hexdigest()
+
+        months = emission_month(rows["dhEmi"]).fillna(UNKNOWN_MONTH) if "dhEmi" in rows.columns \
+            else pd.Series(UNKNOWN_MONTH, index=rows.index)
+        plain = self._plain_strings(rows)
+        written = {}
+        for month, part in plain.groupby(months.to_numpy(), sort=True):
+            path = os.path.join(self.directory, f"month={month}", f"{file_id}.parquet")
+            self._write_file(path, part)
+            written[path] = set(part["source_file"].dropna().unique())
+        return written
+
+    def rewrite(self, path: str, drop: Set[str]) -> Optional[str]:
+        """
+        Writes a copy of the file without the rows of the `drop` sources.
+
+        Returns:
+            The new file's path, or None when no rows remain.
+        """
+        table = pq.read_table(path, partitioning=None)
+        table = table.filter(pc.invert(pc.is_in(table["source_file"], value_set=pa.array(sorted(drop), pa.string()))))
+        if table.num_rows == 0:
+            return None
+        digest = hashlib.sha256(os.path.basename(path).encode("utf-8"))
+        for name in sorted(drop):
+            digest.update(f"\0{name}".encode("utf-8"))
+        new_path = os.path.join(os.path.dirname(path), f"{digest.hexdigest()}.parquet")
+        self._write_file(new_path, table)
+        return new_path
+
+    def compact(self, files: Dict[str, Set[str]]) -> Dict[str, Set[str]]:
+        """
+        Merges a dataset's small files within each month, once at least
+        `COMPACT_MIN_FILES` of them are under `COMPACT_MAX_BYTES`.
+
+        Args:
+            files: The dataset's files, mapped to the sources with rows in them.
+
+        Returns:
+            The dataset's files after compaction, in the same form.
+        """
+        small = {}
+        for path in files:
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                continue
+            if size < COMPACT_MAX_BYTES:
+                small.setdefault(os.path.dirname(path), []).append(path)
+
+        compacted = dict(files)
+        for directory, paths in small.items():
+            if len(paths) < COMPACT_MIN_FILES:
+                continue
+            paths.sort()
+            table = pa.concat_tables([pq.read_table(path, partitioning=None) for path in paths], promote_options="default")
+            digest = hashlib.sha256(b"merge")
+            for path in paths:
+                digest.update(f"\0{os.path.basename(path)}".encode("utf-8"))
+            merged = os.path.join(directory, f"{digest.hexdigest()}.parquet")
+            self._write_file(merged, table)
+            names = set()
+            for path in paths:
+                names |= compacted.pop(path)
+            compacted[merged] = names
+        return compacted
+
+    def read(self, paths: Sequence[str], arrow_dtypes: bool = False) -> pd.DataFrame:
+        """Loads files written by this store back into one typed DataFrame."""
+        table = pa.concat_tables([pq.read_table(path, partitioning=None) for path in paths], promote_options="default")
+        df = table.to_pandas(types_mapper=pd.ArrowDtype) if arrow_dtypes else table.to_pandas()
+        categories = [column for column in df.columns if NFE_SCHEMA.get(column, ("",))[0] == "category"]
+        if categories:
+            df[categories] = apply_nfe_schema(df[categories], arrow_dtypes)
+        return df
+
+    def _manifest_path(self, fingerprint: str) -> str:
+        return os.path.join(self.directory, MANIFEST_DIR, f"{fingerprint}.json")
+
+    def save_manifest(self, fingerprint: str, arrow_dtypes: bool, sources: Dict[str, str],
+                      shadowed: Dict[str, Set[str]], files: Dict[str, Set[str]]) -> None:
+        """
+        Records one dataset version: its sources and their content keys, the
+        owners that shadowed rows of each source, and its files.
+        """
+        path = self._manifest_path(fingerprint)
+        if os.path.exists(path):
+            self._touch(path)
+            return
+        manifest = {
+            "arrow_dtypes": arrow_dtypes,
+            "sources": sources,
+            "shadowed": {name: sorted(owners) for name, owners in shadowed.items()},
+            "files": {os.path.relpath(file_path, self.directory): sorted(names) for file_path, names in files.items()},
+        }
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(manifest, f)
+            os.replace(tmp_path, path)
+        except Exception:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+
+    def _manifests(self):
+        directory = os.path.join(self.directory, MANIFEST_DIR)
+        try:
+            filenames = os.listdir(directory)
+        except OSError:
+            return
+        for filename in filenames:
+            if not filename.endswith(".json"):
+                continue
+            path = os.path.join(directory, filename)
+            try:
+                with open(path, encoding="utf-8") as f:
+                    manifest = json.load(f)
+            except (OSError, ValueError):
+                continue
+            manifest["files"] = {os.path.join(self.directory, file_path): set(names)
+                                 for file_path, names in manifest.get("files", {}).items()}
+            yield path, manifest
+
+    def find_manifest(self, sources: Dict[str, str], arrow_dtypes: bool = False) -> Optional[dict]:
+        """
+        Finds the stored dataset version closest to `sources`: the one with
+        the most sources at the same content key, net of the sources it holds
+        that are not in `sources` (the caller drops those), and whose files
+        are all still present.
+
+        Returns:
+            The manifest ("sources", "shadowed" and "files", with absolute
+            paths), or None when no version shares more than it would drop.
+        """
+        best, best_path, best_score = None, None, 0
+        for path, manifest in self._manifests():
+            if manifest.get("arrow_dtypes") != arrow_dtypes:
+                continue
+            stored = manifest.get("sources", {})
+            matches = sum(1 for name, key in stored.items() if sources.get(name) == key)
+            score = matches - (len(stored) - matches)
+            if score > best_score and all(os.path.exists(file_path) for file_path in manifest["files"]):
+                best, best_path, best_score = manifest, path, score
+        if best is not None:
+            self._touch(best_path)
+        return best
+
+    @staticmethod
+    def retain(paths: Iterable[str]) -> None:
+        """Marks files as used by a live dataset, protecting them from eviction."""
+        with _live_lock:
+            _live_paths.update(os.path.abspath(path) for path in paths)
+
+    @staticmethod
+    def release(paths: Iterable[str]) -> None:
+        """Drops one reference to each file; unreferenced files can be evicted again."""
+        with _live_lock:
+            for path in map(os.path.abspath, paths):
+                count = _live_paths[path] - 1
+                if count > 0:
+                    _live_paths[path] = count
+                else:
+                    _live_paths.pop(path, None)
+
+    def evict(self, keep: Iterable[str] = ()) -> int:
+        """
+        Deletes least recently used files until the store fits `max_bytes`,
+        never touching the paths in `keep` or files retained by live datasets,
+        then drops the manifests that can no longer be restored.
+
+        Returns:
+            The number of files removed.
+        """
+        keep = {os.path.abspath(path) for path in keep}
+        with _live_lock:
+            keep.update(_live_paths)
+        entries = []
+        total = 0
+        for root, _, files in os.walk(self.directory):
+            for filename in files:
+                if not filename.endswith(".parquet"):
+                    continue
+                path = os.path.join(root, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                total += stat.st_size
+                if os.path.abspath(path) not in keep:
+                    entries.append((stat.st_mtime, stat.st_size, path))
+
+        removed = 0
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+
+        # Manifests whose files are gone cannot be restored; of the others, the MAX_MANIFESTS most recent are kept
+        restorable = []
+        for path, manifest in self._manifests():
+            if all(os.path.exists(file_path) for file_path in manifest["files"]):
+                try:
+                    restorable.append((os.stat(path).st_mtime, path))
+                    continue
+                except OSError:
+                    pass
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        for _, path in sorted(restorable, reverse=True)[MAX_MANIFESTS:]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        return removed
+
+
+def _sql_literal(value: str) -> str:
+    return "'" + value.replace("'", "''") + "'"
+
+
+def run_sql_query(files: Sequence[str], query: str, max_rows: int = SQL_MAX_ROWS,
+                  timeout: float = SQL_TIMEOUT_S, memory_mb: int = SQL_MEMORY_MB) -> str:
+    """
+    Runs a read-only SQL query over the given store files, exposed as the
+    view `nfe` (with the `month` partition column), and formats the result.
+
+    DuckDB reads only the columns the query uses and skips month partitions
+    and row groups its filters exclude, so the rows are never loaded into
+    memory as a whole. Queries are interrupted after `timeout` seconds.
+    """
+    if duckdb is None:
+        return "Error: DuckDB is not installed, SQL queries are unavailable."
+    if not files:
+        return "Error: no data is loaded in the columnar store."
+    query = query.strip().strip("`").strip()
+    if query.lower().startswith("sql"):
+        query = query[3:].strip()
+    query = query.rstrip(";").strip()
+    if not _READ_ONLY_STATEMENT.match(query) or ";" in query:
+        return "Error: only a single read-only SELECT/WITH query is allowed."
+
+    connection = duckdb.connect()
+    timer = threading.Timer(timeout, connection.interrupt)
+    try:
+        connection.execute(f"SET memory_limit = '{int(memory_mb)}MB'")
+        file_list = ", ".join(_sql_literal(os.path.abspath(path)) for path in files)
+        connection.execute(
+            f"CREATE VIEW {TABLE_NAME} AS SELECT * FROM read_parquet([{file_list}], "
+            "hive_partitioning = true, union_by_name = true, hive_types = {'month': VARCHAR})"
+        )
+        timer.start()
+        cursor = connection.execute(query)
+        columns = [column[0] for column in cursor.description]
+        rows = cursor.fetchmany(max_rows + 1)
+    except duckdb.InterruptException:
+        return f"Error: query interrupted after the {timeout:.0f}s time limit. Filter or aggregate more."
+    except duckdb.Error as e:
+        return f"Error executing SQL. Details:\n{e}"
+    finally:
+        timer.cancel()
+        connection.close()
+
+    if not rows:
+        return "Query returned no rows."
+    truncated = len(rows) > max_rows
+    result = pd.DataFrame(rows[:max_rows], columns=columns)
+    with pd.option_context("display.max_rows", None, "display.max_columns", None, "display.width", 200):
+        text = result.to_string(index=False)
+    if truncated:
+        text += f"\n(only the first {max_rows} rows are shown; aggregate or add LIMIT)"
+    return text
@@ -0,0 +1,397 @@
+# nfe_parser.py
+
+# Import necessary libraries and modules
+import codecs
+import io
+import os
+import xml.etree.ElementTree as ET
+from typing import Iterator, List, Optional
+
+import pandas as pd
+
+try:
+    import pyarrow as pa
+except ImportError:  # Arrow-backed dtypes are optional
+    pa = None
+
+# Bump whenever the rows produced for a given document change (keys cached parses)
+PARSER_VERSION = "3"
+
+# Size of each chunk read from the source and fed to the incremental parser
+CHUNK_SIZE = 64 * 1024
+
+# Fields read from the direct children of each invoice-level block
+INVOICE_FIELDS = {
+    "ide": (("cNF", "cNF"), ("nNF", "nNF"), ("dhEmi", "dhEmi")),
+    "emit": (("emit_CNPJ", "CNPJ"), ("emit_xNome", "xNome")),
+    "dest": (("dest_CNPJ", "CNPJ"), ("dest_xNome", "xNome")),
+}
+INVOICE_COLUMNS = ["chNFe", "cNF", "nNF", "dhEmi", "emit_CNPJ", "emit_xNome", "dest_CNPJ", "dest_xNome", "vNF"]
+
+# Fields read from the direct children of each <prod> block
+PRODUCT_FIELDS = (
+    ("prod_cProd", "cProd"),
+    ("prod_xProd", "xProd"),
+    ("prod_NCM", "NCM"),
+    ("prod_qCom", "qCom"),
+    ("prod_uCom", "uCom"),
+    ("prod_vUnCom", "vUnCom"),
+    ("prod_vProd", "vProd"),
+)
+
+# Column schema applied to the parsed rows: kind plus, for money and quantities, the
+# number of decimal places the NF-e layout allows. Those values are stored as float64
+# rounded to that scale, not as fixed point: float64 works with every pandas, NumPy and
+# plotting call the agent makes, at an exactness cost far below a centavo for NF-e magnitudes
+NFE_SCHEMA = {
+    "chNFe": ("string", None),
+    "cNF": ("string", None),
+    "nNF": ("string", None),
+    "dhEmi": ("datetime", None),
+    "emit_CNPJ": ("category", None),
+    "emit_xNome": ("category", None),
+    "dest_CNPJ": ("category", None),
+    "dest_xNome": ("category", None),
+    "vNF": ("decimal", 2),
+    "nItem": ("integer", None),
+    "prod_cProd": ("string", None),
+    "prod_xProd": ("string", None),
+    "prod_NCM": ("category", None),
+    "prod_qCom": ("decimal", 4),
+    "prod_uCom": ("category", None),
+    "prod_vUnCom": ("decimal", 10),
+    "prod_vProd": ("decimal", 2),
+    "source_file": ("category", None),
+}
+
+# Timezone used for `dhEmi` (NF-e timestamps carry their own UTC offset)
+NFE_TIMEZONE = "America/Sao_Paulo"
+
+
+class _LocalNameMap(dict):
+    """
+    Maps raw (possibly namespaced) tags to their local names.
+    Each distinct tag is resolved once; later lookups are plain dict hits.
+    """
+    def __missing__(self, tag: str) -> str:
+        name = tag.split('}')[-1] if '}' in tag else tag
+        self[tag] = name
+        return name
+
+
+_LOCAL_NAMES = _LocalNameMap()
+
+
+def access_key(invoice_id: Optional[str]) -> Optional[str]:
+    """Returns the 44-digit chave de acesso from an infNFe `Id` attribute ("NFe" + key)."""
+    if not invoice_id:
+        return None
+    invoice_id = invoice_id.strip()
+    return invoice_id[3:] if invoice_id.startswith("NFe") else invoice_id
+
+
+def _text(elem) -> Optional[str]:
+    return elem.text.strip() if elem.text else None
+
+
+class _InvoiceState:
+    """
+    Collects the fields of one <infNFe> while its events stream by.
+    Mirrors the lookup rules of the tree-based parser: first matching direct
+    child wins, the first <ICMSTot> anywhere in the invoice provides `vNF`,
+    and direct <det> children take precedence over nested ones.
+    """
+    __slots__ = ("elem", "blocks", "invoice", "total", "total_seen",
+                 "det", "det_direct", "item", "prod", "prod_seen",
+                 "direct_items", "nested_items")
+
+    def __init__(self, elem):
+        self.elem = elem
+        self.blocks = {}             # "ide"/"emit"/"dest" element -> block name
+        self.invoice = {}
+        self.total = None
+        self.total_seen = False
+        self.det = None
+        self.det_direct = False
+        self.item = None
+        self.prod = None
+        self.prod_seen = False
+        self.direct_items = []
+        self.nested_items = []
+
+
+def _iter_events(source, encoding: Optional[str] = None):
+    """
+    Feeds the source to an XMLPullParser in chunks, yielding start/end events.
+
+    By default bytes go to the parser untouched, so expat honors the BOM and
+    the XML declaration (UTF-8, UTF-16, ISO-8859-1...). With `encoding`, bytes
+    are decoded incrementally with it instead (replacing undecodable bytes),
+    which recovers documents whose bytes do not match what they declare.
+    """
+    parser = ET.XMLPullParser(events=("start", "end"))
+    decoder = codecs.getincrementaldecoder(encoding)(errors="replace") if encoding else None
+    while True:
+        chunk = source.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        if decoder is not None and isinstance(chunk, bytes):
+            chunk = decoder.decode(chunk)
+        parser.feed(chunk)
+        yield from parser.read_events()
+    if decoder is not None:
+        tail = decoder.decode(b"", final=True)
+        if tail:
+            parser.feed(tail)
+    parser.close()
+    yield from parser.read_events()
+
+
+def _finish_invoice(state: _InvoiceState) -> Iterator[dict]:
+    invoice = {column: state.invoice.get(column) for column in INVOICE_COLUMNS}
+    items = state.direct_items or state.nested_items
+    if not items:
+        row = invoice.copy()
+        row.update({"nItem": None})
+        yield row
+    for item in items:
+        row = invoice.copy()
+        row.update(item)
+        yield row
+
+
+def _iter_rows_once(source, encoding: Optional[str] = None) -> Iterator[dict]:
+    names = _LOCAL_NAMES
+    stack = []                       # open elements; stack[-1] is the parent on "end"
+    state = None
+
+    for event, elem in _iter_events(source, encoding):
+        name = names[elem.tag]
+
+        if event == "start":
+            parent = stack[-1] if stack else None
+            stack.append(elem)
+            if state is None:
+                if name == "infNFe":
+                    state = _InvoiceState(elem)
+                    state.invoice["chNFe"] = access_key(elem.attrib.get("Id"))
+            elif parent is state.elem and name in INVOICE_FIELDS and name not in state.blocks.values():
+                state.blocks[elem] = name
+            elif name == "ICMSTot" and not state.total_seen:
+                state.total_seen = True
+                state.total = elem
+            elif name == "det" and state.det is None:
+                state.det = elem
+                state.det_direct = parent is state.elem
+                state.item = {"nItem": elem.attrib.get("nItem")}
+                state.prod_seen = False
+            elif name == "prod" and parent is state.det and not state.prod_seen:
+                state.prod_seen = True
+                state.prod = elem
+            continue
+
+        # "end" event
+        stack.pop()
+        parent = stack[-1] if stack else None
+
+        if state is None:
+            # Nothing outside <infNFe> is extracted (signatures, protocols...)
+            if parent is not None:
+                elem.clear()
+                parent.remove(elem)
+            continue
+
+        if elem is state.elem:
+            # Invoice finished: emit its rows and drop the subtree
+            yield from _finish_invoice(state)
+            state = None
+            elem.clear()
+            if parent is not None:
+                parent.remove(elem)
+            continue
+
+        block = state.blocks.get(parent)
+        if block is not None:
+            for column, tag in INVOICE_FIELDS[block]:
+                if tag == name and column not in state.invoice:
+                    state.invoice[column] = _text(elem)
+        elif parent is state.total and name == "vNF" and "vNF" not in state.invoice:
+            state.invoice["vNF"] = _text(elem)
+        elif parent is state.prod and state.prod is not None:
+            for column, tag in PRODUCT_FIELDS:
+                if tag == name and column not in state.item:
+                    state.item[column] = _text(elem)
+                    break
+
+        if elem is state.prod:
+            # Fix the column order regardless of the order tags appeared in
+            item = {"nItem": state.item["nItem"]}
+            item.update({column: state.item.get(column) for column, _ in PRODUCT_FIELDS})
+            state.item = item
+            state.prod = None
+        elif elem is state.det:
+            target = state.direct_items if state.det_direct else state.nested_items
+            target.append(state.item)
+            state.det = None
+            state.item = None
+            # Items are fully extracted, their elements are no longer needed
+            elem.clear()
+        elif elem is state.total:
+            state.total = None
+
+
+def iter_nfe_rows(source) -> Iterator[dict]:
+    """
+    Streams an NF-e XML (bare NFe, nfeProc or batch bundles) in a single
+    incremental pass, yielding one dict per <det> item as each <infNFe> ends.
+    Finished invoice subtrees are cleared, so memory stays flat regardless
+    of the file size.
+
+    Args:
+        source: A binary/text file-like object (e.g. a Streamlit upload) or a path.
+
+    Yields:
+        Row dicts with the same keys, in the same order, as `parse_nfe_xml` columns.
+    """
+    if isinstance(source, bytes):
+        source = io.BytesIO(source)
+    elif isinstance(source, str) or hasattr(source, "__fspath__"):
+        with open(source, "rb") as handle:
+            yield from iter_nfe_rows(handle)
+        return
+
+    try:
+        source.seek(0)
+    except Exception:
+        pass
+
+    emitted = 0
+    try:
+        for row in _iter_rows_once(source):
+            emitted += 1
+            yield row
+        return
+    except ET.ParseError as e:
+        # Possibly bytes that do not match the declared (or default UTF-8)
+        # encoding: retry decoding as latin-1, skipping the rows already produced
+        first_error = e
+
+    try:
+        source.seek(0)
+    except Exception:
+        raise RuntimeError(f"Erro ao parsear XML: {first_error}")
+
+    try:
+        for index, row in enumerate(_iter_rows_once(source, "latin-1")):
+            if index >= emitted:
+                yield row
+    except ET.ParseError:
+        raise RuntimeError(f"Erro ao parsear XML: {first_error}")
+
+
+def source_name(source) -> Optional[str]:
+    """Returns the file name recorded in `source_file` for an upload or a path."""
+    if isinstance(source, str) or hasattr(source, "__fspath__"):
+        return os.path.basename(os.fspath(source))
+    return getattr(source, "name", None)
+
+
+def parse_nfe_xml(uploaded_file) -> pd.DataFrame:
+    """
+    Robust NF-e XML parser that is namespace-agnostic.
+    Each <det> (item) becomes a row; invoice-level fields (including the
+    access key `chNFe`, from the infNFe `Id` attribute) are repeated.
+    Works with default namespaces by comparing local tag names.
+    Parsing is streamed through `iter_nfe_rows`, so only the rows are held
+    in memory, never the full document tree.
+    """
+    df = pd.DataFrame(list(iter_nfe_rows(uploaded_file)))
+    df["source_file"] = source_name(uploaded_file)
+    return df
+
+
+def _convert_column(series: pd.Series, kind: str, scale: Optional[int], arrow: bool) -> pd.Series:
+    if kind == "decimal":
+        values = pd.to_numeric(series, errors="coerce").round(scale)
+        # Arrow decimal128 breaks common calls (nlargest, rank...), so Arrow mode uses double too
+        return values.astype(pd.ArrowDtype(pa.float64()) if arrow else "float64")
+    if kind == "integer":
+        values = pd.to_numeric(series, errors="coerce")
+        return values.astype(pd.ArrowDtype(pa.int32()) if arrow else "Int32")
+    if kind == "datetime":
+        values = pd.to_datetime(series, errors="coerce", utc=True, format="ISO8601").dt.tz_convert(NFE_TIMEZONE)
+        if arrow:
+            return values.astype(pd.ArrowDtype(pa.timestamp("us", tz=NFE_TIMEZONE)))
+        return values
+    if kind == "category":
+        if arrow:
+            return series.astype(pd.ArrowDtype(pa.dictionary(pa.int32(), pa.string())))
+        return series.astype("category")
+    return series.astype(pd.ArrowDtype(pa.string()) if arrow else "string")
+
+
+def apply_nfe_schema(df: pd.DataFrame, arrow: bool = False) -> pd.DataFrame:
+    """
+    Converts the raw string columns produced by `parse_nfe_xml` to compact,
+    analysis-ready dtypes following `NFE_SCHEMA`:
+    money and quantities become float64 rounded to their NF-e scale,
+    `dhEmi` a tz-aware datetime, and repeated identifiers/names categoricals.
+
+    Args:
+        df: Parsed (and possibly concatenated) NF-e rows.
+        arrow: Use Arrow-backed dtypes (double, dictionary, string[pyarrow]).
+
+    Returns:
+        A new DataFrame; columns absent from the schema are left untouched.
+    """
+    if arrow and pa is None:
+        raise RuntimeError("pyarrow não está instalado; não é possível usar tipos Arrow.")
+    converted = {}
+    for column in df.columns:
+        if column in NFE_SCHEMA:
+            kind, scale = NFE_SCHEMA[column]
+            converted[column] = _convert_column(df[column], kind, scale, arrow)
+        else:
+            converted[column] = df[column]
+    return pd.DataFrame(converted, index=df.index)
+
+
+def concat_nfe_frames(frames: List[pd.DataFrame]) -> pd.DataFrame:
+    """
+    Concatenates typed NF-e frames without losing categorical dtypes.
+    `pd.concat` falls back to object when categories differ, so each
+    categorical column is first widened to the union of all categories.
+    """
+    frames = [frame for frame in frames if frame is not None]
+    if not frames:
+        return pd.DataFrame()
+    if len(frames) == 1:
+        return frames[0].reset_index(drop=True)
+
+    widened = [frame.copy(deep=False) for frame in frames]
+    columns = dict.fromkeys(column for frame in frames for column in frame.columns)
+    for column in columns:
+        present = [frame[column] for frame in frames if column in frame.columns]
+        if not all(isinstance(series.dtype, pd.CategoricalDtype) for series in present):
+            continue
+        categories = pd.Index(present[0].cat.categories)
+        for series in present[1:]:
+            categories = categories.union(series.cat.categories, sort=False)
+        for frame in widened:
+            if column in frame.columns:
+                frame[column] = frame[column].cat.set_categories(categories)
+    return pd.concat(widened, ignore_index=True, sort=False)
+
+
+def emission_month(dhEmi: pd.Series) -> pd.Series:
+    """
+    Returns the emission month of each row as a "YYYY-MM" string (NA when
+    `dhEmi` is missing), for typed as well as raw string columns.
+    """
+    emitted = dhEmi
+    if not (isinstance(emitted.dtype, pd.ArrowDtype) or pd.api.types.is_datetime64_any_dtype(emitted.dtype)):
+        emitted = pd.to_datetime(emitted, errors="coerce", utc=True, format="ISO8601").dt.tz_convert(NFE_TIMEZONE)
+    # Formatting a handful of distinct year*100+month codes is far cheaper than strftime per row
+    codes = (emitted.dt.year * 100 + emitted.dt.month).astype("float64")
+    months = {code: f"{int(code) // 100:04d}-{int(code) % 100:02d}" for code in codes.dropna().unique()}
+    return codes.map(months).astype("string")
@@ -0,0 +1,188 @@
+# parse_cache.py
+
+# Import necessary libraries and modules
+import hashlib
+import json
+import os
+import tempfile
+import uuid
+from typing import Dict, Iterable, List, Optional
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.ipc as ipc
+
+from nfe_parser import PARSER_VERSION
+
+# Default location and size bound of the on-disk cache (overridable via environment)
+DEFAULT_CACHE_DIR = os.environ.get("NFE_CACHE_DIR", ".nfe_cache")
+DEFAULT_CACHE_MAX_BYTES = int(os.environ.get("NFE_CACHE_MAX_MB", "1024")) * 1024 * 1024
+
+# Segment files, and the schema metadata entry mapping each key to its row range
+SEGMENT_SUFFIX = ".arrow"
+_INDEX_METADATA = b"nfe_parse_cache_index"
+
+# Per-process index of every segment read so far (segments are immutable once written)
+_segment_indexes = {}
+
+
+def _new_digest():
+    digest = hashlib.sha256()
+    digest.update(PARSER_VERSION.encode("ascii"))
+    digest.update(b"\0")
+    return digest
+
+
+def content_key(data: bytes) -> str:
+    """Returns the cache key of an XML document: hash of its bytes plus the parser version."""
+    digest = _new_digest()
+    digest.update(data)
+    return digest.hexdigest()
+
+
+def file_content_key(path: str, chunk_size: int = 1024 * 1024) -> str:
+    """Same key as `content_key` for a file on disk, hashed in chunks without loading it whole."""
+    digest = _new_digest()
+    with open(path, "rb") as handle:
+        for chunk in iter(lambda: handle.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ParseCache:
+    """
+    Content-addressed cache of parsed NF-e files under `directory`. Entries
+    hold the raw parser output (before `apply_nfe_schema`), so schema tweaks
+    never invalidate them.
+
+    Documents are stored in segments: one Arrow IPC file per ingest batch,
+    whose schema metadata maps each content key to its row range. A warm
+    batch is served by memory-mapping one file instead of opening a file per
+    invoice, which matters for the common case of thousands of small XMLs.
+
+    Recency is tracked with segment mtimes: hits touch the segment and
+    `evict` removes the least recently used segments until the cache fits
+    `max_bytes`. Instances are plain data and can be shipped to worker processes.
+    """
+
+    def __init__(self, directory: str = DEFAULT_CACHE_DIR, max_bytes: int = DEFAULT_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def _segments(self) -> List[str]:
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return []
+        return [os.path.join(self.directory, name) for name in names if name.endswith(SEGMENT_SUFFIX)]
+
+    def _segment_index(self, path: str) -> Optional[Dict[str, list]]:
+        index = _segment_indexes.get(path)
+        if index is None:
+            try:
+                with pa.memory_map(path) as source:
+                    metadata = ipc.open_file(source).schema.metadata or {}
+                index = json.loads(metadata[_INDEX_METADATA])
+            except (OSError, KeyError, ValueError, pa.ArrowInvalid):
+                return None
+            _segment_indexes[path] = index
+        return index
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, pd.DataFrame]:
+        """
+        Returns the cached DataFrames of the given keys that are present;
+        misses and unreadable segments are simply left out.
+        """
+        wanted = set(keys)
+        located = {}                      # segment path -> keys found in it
+        for path in self._segments():
+            if not wanted:
+                break
+            index = self._segment_index(path)
+            if not index:
+                continue
+            hits = [key for key in wanted if key in index]
+            if hits:
+                located[path] = hits
+                wanted.difference_update(hits)
+
+        found = {}
+        for path, hits in located.items():
+            try:
+                with pa.memory_map(path) as source:
+                    df = ipc.open_file(source).read_pandas()
+            except (OSError, pa.ArrowInvalid):
+                continue
+            index = _segment_indexes[path]
+            for key in hits:
+                start, count = index[key]
+                found[key] = df.iloc[start:start + count].reset_index(drop=True)
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+        return found
+
+    def put_many(self, entries: Dict[str, pd.DataFrame]) -> None:
+        """
+        Stores several documents as one segment. Writes go to a temporary file
+        first and are renamed into place, so concurrent workers never expose
+        partial segments.
+        """
+        if not entries:
+            return
+        index, start = {}, 0
+        for key, df in entries.items():
+            index[key] = [start, len(df)]
+            start += len(df)
+        combined = pd.concat(list(entries.values()), ignore_index=True, sort=False)
+        table = pa.Table.from_pandas(combined, preserve_index=False)
+        metadata = dict(table.schema.metadata or {})
+        metadata[_INDEX_METADATA] = json.dumps(index).encode("utf-8")
+        table = table.replace_schema_metadata(metadata)
+
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, uuid.uuid4().hex + SEGMENT_SUFFIX)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        os.close(fd)
+        try:
+            with pa.OSFile(tmp_path, "wb") as sink:
+                with ipc.new_file(sink, table.schema, options=ipc.IpcWriteOptions(compression="lz4")) as writer:
+                    writer.write_table(table)
+            os.replace(tmp_path, path)
+        except Exception:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+
+    def evict(self) -> int:
+        """
+        Deletes least recently used segments until the cache fits `max_bytes`.
+
+        Returns:
+            The number of segments removed.
+        """
+        entries = []
+        total = 0
+        for path in self._segments():
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+
+        removed = 0
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            _segment_indexes.pop(path, None)
+            total -= size
+            removed += 1
+        return removed
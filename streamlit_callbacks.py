@@ -0,0 +1,148 @@
+# streamlit_callbacks.py
+
+# Import necessary libraries and modules
+from typing import Any, Dict, List, Optional
+from uuid import UUID
+
+import streamlit as st
+from langchain_core.callbacks import BaseCallbackHandler
+
+# Marker the ReAct output parser uses to recognize the answer
+FINAL_ANSWER_MARKER = "Final Answer:"
+
+
+def _format_tokens(prompt_tokens: Optional[int], completion_tokens: Optional[int]) -> str:
+    if prompt_tokens is None and completion_tokens is None:
+        return ""
+    return f" · {prompt_tokens or 0} → {completion_tokens or 0} tokens"
+
+
+def format_llm_timing(llm) -> str:
+    """One-line summary of an LLM call (see `agent_tracing.LLMCallTrace`)."""
+    text = f"🧠 LLM: {llm.latency_s:.2f} s"
+    if llm.first_token_s is not None:
+        text += f" (primeiro token em {llm.first_token_s:.2f} s)"
+    return text + _format_tokens(llm.prompt_tokens, llm.completion_tokens)
+
+
+def format_tool_timing(step) -> str:
+    """One-line summary of a step's tool call (see `agent_tracing.StepTrace`)."""
+    metrics = step.tool_metrics
+    if not metrics:
+        return ""
+    text = f"⚙️ Ferramenta: {metrics.get('wall_s', 0.0):.2f} s (CPU {metrics.get('cpu_s', 0.0):.2f} s"
+    for key, label in (("load_s", "carga dos dados"), ("exec_s", "execução"), ("chart_s", "gráficos")):
+        if metrics.get(key):
+            text += f", {label} {metrics[key]:.2f} s"
+    text += ")"
+    if "peak_rss_mb" in metrics:
+        text += f" · pico de memória {metrics['peak_rss_mb']:.0f} MB (+{metrics.get('rss_growth_mb', 0.0):.0f} MB)"
+    return text + f" · observação com {step.observation_chars} caracteres"
+
+
+def format_run_summary(trace) -> str:
+    """One-line summary of a whole run (see `agent_tracing.RunTrace`)."""
+    calls = trace.llm_calls
+    text = f"⏱️ Tempo total: {trace.total_s or 0.0:.2f} s · LLM {trace.llm_s:.2f} s em {len(calls)} chamada(s)"
+    text += _format_tokens(*trace.token_totals())
+    return text + f" · ferramentas {trace.tool_s:.2f} s em {len(trace.steps)} ciclo(s)"
+
+
+def render_step_action(container, index: int, action, step_trace=None) -> None:
+    """Renders the Thought and Action parts of one ReAct cycle, with the LLM timing when traced."""
+    with container:
+        if index > 0:
+            st.divider()
+        st.subheader(f"🔄 Ciclo {index + 1}")
+        if step_trace is not None and step_trace.llm is not None:
+            st.caption(format_llm_timing(step_trace.llm))
+
+        # 1. Agent Thought
+        st.markdown("##### 1. Pensamento")
+        st.text(action.log.strip())
+
+        # 2. Action Executed
+        st.markdown("##### 2. Ação")
+        st.markdown(f"**Ferramenta:** `{action.tool}`")
+        st.markdown("**Entrada da Ação (Código Executado):**")
+        st.code(action.tool_input, language="python")
+
+
+def render_step_observation(container, observation, step_trace=None) -> None:
+    """Renders the Observation part of one ReAct cycle, with the tool timing when traced."""
+    with container:
+        # 3. Observation (Result of Action)
+        st.markdown("##### 3. Observação")
+        if step_trace is not None and step_trace.tool_metrics:
+            st.caption(format_tool_timing(step_trace))
+        st.markdown(observation)
+
+
+def render_agent_steps(container, intermediate_steps: List[tuple], trace=None) -> None:
+    """Renders completed intermediate steps, e.g. after a non-streamed run; `trace` adds their timings."""
+    if not intermediate_steps:
+        container.write("Nenhum passo intermediário executado (ex: resposta direta fornecida).")
+        return
+    step_traces = trace.steps if trace is not None and len(trace.steps) == len(intermediate_steps) else None
+    for i, (action, observation) in enumerate(intermediate_steps):
+        step_trace = step_traces[i] if step_traces else None
+        render_step_action(container, i, action, step_trace)
+        render_step_observation(container, observation, step_trace)
+
+
+class StreamlitAgentCallbackHandler(BaseCallbackHandler):
+    """
+    Renders a ReAct run while it happens: the LLM's tokens appear live in the
+    steps container, each Thought/Action is rendered as soon as the agent picks
+    it, each Observation as soon as the tool returns, and the Final Answer is
+    streamed token by token into `answer_placeholder`.
+
+    Callbacks fire on the thread that invoked the agent, i.e. the Streamlit
+    script thread, so Streamlit elements can be updated directly. With an
+    `agent_tracing.AgentTracer` listed before this handler, each cycle also
+    shows its LLM and tool timings.
+    """
+
+    def __init__(self, steps_container, answer_placeholder, tracer=None):
+        self.steps_container = steps_container
+        self.answer_placeholder = answer_placeholder
+        self.tracer = tracer
+        self.step_count = 0
+        self._tokens = []
+        self._live_placeholder = None
+
+    def on_chat_model_start(self, serialized: Dict[str, Any], messages: List[List[Any]], *, run_id: UUID, **kwargs: Any) -> None:
+        self._start_llm_output()
+
+    def on_llm_start(self, serialized: Dict[str, Any], prompts: List[str], *, run_id: UUID, **kwargs: Any) -> None:
+        self._start_llm_output()
+
+    def _start_llm_output(self) -> None:
+        self._tokens = []
+        self._live_placeholder = self.steps_container.empty()
+
+    def on_llm_new_token(self, token: str, *, run_id: UUID, parent_run_id: Optional[UUID] = None, **kwargs: Any) -> None:
+        self._tokens.append(token)
+        text = "".join(self._tokens)
+        if FINAL_ANSWER_MARKER in text:
+            self.answer_placeholder.markdown(text.split(FINAL_ANSWER_MARKER, 1)[1].strip() + " ▌")
+            if self._live_placeholder is not None:
+                self._live_placeholder.empty()
+        elif self._live_placeholder is not None:
+            self._live_placeholder.text(f"💭 {text.strip()}")
+
+    def on_agent_action(self, action, *, run_id: UUID, parent_run_id: Optional[UUID] = None, **kwargs: Any) -> Any:
+        if self._live_placeholder is not None:
+            self._live_placeholder.empty()
+            self._live_placeholder = None
+        render_step_action(self.steps_container, self.step_count, action, self._step_trace())
+        self.step_count += 1
+
+    def _step_trace(self):
+        return self.tracer.current_step if self.tracer is not None else None
+
+    def on_tool_end(self, output: Any, *, run_id: UUID, parent_run_id: Optional[UUID] = None, **kwargs: Any) -> Any:
+        render_step_observation(self.steps_container, getattr(output, "content", output), self._step_trace())
+
+    def on_tool_error(self, error: BaseException, *, run_id: UUID, parent_run_id: Optional[UUID] = None, **kwargs: Any) -> Any:
+        render_step_observation(self.steps_container, f"Erro na ferramenta: {error}", self._step_trace())
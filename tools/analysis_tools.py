@@ -5,29 +5,71 @@ from langchain.tools import tool
 from io import StringIO
 import sys
 import os
+import threading
+import time
+import uuid
+import weakref
 import matplotlib
 # Set the Matplotlib backend to 'Agg' to prevent GUI issues in non-interactive environments
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 import seaborn as sns
-import traceback
 
-# Define a persistent scope for code execution
-_global_code_scope = {}
+from aggregate_index import AggregateIndex, run_aggregate_query
+from dataset_profile import build_dataset_profile
+from invoice_store import duckdb, run_sql_query
+from tools.charts import CHART_TAG, ChartStore, capture_figures
+from tools.metrics import report_tool_metrics
+from tools.observation import compact_display, format_exception_compact, shape_output
+from tools.sandbox import SharedDataset, get_sandbox_pool
 
-@tool
-def code_execution_tool(code: str) -> str:
+# Execution backend: "sandbox" runs code in the warm worker pool, "inprocess" uses exec() here
+EXECUTION_BACKEND = os.environ.get("ANALYSIS_EXECUTION_BACKEND", "sandbox")
+
+# pyplot keeps global figure state, so in-process executions are serialized
+_inprocess_lock = threading.Lock()
+
+
+class _ThreadLocalStdout:
     """
-    Executes Python code to explore and analyze data within a Pandas DataFrame.
-    The DataFrame is available as the variable `df`. Use `print()` to return results.
-    Example: print(df.info())
+    sys.stdout proxy that sends writes from a capturing thread to that
+    thread's buffer and everything else to the real stream. Installed once,
+    so concurrent sessions never swap the process-wide stdout.
     """
-    global _global_code_scope
 
-    # Clear the state of any previous plot to prevent plot overlap
-    if 'plt' in _global_code_scope:
-        _global_code_scope['plt'].clf()
+    def __init__(self, stream):
+        self._stream = stream
+        self._local = threading.local()
+
+    def capture(self, buffer):
+        self._local.buffer = buffer
+
+    def release(self):
+        self._local.buffer = None
+
+    def write(self, text):
+        buffer = getattr(self._local, "buffer", None)
+        return (buffer if buffer is not None else self._stream).write(text)
+
+    def flush(self):
+        buffer = getattr(self._local, "buffer", None)
+        (buffer if buffer is not None else self._stream).flush()
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+
+_stdout_lock = threading.Lock()
+
 
+def _thread_local_stdout() -> _ThreadLocalStdout:
+    with _stdout_lock:
+        if not isinstance(sys.stdout, _ThreadLocalStdout):
+            sys.stdout = _ThreadLocalStdout(sys.stdout)
+        return sys.stdout
+
+
+def _clean_code(code: str) -> str:
     # Clean up input code to remove potential markdown formatting (```python or ```)
     cleaned_code = code.strip()
     if cleaned_code.startswith("```python"):
@@ -38,47 +80,204 @@ def code_execution_tool(code: str) -> str:
     if cleaned_code.endswith("```"):
         cleaned_code = cleaned_code[:-3]
 
-    cleaned_code = cleaned_code.strip()
+    return cleaned_code.strip()
 
-    try:
-        # Redirect standard output (stdout) to capture prints
-        old_stdout = sys.stdout
-        sys.stdout = captured_output = StringIO()
 
-        # Execute the code in the persistent scope
-        exec(cleaned_code, _global_code_scope)
+def _format_observation(output: str, charts_note: str = "") -> str:
+    if output:
+        return f"Execution successful. Output:\n```\n{shape_output(output)}\n```{charts_note}"
+    if charts_note:
+        return f"Code executed successfully.{charts_note}"
+    return "Code executed successfully, but produced no output. Use the `print()` function to surface results."
+
+
+def _format_error(details: str) -> str:
+    return f"Error executing code. Details:\n```\n{shape_output(details)}\n```"
+
+
+class ExecutionContext:
+    """
+    The execution state of one analysis session: its `df`, its persistent
+    variables and its output. Each AgentExecutor gets its own context, so
+    several sessions can share one server process without seeing each
+    other's data or printed output.
+    """
+
+    def __init__(self, dataframe: pd.DataFrame, backend: str = None, profile: str = None,
+                 aggregates: AggregateIndex = None, store_paths: list = None, shared_dataset: SharedDataset = None):
+        self.session_id = uuid.uuid4().hex
+        self.backend = backend or EXECUTION_BACKEND
+        self.dataframe = dataframe
+        self.dataset_profile = None
+        self.aggregates = None
+        self.store_paths = None
+        self.scope = {'pd': pd, 'plt': plt, 'sns': sns}
+        self.charts = ChartStore()
+        self._shared_dataset = None
+        self._dataset_key = None
+        self.update_dataframe(dataframe, profile, aggregates, store_paths, shared_dataset)
+        if self.backend == "sandbox":
+            # Drop this session's variables in its worker once the context is gone
+            weakref.finalize(self, _reset_sandbox_session, self.session_id)
 
-        # Restore standard output
-        sys.stdout = old_stdout
-        output = captured_output.getvalue()
+    def update_dataframe(self, dataframe: pd.DataFrame, profile: str = None, aggregates: AggregateIndex = None,
+                         store_paths: list = None, shared_dataset: SharedDataset = None):
+        """
+        Replaces the DataFrame exposed as `df` to the agent's code, keeping the
+        rest of the session's variables (and the agent built on it) intact.
+        `profile` is the dataset summary shown in the prompt and `aggregates`
+        the cubes behind the aggregate tool; each is computed here when the
+        caller does not already maintain one. `store_paths` are the columnar
+        store files behind the SQL tool, which is only offered when given.
+        `shared_dataset` is an existing sandbox export of `dataframe` to reuse.
+        """
+        self.dataframe = dataframe
+        self.dataset_profile = profile if profile is not None else build_dataset_profile(dataframe)
+        self.aggregates = aggregates if aggregates is not None else AggregateIndex.from_dataframe(dataframe)
+        self.store_paths = store_paths
+        self.scope['df'] = dataframe
+        self._dataset_key = uuid.uuid4().hex
+        if self.backend == "sandbox":
+            # Export the DataFrame once; workers memory-map it instead of unpickling a copy
+            self._shared_dataset = shared_dataset or SharedDataset(dataframe)
 
-        if output:
-            return f"Execution successful. Output:\n```\n{output}\n```"
-        else:
-            return "Code executed successfully, but produced no output. Use the `print()` function to surface results."
+    def fork(self) -> "ExecutionContext":
+        """
+        Returns a new session over the same data: it shares the DataFrame, the
+        profile, the cubes, the store files and the sandbox export, but has
+        its own variables and charts (e.g. one per concurrent batch question).
+        """
+        return ExecutionContext(self.dataframe, self.backend, self.dataset_profile, self.aggregates,
+                                self.store_paths, shared_dataset=self._shared_dataset)
 
+    def reset_scope(self):
+        """Drops every variable the agent's code defined, keeping `df` and the preloaded modules."""
+        self.scope = {'pd': pd, 'plt': plt, 'sns': sns, 'df': self.dataframe}
+        if self.backend == "sandbox":
+            _reset_sandbox_session(self.session_id)
+
+    def _charts_note(self, charts: list) -> str:
+        """Stores captured charts in the session and tells the agent how to show them."""
+        if not charts:
+            return ""
+        tags, notes = [], []
+        for png, downsampling in charts:
+            tags.append(f"{CHART_TAG}{self.charts.add(png)}]")
+            notes.extend(downsampling)
+        note = f"\nCharts captured: {' '.join(tags)} (include these tags in the Final Answer to display them)"
+        if notes:
+            note += "\nLarge series were reduced before rendering: " + "; ".join(notes)
+        return note
+
+    def run(self, code: str) -> str:
+        """Executes `code` in this session's scope and returns the formatted observation."""
+        cleaned_code = _clean_code(code)
+
+        if self.backend == "sandbox":
+            status, output, charts, metrics = get_sandbox_pool().execute(cleaned_code, self._shared_dataset, session_id=self.session_id)
+            # CPU and memory are the worker's, not this process's
+            report_tool_metrics(backend="sandbox", status=status, **metrics)
+            return _format_observation(output, self._charts_note(charts)) if status == "ok" else _format_error(output)
+
+        stdout = _thread_local_stdout()
+        captured_output = StringIO()
+        with _inprocess_lock:
+            # Start from no open figures, so only this call's plots are captured
+            plt.close("all")
+            stdout.capture(captured_output)
+            start = time.perf_counter()
+            try:
+                # Execute the code in the persistent scope, printing DataFrames compactly
+                with compact_display():
+                    exec(cleaned_code, self.scope)
+                executed = time.perf_counter()
+                charts = capture_figures(cleaned_code, self._dataset_key)
+                report_tool_metrics(backend="inprocess", status="ok", exec_s=executed - start,
+                                    chart_s=time.perf_counter() - executed)
+            except Exception as e:
+                report_tool_metrics(backend="inprocess", status="error", exec_s=time.perf_counter() - start)
+                # Capture the relevant part of the traceback and return it as a formatted string
+                return _format_error(format_exception_compact(e))
+            finally:
+                stdout.release()
+                plt.close("all")
+        return _format_observation(captured_output.getvalue(), self._charts_note(charts))
+
+    def cancel(self):
+        """Cancels the code this session is running (sandbox backend only)."""
+        if self.backend == "sandbox":
+            get_sandbox_pool().cancel(self.session_id)
+
+
+def _reset_sandbox_session(session_id: str):
+    try:
+        get_sandbox_pool().reset_session(session_id)
     except Exception:
-        # Restore standard output in case of error
-        sys.stdout = old_stdout
-        # Capture the full traceback and return it as a formatted string
-        error_trace = traceback.format_exc()
-        return f"Error executing code. Details:\n```\n{error_trace}\n```"
+        pass
+
+
+def make_code_execution_tool(context: ExecutionContext):
+    """Builds the code execution tool bound to one session's ExecutionContext."""
+
+    @tool
+    def code_execution_tool(code: str) -> str:
+        """
+        Executes Python code to explore and analyze data within a Pandas DataFrame.
+        The DataFrame is available as the variable `df`. Use `print()` to return results.
+        Example: print(df.groupby('emit_CNPJ', observed=True)['prod_vProd'].sum())
+        """
+        return context.run(code)
+
+    return code_execution_tool
+
+
+def make_aggregate_lookup_tool(context: ExecutionContext):
+    """Builds the aggregate lookup tool bound to one session's ExecutionContext."""
+
+    @tool
+    def aggregate_lookup_tool(query: str) -> str:
+        """
+        Answers totals and rankings from pre-aggregated indexes in milliseconds, without scanning `df`.
+        Input is a JSON object: "by" is one of emit_CNPJ, dest_CNPJ, prod_NCM, prod_cProd, month (YYYY-MM of dhEmi),
+        or a list of one of them plus "month"; optional "filters" (exact match on those dimensions), "top" (default 20),
+        "order" (prod_vProd, prod_qCom or itens) and "ascending". Returns sums of prod_vProd and prod_qCom and the item count.
+        Example: {"by": "emit_CNPJ", "filters": {"month": "2024-03"}, "top": 10}
+        For anything else (other columns, averages, distinct counts, charts) use code_execution_tool.
+        """
+        return shape_output(run_aggregate_query(context.aggregates, query))
+
+    return aggregate_lookup_tool
+
+
+def make_sql_query_tool(context: ExecutionContext):
+    """Builds the SQL tool over the columnar store files of one session's ExecutionContext."""
+
+    @tool
+    def sql_query_tool(query: str) -> str:
+        """
+        Runs one read-only SQL query (DuckDB dialect) over the on-disk columnar copy of the invoice items,
+        exposed as the table `nfe`: the same columns as `df` plus `month` ('YYYY-MM' of dhEmi, the partition key).
+        Only the referenced columns and matching months are read, under a query memory limit, so heavy scans and
+        GROUP BYs do not copy `df`; filter on `month` whenever possible. Example: SELECT prod_NCM, SUM(prod_vProd) AS total FROM nfe WHERE month >= '2024-01'
+        GROUP BY prod_NCM ORDER BY total DESC LIMIT 10
+        """
+        return shape_output(run_sql_query(context.store_paths or [], query))
+
+    return sql_query_tool
+
 
-def setup_analysis_tools(dataframe: pd.DataFrame):
+def setup_analysis_tools(dataframe: pd.DataFrame, context: ExecutionContext = None):
     """
     Helper function that sets up and configures the tools for the agent.
+    A new ExecutionContext is created for `dataframe` unless one is given.
     """
-    # Initialize the scope with the DataFrame and libraries
-    global _global_code_scope
-    _global_code_scope = {
-        'df': dataframe,
-        'pd': pd,
-        'plt': plt,
-        'sns': sns
-    }
-    # Ensure the directory for saving charts exists.
-    if not os.path.exists("charts"):
-        os.makedirs("charts")
-
-    # Return the list of tools
-    return [code_execution_tool]
\ No newline at end of file
+    if context is None:
+        context = ExecutionContext(dataframe)
+    if context.backend == "sandbox":
+        # Start the worker pool now so the first question does not pay for it
+        get_sandbox_pool()
+    # Return the list of tools; SQL over the columnar store needs DuckDB and a store
+    tools = [make_code_execution_tool(context), make_aggregate_lookup_tool(context)]
+    if duckdb is not None and context.store_paths is not None:
+        tools.append(make_sql_query_tool(context))
+    return tools
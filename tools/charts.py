@@ -0,0 +1,249 @@
+# tools/charts.py
+
+# Import necessary libraries and modules
+import hashlib
+import os
+import re
+import threading
+import uuid
+from collections import OrderedDict
+from io import BytesIO
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+# Largest number of points drawn per line or scatter; bigger series are downsampled or binned
+CHART_MAX_POINTS = int(os.environ.get("CHART_MAX_POINTS", "5000"))
+
+# Charts kept per session, and rendered figures kept per process for reuse
+CHART_MAX_PER_SESSION = int(os.environ.get("CHART_MAX_PER_SESSION", "32"))
+RENDER_CACHE_MAX_ENTRIES = 64
+
+# Resolution of the PNG renders
+CHART_DPI = 100
+
+# Hexagons across the x axis when a scatter is binned
+_HEXBIN_GRIDSIZE = 80
+
+# Tag the agent puts in its Final Answer to show a captured chart
+CHART_TAG = "[CHART:"
+
+# Matches "[CHART:<id>]" and the former "[CHART_PATH:<file>]" tags
+CHART_TAG_PATTERN = re.compile(r"\[(CHART|CHART_PATH):\s*([^\]]+?)\s*\]")
+
+_render_cache = OrderedDict()            # (code, dataset key, figure digest) -> (png, notes)
+_render_cache_lock = threading.Lock()
+
+
+def lttb(x: np.ndarray, y: np.ndarray, threshold: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Largest-Triangle-Three-Buckets downsampling: keeps the first and last
+    points and, from each of `threshold - 2` buckets in between, the point
+    forming the largest triangle with the previously kept point and the
+    next bucket's average. Peaks and the overall shape of the series survive.
+    """
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return x, y
+    every = (n - 2) / (threshold - 2)
+    keep = np.empty(threshold, dtype=np.int64)
+    keep[0], keep[-1] = 0, n - 1
+    previous = 0
+    for i in range(threshold - 2):
+        start = int(i * every) + 1
+        end = int((i + 1) * every) + 1
+        next_end = min(int((i + 2) * every) + 1, n)
+        avg_x = x[end:next_end].mean()
+        avg_y = y[end:next_end].mean()
+        areas = np.abs(
+            (x[previous] - avg_x) * (y[start:end] - y[previous])
+            - (x[previous] - x[start:end]) * (avg_y - y[previous])
+        )
+        previous = start + int(np.argmax(areas))
+        keep[i + 1] = previous
+    return x[keep], y[keep]
+
+
+def _downsample_lines(ax, notes: List[str]) -> None:
+    for line in ax.get_lines():
+        xy = np.asarray(line.get_xydata(), dtype="float64")
+        if len(xy) <= CHART_MAX_POINTS:
+            continue
+        xy = xy[~np.isnan(xy).any(axis=1)]
+        if len(xy) > 1 and np.any(np.diff(xy[:, 0]) < 0):
+            xy = xy[np.argsort(xy[:, 0], kind="stable")]
+        x, y = lttb(xy[:, 0], xy[:, 1], CHART_MAX_POINTS)
+        line.set_data(x, y)
+        label = line.get_label()
+        name = "a line" if label.startswith("_") else f"line '{label}'"
+        notes.append(f"{name} downsampled from {len(xy)} to {len(x)} points (LTTB)")
+
+
+def _bin_scatters(ax, notes: List[str]) -> None:
+    from matplotlib.collections import PathCollection
+
+    for collection in list(ax.collections):
+        if not isinstance(collection, PathCollection):
+            continue
+        offsets = np.asarray(collection.get_offsets(), dtype="float64")
+        if len(offsets) <= CHART_MAX_POINTS:
+            continue
+        offsets = offsets[~np.isnan(offsets).any(axis=1)]
+        collection.remove()
+        ax.hexbin(offsets[:, 0], offsets[:, 1], gridsize=_HEXBIN_GRIDSIZE, mincnt=1, cmap="viridis")
+        notes.append(f"scatter of {len(offsets)} points drawn as a hexbin density plot")
+
+
+def downsample_figure(fig) -> List[str]:
+    """
+    Shrinks what a figure has to draw: lines with more than
+    `CHART_MAX_POINTS` points are reduced with LTTB and larger scatters are
+    replaced by hexagonal binning.
+
+    Returns:
+        One note per series that was reduced.
+    """
+    notes = []
+    for ax in fig.get_axes():
+        _downsample_lines(ax, notes)
+        _bin_scatters(ax, notes)
+    return notes
+
+
+# Artist state that can change the pixels of a render, read from every artist that has it
+_DIGEST_GETTERS = (
+    "get_visible", "get_alpha", "get_zorder", "get_text", "get_position", "get_rotation", "get_fontsize",
+    "get_fontweight", "get_horizontalalignment", "get_verticalalignment", "get_color", "get_xydata",
+    "get_linestyle", "get_linewidth", "get_marker", "get_markersize", "get_offsets", "get_sizes",
+    "get_facecolor", "get_edgecolor", "get_linewidths", "get_hatch", "get_array", "get_clim", "get_extent",
+    "get_xlim", "get_ylim", "get_xscale", "get_yscale", "get_size_inches", "get_dpi",
+)
+
+
+def _digest_value(digest, value) -> None:
+    if isinstance(value, np.ma.MaskedArray):
+        _digest_value(digest, np.ma.getdata(value))
+        value = np.ma.getmaskarray(value)
+    if isinstance(value, np.ndarray) and value.dtype.kind in "biufcM":
+        digest.update(repr((value.dtype.str, value.shape)).encode("utf-8"))
+        digest.update(np.ascontiguousarray(value).tobytes())
+    elif isinstance(value, (list, tuple)) and value and isinstance(value[0], np.ndarray):
+        for item in value:
+            _digest_value(digest, item)
+    else:
+        digest.update(repr(value).encode("utf-8"))
+
+
+def _figure_digest(fig) -> str:
+    """
+    Hash of everything a figure draws: every artist's data and style (line and
+    scatter data, collection paths and color arrays, images, patches, texts,
+    legends, colormaps, limits and scales), plus the tick positions and labels,
+    so equal code whose figure differs in any visible way never reuses a render.
+    """
+    digest = hashlib.sha256()
+    for ax in fig.get_axes():
+        for axis in (ax.xaxis, ax.yaxis):
+            # Formats the tick labels (normally done at draw time), so they can be hashed below
+            _digest_value(digest, axis.get_ticklocs())
+            for label in axis.get_ticklabels(which="both"):
+                digest.update(label.get_text().encode("utf-8"))
+    for artist in fig.findobj():
+        digest.update(type(artist).__name__.encode("utf-8"))
+        for getter in _DIGEST_GETTERS:
+            method = getattr(artist, getter, None)
+            if method is None:
+                continue
+            try:
+                _digest_value(digest, method())
+            except Exception:
+                continue
+        if hasattr(artist, "get_paths"):
+            _digest_value(digest, [path.vertices for path in artist.get_paths()])
+        if hasattr(artist, "get_cmap"):
+            digest.update(str(getattr(artist.get_cmap(), "name", "")).encode("utf-8"))
+        if hasattr(artist, "get_extents"):
+            _digest_value(digest, np.asarray(artist.get_extents().bounds, dtype="float64"))
+    return digest.hexdigest()
+
+
+def capture_figures(code: str, dataset_key: str) -> List[Tuple[bytes, List[str]]]:
+    """
+    Renders every open pyplot figure to PNG in memory and closes them.
+
+    Renders are cached by the code, the dataset it ran against and a digest
+    of everything the figure draws (see `_figure_digest`), so re-running the
+    same plotting code skips the downsampling and rasterization.
+
+    Returns:
+        One (png bytes, downsampling notes) pair per figure.
+    """
+    import matplotlib.pyplot as plt
+
+    rendered = []
+    try:
+        for number in plt.get_fignums():
+            fig = plt.figure(number)
+            if not fig.get_axes():
+                continue
+            key = (code, dataset_key, _figure_digest(fig))
+            with _render_cache_lock:
+                cached = _render_cache.get(key)
+                if cached is not None:
+                    _render_cache.move_to_end(key)
+            if cached is None:
+                notes = downsample_figure(fig)
+                buffer = BytesIO()
+                fig.savefig(buffer, format="png", dpi=CHART_DPI, bbox_inches="tight")
+                cached = (buffer.getvalue(), notes)
+                with _render_cache_lock:
+                    _render_cache[key] = cached
+                    while len(_render_cache) > RENDER_CACHE_MAX_ENTRIES:
+                        _render_cache.popitem(last=False)
+            rendered.append(cached)
+    finally:
+        plt.close("all")
+    return rendered
+
+
+class ChartStore:
+    """
+    The charts captured in one session, by id, in memory. Only the most
+    recent `max_charts` are kept; older ones are evicted first.
+    """
+
+    def __init__(self, max_charts: int = CHART_MAX_PER_SESSION):
+        self.max_charts = max_charts
+        self._charts = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, png: bytes) -> str:
+        """Stores a rendered chart and returns its new id."""
+        chart_id = uuid.uuid4().hex[:10]
+        self.put(chart_id, png)
+        return chart_id
+
+    def put(self, chart_id: str, png: bytes) -> None:
+        """Stores a chart under a known id, e.g. one restored from the answer cache."""
+        with self._lock:
+            self._charts[chart_id] = png
+            self._charts.move_to_end(chart_id)
+            while len(self._charts) > self.max_charts:
+                self._charts.popitem(last=False)
+
+    def get(self, chart_id: str) -> Optional[bytes]:
+        with self._lock:
+            return self._charts.get(chart_id)
+
+    def collect(self, text: str) -> Dict[str, bytes]:
+        """Returns the stored charts referenced by `[CHART:id]` tags in `text`."""
+        charts = {}
+        for kind, chart_id in CHART_TAG_PATTERN.findall(text):
+            png = self.get(chart_id) if kind == "CHART" else None
+            if png is not None:
+                charts[chart_id] = png
+        return charts
+
+    def clear(self) -> None:
+        with self._lock:
+            self._charts.clear()
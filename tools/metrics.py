@@ -0,0 +1,119 @@
+# tools/metrics.py
+
+# Import necessary libraries and modules
+import resource
+import sys
+import time
+from contextvars import ContextVar
+from typing import Dict, Optional
+
+_MB = 1024 * 1024
+
+# Metrics a tool reports about its current call, picked up by the tracer. A context
+# variable holding a dict follows the call into the executor thread of async runs
+_reported: ContextVar = ContextVar("tool_metrics", default=None)
+
+
+def reset_peak_rss() -> bool:
+    """
+    Resets the process's peak resident memory (VmHWM) to its current RSS,
+    so the next reading is the peak of what ran in between. Linux only.
+
+    Returns:
+        False where the reset is unavailable; peaks then cover the process lifetime.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as handle:
+            handle.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _status_kb(field: str) -> Optional[int]:
+    try:
+        with open("/proc/self/status") as handle:
+            for line in handle:
+                if line.startswith(field):
+                    return int(line.split()[1])
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def current_rss_bytes() -> Optional[int]:
+    """Current resident memory of this process, or None where /proc is unavailable."""
+    kb = _status_kb("VmRSS:")
+    return None if kb is None else kb * 1024
+
+
+def peak_rss_bytes() -> int:
+    """Peak resident memory of this process since start or the last `reset_peak_rss`."""
+    kb = _status_kb("VmHWM:")
+    if kb is not None:
+        return kb * 1024
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class ResourceProbe:
+    """
+    Measures one call: wall time, CPU time and the peak resident memory of
+    this process while it ran, also as growth over the RSS at the start.
+
+    CPU time is process-wide, so it includes native threads a call starts
+    (DuckDB, BLAS) but also any other work the process does concurrently.
+    """
+
+    def __init__(self):
+        self.reset_ok = reset_peak_rss()
+        self.start_rss = current_rss_bytes()
+        self.start_peak = peak_rss_bytes()
+        self.start_cpu = time.process_time()
+        self.start_wall = time.perf_counter()
+
+    def finish(self) -> Dict[str, float]:
+        metrics = {
+            "wall_s": time.perf_counter() - self.start_wall,
+            "cpu_s": time.process_time() - self.start_cpu,
+        }
+        peak = peak_rss_bytes()
+        metrics["peak_rss_mb"] = peak / _MB
+        if self.reset_ok and self.start_rss is not None:
+            metrics["rss_growth_mb"] = max(0, peak - self.start_rss) / _MB
+        else:
+            # Without a reset only a new lifetime peak can be attributed to the call
+            metrics["rss_growth_mb"] = max(0, peak - self.start_peak) / _MB
+        return metrics
+
+
+def start_tool_metrics() -> Dict[str, float]:
+    """
+    Opens the metrics of a tool call about to start in this context. Tools
+    run from here (directly, or in an executor thread with a copy of the
+    context) report into the returned dict.
+    """
+    metrics = {}
+    _reported.set(metrics)
+    return metrics
+
+
+def report_tool_metrics(**metrics) -> None:
+    """
+    Records details of the running tool call (e.g. execution and chart
+    rendering time, or a sandbox worker's own CPU and memory), which the
+    agent tracer merges into the step when the tool returns.
+    """
+    current = _reported.get()
+    if current is None:
+        current = {}
+        _reported.set(current)
+    current.update(metrics)
+
+
+def pop_tool_metrics() -> Dict[str, float]:
+    """Returns and clears the metrics reported for the current tool call."""
+    metrics = _reported.get() or {}
+    _reported.set(None)
+    return metrics
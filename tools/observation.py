@@ -0,0 +1,117 @@
+# tools/observation.py
+
+# Import necessary libraries and modules
+import os
+import re
+import traceback
+from contextlib import contextmanager
+
+import pandas as pd
+
+# Size budget of one tool observation (~4 characters per token)
+OBSERVATION_MAX_CHARS = int(os.environ.get("OBSERVATION_MAX_CHARS", "4000"))
+
+# Stack frames kept from a traceback (the user's code plus the innermost library frames)
+TRACEBACK_MAX_FRAMES = 4
+
+# pandas display options used while agent code runs, so print(df) stays compact
+_DISPLAY_OPTIONS = {
+    "display.max_rows": 20,
+    "display.min_rows": 10,
+    "display.max_columns": 20,
+    "display.width": 200,
+    "display.max_colwidth": 50,
+    "display.show_dimensions": True,
+}
+
+# Footers pandas prints under truncated DataFrame/Series reprs
+_FRAME_FOOTER = re.compile(r"^\[\d+ rows x \d+ columns\]$")
+_SERIES_FOOTER = re.compile(r"^(Name: .*, )?Length: \d+, dtype: .+$")
+
+# Filename exec() reports for the agent's code
+_USER_CODE_FILENAME = "<string>"
+
+
+@contextmanager
+def compact_display():
+    """Renders DataFrames and Series printed inside the block head/tail with their dimensions."""
+    args = [item for pair in _DISPLAY_OPTIONS.items() for item in pair]
+    with pd.option_context(*args):
+        yield
+
+
+def format_exception_compact(exc: BaseException, max_frames: int = TRACEBACK_MAX_FRAMES) -> str:
+    """
+    Formats an exception raised by agent code, keeping only the relevant frames:
+    frames of the executor itself are dropped, the agent's own lines are kept,
+    and long library call chains are cut down to their innermost frames.
+    """
+    frames = traceback.extract_tb(exc.__traceback__)
+    user_start = next((i for i, frame in enumerate(frames) if frame.filename == _USER_CODE_FILENAME), len(frames))
+    frames = frames[user_start:]
+
+    omitted = 0
+    if len(frames) > max_frames:
+        user_frames = [frame for frame in frames[:-1] if frame.filename == _USER_CODE_FILENAME][:1]
+        tail = frames[-(max_frames - len(user_frames)):]
+        omitted = len(frames) - len(user_frames) - len(tail)
+        frames = traceback.StackSummary.from_list(user_frames + list(tail))
+        lines = ["Traceback (most recent call last):\n"]
+        lines.extend(frames.format()[:len(user_frames)])
+        lines.append(f"  ... ({omitted} frames omitted)\n")
+        lines.extend(frames.format()[len(user_frames):])
+    else:
+        lines = ["Traceback (most recent call last):\n"]
+        lines.extend(traceback.StackSummary.from_list(frames).format())
+    lines.extend(traceback.format_exception_only(type(exc), exc))
+    return "".join(lines)
+
+
+def _mark_compact_reprs(lines: list) -> list:
+    """Annotates DataFrame/Series repr footers so the agent knows the print was truncated."""
+    annotated = []
+    for line in lines:
+        annotated.append(line)
+        stripped = line.strip()
+        if _FRAME_FOOTER.match(stripped) or _SERIES_FOOTER.match(stripped):
+            annotated.append("(compact display; use aggregations, .head() or filters to see details)")
+    return annotated
+
+
+def shape_output(text: str, max_chars: int = OBSERVATION_MAX_CHARS) -> str:
+    """
+    Fits captured output into the observation budget. Text within budget is
+    returned as is; longer text keeps its first and last lines around a
+    marker stating how many lines and characters were left out.
+    """
+    if not text:
+        return text
+    lines = _mark_compact_reprs(text.splitlines())
+    shaped = "\n".join(lines)
+    if len(shaped) <= max_chars:
+        return shaped
+
+    head_budget = max_chars * 2 // 3
+    tail_budget = max_chars - head_budget
+    head, used = [], 0
+    for line in lines:
+        if used + len(line) + 1 > head_budget:
+            break
+        head.append(line)
+        used += len(line) + 1
+    tail, used = [], 0
+    for line in reversed(lines[len(head):]):
+        if used + len(line) + 1 > tail_budget:
+            break
+        tail.append(line)
+        used += len(line) + 1
+    tail.reverse()
+
+    if not head and not tail:
+        # A single huge line: cut it by characters
+        return f"{shaped[:head_budget]}\n... [output truncated: {len(shaped)} characters in total] ...\n{shaped[-tail_budget:]}"
+
+    omitted_lines = len(lines) - len(head) - len(tail)
+    omitted_chars = len(shaped) - sum(len(line) + 1 for line in head + tail)
+    marker = f"... [output truncated: {omitted_lines} of {len(lines)} lines and {omitted_chars} characters omitted] ..."
+    return "\n".join(head + [marker] + tail)
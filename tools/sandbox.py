@@ -0,0 +1,353 @@
+# tools/sandbox.py
+
+# Import necessary libraries and modules
+import atexit
+import multiprocessing as mp
+import os
+import sys
+import tempfile
+import threading
+import time
+import traceback
+import weakref
+from collections import OrderedDict
+from io import StringIO
+from typing import List, Optional, Tuple
+
+import pandas as pd
+import pyarrow.feather as feather
+
+from tools.charts import capture_figures
+from tools.metrics import ResourceProbe
+from tools.observation import compact_display, format_exception_compact
+
+# Defaults for the worker pool (overridable via environment)
+DEFAULT_WORKERS = int(os.environ.get("SANDBOX_WORKERS", "2"))
+DEFAULT_TIMEOUT_S = float(os.environ.get("SANDBOX_TIMEOUT_S", "60"))
+DEFAULT_MEMORY_LIMIT_MB = int(os.environ.get("SANDBOX_MEMORY_MB", "2048"))
+
+# How often the parent checks a running call for timeout and memory growth
+_WATCH_INTERVAL_S = 0.1
+
+# Datasets kept mapped per worker; older ones are dropped first
+_MAX_MAPPED_DATASETS = 4
+
+# Sent by a worker once the call's dataset is bound, before the code runs
+_READY = "ready"
+
+
+def _shared_dirs(size_hint: int) -> List[str]:
+    """
+    Where to export a dataset, best first. /dev/shm is RAM-backed on Linux,
+    so the mapped file never hits the disk, but it is often small (64 MB by
+    default in Docker); it is skipped when it cannot hold `size_hint` bytes.
+    """
+    directories = []
+    if os.path.isdir("/dev/shm"):
+        try:
+            stat = os.statvfs("/dev/shm")
+            if stat.f_bavail * stat.f_frsize > size_hint:
+                directories.append("/dev/shm")
+        except OSError:
+            pass
+    directories.append(tempfile.gettempdir())
+    return directories
+
+
+def _remove_file(path: str) -> None:
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _rss_bytes(pid: int) -> Optional[int]:
+    """
+    Private resident memory of a process (resident minus shared pages, so
+    the mapped dataset is not counted), or None where /proc is unavailable.
+    """
+    try:
+        with open(f"/proc/{pid}/statm") as handle:
+            fields = handle.read().split()
+        return (int(fields[1]) - int(fields[2])) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class SharedDataset:
+    """
+    A DataFrame exported once as an uncompressed Arrow IPC (Feather v2) file,
+    in shared memory when it fits (see `_shared_dirs`). Workers memory-map it instead of receiving a pickled
+    copy (see `_load_dataset`). The file is removed when this object is
+    garbage collected.
+    """
+
+    def __init__(self, dataframe: pd.DataFrame):
+        directories = _shared_dirs(int(dataframe.memory_usage(deep=False).sum()))
+        for attempt, directory in enumerate(directories, start=1):
+            fd, self.path = tempfile.mkstemp(prefix="nfe_df_", suffix=".arrow", dir=directory)
+            os.close(fd)
+            try:
+                feather.write_feather(dataframe, self.path, compression="uncompressed")
+                break
+            except OSError:
+                # Typically a full /dev/shm: fall back to the next location
+                _remove_file(self.path)
+                if attempt == len(directories):
+                    raise
+            except Exception:
+                _remove_file(self.path)
+                raise
+        self.size = os.path.getsize(self.path)
+        self._finalizer = weakref.finalize(self, _remove_file, self.path)
+
+
+def _load_dataset(path: str) -> pd.DataFrame:
+    """
+    Maps a shared dataset back into a frame with exactly the parent's dtypes,
+    so code written from the dataset profile sees the same frame here.
+    Arrow-typed frames come back as ArrowDtype columns over the mapped
+    buffers; in NumPy-typed frames, numeric columns without nulls are
+    zero-copy views and the other columns are converted from the metadata.
+    """
+    table = feather.read_table(path, memory_map=True)
+    columns = (table.schema.pandas_metadata or {}).get("columns", [])
+    if any(str(column.get("numpy_type", "")).endswith("[pyarrow]") for column in columns):
+        return table.to_pandas(types_mapper=pd.ArrowDtype, split_blocks=True)
+    return table.to_pandas(split_blocks=True)
+
+
+def _worker_main(conn) -> None:
+    """
+    Worker loop: keeps one persistent execution scope per session and runs
+    each snippet with stdout captured. The process is single-threaded, so
+    swapping `sys.stdout` here cannot leak output between calls.
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+
+    datasets = OrderedDict()          # path -> DataFrame
+    scopes = {}                       # session id -> (dataset path, scope)
+
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            break
+        if message is None:
+            break
+
+        kind, session_id = message[0], message[1]
+        if kind == "reset":
+            scopes.pop(session_id, None)
+            continue
+
+        _, _, dataset_path, code = message
+        metrics = {}
+        try:
+            if dataset_path not in datasets:
+                load_start = time.perf_counter()
+                datasets[dataset_path] = _load_dataset(dataset_path)
+                metrics["load_s"] = time.perf_counter() - load_start
+                while len(datasets) > _MAX_MAPPED_DATASETS:
+                    datasets.popitem(last=False)
+            datasets.move_to_end(dataset_path)
+
+            path, scope = scopes.get(session_id, (None, None))
+            if scope is None:
+                scope = {'pd': pd, 'plt': plt, 'sns': sns}
+            if path != dataset_path:
+                scope['df'] = datasets[dataset_path]
+            scopes[session_id] = (dataset_path, scope)
+        except Exception:
+            conn.send(("error", traceback.format_exc(), [], metrics))
+            continue
+        # Lets the parent take its memory baseline with the dataset loaded
+        conn.send(_READY)
+
+        # Start from no open figures, so only this call's plots are captured
+        plt.close("all")
+        old_stdout = sys.stdout
+        sys.stdout = captured_output = StringIO()
+        charts = []
+        probe = ResourceProbe()
+        try:
+            with compact_display():
+                exec(code, scope)
+            metrics["exec_s"] = time.perf_counter() - probe.start_wall
+            status, text = "ok", captured_output.getvalue()
+            charts = capture_figures(code, dataset_path)
+            metrics["chart_s"] = time.perf_counter() - probe.start_wall - metrics["exec_s"]
+        except MemoryError as e:
+            status, text = "memory", format_exception_compact(e)
+        except Exception as e:
+            status, text = "error", format_exception_compact(e)
+        finally:
+            sys.stdout = old_stdout
+            plt.close("all")
+        # The worker's own CPU time and memory peak, which the parent cannot see
+        finished = probe.finish()
+        metrics.setdefault("exec_s", finished["wall_s"])
+        metrics.update(cpu_s=finished["cpu_s"], peak_rss_mb=finished["peak_rss_mb"], rss_growth_mb=finished["rss_growth_mb"])
+        conn.send((status, text, charts, metrics))
+
+
+class _Worker:
+    def __init__(self, context):
+        self._context = context
+        self.lock = threading.Lock()
+        self.cancelled = threading.Event()
+        self.sessions = set()
+        self._start()
+
+    def _start(self):
+        self.conn, child_conn = self._context.Pipe()
+        self.process = self._context.Process(target=_worker_main, args=(child_conn,), daemon=True)
+        self.process.start()
+        child_conn.close()
+
+    def restart(self):
+        """Kills the process (dropping every scope it held) and starts a fresh one."""
+        try:
+            self.process.kill()
+            self.process.join(timeout=5)
+        except Exception:
+            pass
+        self.conn.close()
+        self.sessions.clear()
+        self._start()
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+            self.process.join(timeout=2)
+        except Exception:
+            pass
+        if self.process.is_alive():
+            self.process.kill()
+
+
+class SandboxPool:
+    """
+    Pool of warm worker processes that execute agent code out of process.
+
+    Each session is pinned to one worker so its variables persist between
+    calls, while different sessions run in parallel on different workers.
+    Calls are bounded by a wall-clock timeout and by the growth of the
+    worker's resident memory (Linux); a call that exceeds either is
+    cancelled by killing the worker, which is restarted immediately.
+    """
+
+    def __init__(self, workers: int = DEFAULT_WORKERS, timeout: float = DEFAULT_TIMEOUT_S,
+                 memory_limit_mb: int = DEFAULT_MEMORY_LIMIT_MB):
+        # "spawn" keeps workers from inheriting the server's threads and locks
+        context = mp.get_context("spawn")
+        self.timeout = timeout
+        self.memory_limit = memory_limit_mb * 1024 * 1024
+        self._workers = [_Worker(context) for _ in range(max(1, workers))]
+        self._routes = {}                 # session id -> worker
+        self._lock = threading.Lock()
+
+    def _worker_for(self, session_id: str) -> _Worker:
+        with self._lock:
+            worker = self._routes.get(session_id)
+            if worker is None or session_id not in worker.sessions:
+                worker = min(self._workers, key=lambda w: (len(w.sessions), w.lock.locked()))
+                worker.sessions.add(session_id)
+                self._routes[session_id] = worker
+            return worker
+
+    def execute(self, code: str, dataset: SharedDataset, session_id: str = "default",
+                timeout: Optional[float] = None) -> Tuple[str, str, List[Tuple[bytes, List[str]]], dict]:
+        """
+        Runs `code` with `df` bound to `dataset` in the session's scope.
+        The memory limit applies to growth of the worker's private RSS over
+        its level once the dataset is bound, so loading it is not counted.
+
+        Returns:
+            (status, text, charts, metrics): status is "ok", "error", "timeout",
+            "memory", "cancelled" or "crashed"; text is the captured stdout or
+            the error details; charts are the figures the code left open,
+            rendered to PNG (see `tools.charts.capture_figures`); metrics are the
+            worker's timings (load_s, exec_s, chart_s), CPU time and memory
+            peak, empty when the worker did not finish the call.
+        """
+        timeout = self.timeout if timeout is None else timeout
+        worker = self._worker_for(session_id)
+        with worker.lock:
+            pid = worker.process.pid
+            # Replaced by the level after loading as soon as the worker reports it
+            baseline = _rss_bytes(pid)
+            try:
+                worker.conn.send(("exec", session_id, dataset.path, code))
+            except (BrokenPipeError, OSError):
+                worker.restart()
+                return "crashed", "The execution process had died and was restarted; run the code again.", [], {}
+
+            worker.cancelled.clear()
+            deadline = time.monotonic() + timeout
+            while True:
+                try:
+                    if worker.conn.poll(_WATCH_INTERVAL_S):
+                        reply = worker.conn.recv()
+                        if reply != _READY:
+                            return reply
+                        baseline = _rss_bytes(pid)
+                        continue
+                except (EOFError, OSError):
+                    worker.restart()
+                    return "crashed", "The execution process died unexpectedly and was restarted; previously defined variables were lost.", [], {}
+
+                if worker.cancelled.is_set():
+                    worker.restart()
+                    return "cancelled", "Execution was cancelled; previously defined variables were lost.", [], {}
+                if time.monotonic() > deadline:
+                    worker.restart()
+                    return "timeout", f"Execution exceeded the {timeout:.0f}s time limit and was cancelled; previously defined variables were lost.", [], {}
+                rss = _rss_bytes(pid)
+                if baseline is not None and rss is not None and rss - baseline > self.memory_limit:
+                    worker.restart()
+                    return "memory", f"Execution exceeded the {self.memory_limit // (1024 * 1024)} MB memory limit and was cancelled; previously defined variables were lost.", [], {}
+                if not worker.process.is_alive():
+                    worker.restart()
+                    return "crashed", "The execution process died unexpectedly and was restarted; previously defined variables were lost.", [], {}
+
+    def cancel(self, session_id: str) -> None:
+        """Cancels whatever the session is running; its worker is restarted by the waiting call."""
+        with self._lock:
+            worker = self._routes.get(session_id)
+        if worker is not None and worker.lock.locked():
+            worker.cancelled.set()
+
+    def reset_session(self, session_id: str) -> None:
+        """Drops the session's variables in its worker."""
+        with self._lock:
+            worker = self._routes.pop(session_id, None)
+            if worker is None:
+                return
+            worker.sessions.discard(session_id)
+        with worker.lock:
+            try:
+                worker.conn.send(("reset", session_id))
+            except (BrokenPipeError, OSError):
+                worker.restart()
+
+    def shutdown(self) -> None:
+        for worker in self._workers:
+            worker.stop()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_sandbox_pool() -> SandboxPool:
+    """Returns the process-wide sandbox pool, starting its workers on first use."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = SandboxPool()
+            atexit.register(_pool.shutdown)
+        return _pool